@@ -0,0 +1,270 @@
+import csv
+import os
+
+import numpy as np
+
+from utils import PipelineFailedException
+
+
+def run_alignment(module_dict, settings):
+    '''
+    Retention time alignment of all samples against consensus anchor peak groups
+
+    Anchor peak groups are found in the mzrollDB with a batched cosine similarity
+    between each group's intensity profile across samples and the consensus
+    profile (`cosine_cutoff`). Each sample's RT deviations from the anchors' median
+    RTs are then smoothed with a penalized cubic B-spline (`spline_ridge_penalty`);
+    all samples are fit in a single batched solve.
+
+    The RT correction is written as an RT update key (sample, rt, rt_update) and
+    registered on settings so that peakdetector uses it when it is rerun in the
+    same pipe.
+
+    Parameters
+    ----------
+    module_dict : dict
+      module configuration; parameters are merged with globals
+    settings : MzkitSettings
+      paths to the dataset, outputs and programming assets, and run settings
+    '''
+
+    parameters = module_dict['parameters']
+
+    cosine_cutoff = float(parameters.get('cosine_cutoff', 0.95))
+    ridge_penalty = float(parameters.get('spline_ridge_penalty', 400))
+    min_sample_fraction = float(parameters.get('min_sample_fraction', 0.8))
+    max_anchors = int(parameters.get('max_anchors', 2000))
+    n_knots = int(parameters.get('n_knots', 20))
+    rt_step = float(parameters.get('rt_step', 0.05))
+    quant_type = parameters.get('quant_type', "peakAreaTop")
+
+    if not os.path.isfile(settings.mzrolldb_file):
+        raise PipelineFailedException("mzrollDB not found: %s" % settings.mzrolldb_file)
+
+    conn = settings.py_context.mzrolldb(settings.mzrolldb_file)
+    sample_ids, sample_names = read_samples(conn)
+    group_ids, rt_matrix, intensity_matrix = read_candidate_groups(conn, sample_ids, min_sample_fraction, quant_type)
+
+    if group_ids.size == 0:
+        raise PipelineFailedException("no peak groups were detected in at least %.0f%% of samples" % (min_sample_fraction * 100))
+
+    similarity = consensus_cosine_similarity(intensity_matrix)
+    anchors = np.nonzero(similarity >= cosine_cutoff)[0]
+    anchors = anchors[np.argsort(similarity[anchors])[::-1][:max_anchors]]
+
+    if anchors.size < 4:
+        raise PipelineFailedException("only %d anchor peak groups passed cosine_cutoff=%s" % (anchors.size, cosine_cutoff))
+
+    print("# Aligning %d samples using %d anchor peak groups" % (len(sample_ids), anchors.size))
+
+    anchor_rts = rt_matrix[anchors].T  # samples x anchors
+    rt_min = np.nanmin(rt_matrix)
+    rt_max = np.nanmax(rt_matrix)
+    knots = spline_knots(rt_min, rt_max, n_knots)
+
+    coefficients = fit_rt_deviations(anchor_rts, knots, ridge_penalty)
+
+    # RT correction evaluated on a grid for every sample
+    rt_grid = np.arange(rt_min, rt_max + rt_step, rt_step)
+    deviations = bspline_basis(rt_grid, knots) @ coefficients.T  # grid x samples
+
+    alignment_file = os.path.join(settings.run['output_folder'], parameters.get('alignment_file', "rt_update_key.txt"))
+    write_rt_update_key(alignment_file, sample_names, rt_grid, deviations)
+
+    report_alignment(anchor_rts, knots, coefficients, sample_names,
+                     os.path.join(settings.run['output_folder'], "QC", "alignment_summary.tsv"))
+
+    settings.alignment_file = alignment_file
+
+    return
+
+
+def read_samples(conn):
+
+    samples = conn.execute("SELECT sampleId, name FROM samples ORDER BY sampleId").fetchall()
+
+    return np.array([x[0] for x in samples], dtype=np.int64), [x[1] for x in samples]
+
+
+def read_candidate_groups(conn, sample_ids, min_sample_fraction, quant_type):
+    '''
+    Read groups found in at least min_sample_fraction of samples as group x sample RT and intensity matrices
+
+    Missing peaks are NaN in the RT matrix and 0 in the intensity matrix.
+    '''
+
+    min_samples = int(np.ceil(min_sample_fraction * sample_ids.size))
+
+    peaks = conn.execute(
+        'SELECT groupId, sampleId, rt, "%s" FROM peaks WHERE groupId IN '
+        '(SELECT groupId FROM peaks GROUP BY groupId HAVING COUNT(DISTINCT sampleId) >= ?) '
+        'ORDER BY groupId' % quant_type, (min_samples,)).fetchall()
+
+    if len(peaks) == 0:
+        return np.empty(0, dtype=np.int64), np.empty((0, sample_ids.size)), np.empty((0, sample_ids.size))
+
+    peaks = np.array(peaks, dtype=np.float64)
+    group_ids, row_index = np.unique(peaks[:, 0].astype(np.int64), return_inverse=True)
+    col_index = np.searchsorted(sample_ids, peaks[:, 1].astype(np.int64))
+
+    rt_matrix = np.full((group_ids.size, sample_ids.size), np.nan)
+    intensity_matrix = np.zeros((group_ids.size, sample_ids.size))
+
+    # keep the most intense peak if a group has several peaks in one sample
+    order = np.argsort(np.nan_to_num(peaks[:, 3]))
+    rt_matrix[row_index[order], col_index[order]] = peaks[order, 2]
+    intensity_matrix[row_index[order], col_index[order]] = np.nan_to_num(peaks[order, 3])
+
+    return group_ids, rt_matrix, intensity_matrix
+
+
+def consensus_cosine_similarity(intensity_matrix, batch_size=10000):
+    '''
+    Cosine similarity of each group's intensity profile to the consensus profile
+
+    The consensus is the median of the unit-normalized group profiles, so a
+    group scores highly when its intensity is spread across samples the way most
+    groups' are, rather than being driven by a few samples.
+
+    Profiles are normalized batch by batch: rows of batch_size groups for the
+    norms and similarities, and blocks of columns holding as many cells for
+    the column medians, so no normalized copy of the whole matrix is made.
+    '''
+
+    n_groups, n_samples = intensity_matrix.shape
+
+    norms = np.empty((n_groups, 1))
+    for start in range(0, n_groups, batch_size):
+        norms[start:start + batch_size, 0] = np.linalg.norm(intensity_matrix[start:start + batch_size], axis=1)
+    norms[norms == 0] = 1
+
+    block_columns = max(batch_size * n_samples // max(n_groups, 1), 1)
+    consensus = np.empty(n_samples)
+    for start in range(0, n_samples, block_columns):
+        block = slice(start, start + block_columns)
+        consensus[block] = np.median(intensity_matrix[:, block] / norms, axis=0)
+    consensus = consensus / max(np.linalg.norm(consensus), np.finfo(float).tiny)
+
+    similarity = np.empty(n_groups)
+    for start in range(0, n_groups, batch_size):
+        batch = slice(start, start + batch_size)
+        similarity[batch] = (intensity_matrix[batch] / norms[batch]) @ consensus
+
+    return similarity
+
+
+def spline_knots(x_min, x_max, n_knots, degree=3):
+    '''Uniform knots with degree-fold repeated boundary knots'''
+
+    inner = np.linspace(x_min, x_max, n_knots)
+
+    return np.concatenate([np.repeat(x_min, degree), inner, np.repeat(x_max, degree)])
+
+
+def bspline_basis(x, knots, degree=3):
+    '''
+    Evaluate all B-spline basis functions at x with the Cox-de Boor recursion
+
+    Returns an array of shape x.shape + (len(knots) - degree - 1,)
+    '''
+
+    x = np.clip(np.asarray(x, dtype=np.float64), knots[0], knots[-1])
+    x = x[..., None]
+
+    # degree 0: indicator of the knot span; the last non-empty span is closed on the right
+    left = knots[:-1]
+    right = knots[1:]
+    basis = ((x >= left) & (x < right)).astype(np.float64)
+    last_span = np.nonzero(right > left)[0][-1]
+    basis[..., last_span] += (x[..., 0] == knots[-1])
+
+    for d in range(1, degree + 1):
+        left_width = knots[d:-1] - knots[:-d - 1]
+        right_width = knots[d + 1:] - knots[1:-d]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            left_term = np.where(left_width > 0, (x - knots[:-d - 1]) / left_width, 0) * basis[..., :-1]
+            right_term = np.where(right_width > 0, (knots[d + 1:] - x) / right_width, 0) * basis[..., 1:]
+        basis = left_term + right_term
+
+    return basis
+
+
+def fit_rt_deviations(anchor_rts, knots, ridge_penalty):
+    '''
+    Fit every sample's RT deviation from the anchor consensus with a P-spline
+
+    Solves (B'WB + penalty * D'D) c = B'Wy for all samples at once, where B is
+    the B-spline basis at the sample's anchor RTs, W masks missing anchors, y
+    is the deviation from the anchors' median RT and D is the second difference
+    operator.
+
+    Parameters
+    ----------
+    anchor_rts : np.ndarray
+      samples x anchors RTs, NaN when an anchor was not detected in a sample
+    knots : np.ndarray
+      B-spline knots spanning the RT range
+    ridge_penalty : float
+      weight of the second difference (smoothness) penalty
+
+    Returns
+    -------
+    coefficients : np.ndarray
+      samples x basis functions spline coefficients
+    '''
+
+    consensus_rts = np.nanmedian(anchor_rts, axis=0)
+    deviations = anchor_rts - consensus_rts[None, :]
+
+    weights = np.isfinite(anchor_rts).astype(np.float64)
+    deviations = np.where(weights > 0, deviations, 0)
+    basis = bspline_basis(np.where(weights > 0, anchor_rts, knots[0]), knots)  # samples x anchors x basis
+
+    n_basis = basis.shape[-1]
+    difference = np.diff(np.eye(n_basis), n=2, axis=0)
+    penalty = ridge_penalty * difference.T @ difference
+
+    lhs = np.einsum('sak,sa,sal->skl', basis, weights, basis) + penalty[None, :, :]
+    rhs = np.einsum('sak,sa,sa->sk', basis, weights, deviations)
+
+    # a small ridge keeps samples with few anchors solvable
+    lhs += 1e-8 * np.eye(n_basis)[None, :, :]
+
+    return np.linalg.solve(lhs, rhs[..., None])[..., 0]
+
+
+def write_rt_update_key(out_path, sample_names, rt_grid, deviations):
+
+    with open(out_path, "w", newline="") as f:
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        writer.writerow(["sample", "rt", "rt_update"])
+
+        for i, name in enumerate(sample_names):
+            rt_update = rt_grid - deviations[:, i]
+            for rt, updated_rt in zip(rt_grid, rt_update):
+                writer.writerow([name, "%.4f" % rt, "%.4f" % updated_rt])
+
+    return
+
+
+def report_alignment(anchor_rts, knots, coefficients, sample_names, out_path):
+    '''Write each sample's anchor count and RMS deviation from the consensus before and after correction'''
+
+    consensus_rts = np.nanmedian(anchor_rts, axis=0)
+    observed = np.isfinite(anchor_rts)
+
+    fitted = np.einsum('sak,sk->sa', bspline_basis(np.where(observed, anchor_rts, knots[0]), knots), coefficients)
+    before = np.where(observed, anchor_rts - consensus_rts[None, :], np.nan)
+    after = np.where(observed, anchor_rts - fitted - consensus_rts[None, :], np.nan)
+
+    with open(out_path, "w", newline="") as f:
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        writer.writerow(["sample", "n_anchors", "rt_rmsd_before", "rt_rmsd_after"])
+
+        for i, name in enumerate(sample_names):
+            writer.writerow([name,
+                             int(observed[i].sum()),
+                             "%.4f" % np.sqrt(np.nanmean(before[i] ** 2)) if observed[i].any() else "NA",
+                             "%.4f" % np.sqrt(np.nanmean(after[i] ** 2)) if observed[i].any() else "NA"])
+
+    return
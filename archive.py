@@ -0,0 +1,613 @@
+import argparse
+import fnmatch
+import hashlib
+import os
+import socket
+import sqlite3
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from time import perf_counter
+
+import numpy as np
+import zstandard
+
+from utils import PipelineFailedException
+
+ARCHIVE_STORE_PATH = os.environ.get("MZKIT_ARCHIVE_STORE", os.path.join(os.path.expanduser("~"), ".mzkit", "archive"))
+
+ARCHIVE_INDEX_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS archives (
+        archive_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT,
+        source_folder TEXT,
+        host TEXT,
+        created_at TEXT,
+        status TEXT,
+        n_files INTEGER,
+        total_bytes INTEGER,
+        new_bytes INTEGER,
+        stored_bytes INTEGER)""",
+    """CREATE TABLE IF NOT EXISTS packs (
+        pack_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        archive_id INTEGER REFERENCES archives (archive_id),
+        path TEXT)""",
+    """CREATE TABLE IF NOT EXISTS chunks (
+        chunk_hash TEXT PRIMARY KEY,
+        pack_id INTEGER REFERENCES packs (pack_id),
+        offset INTEGER,
+        size INTEGER,
+        stored_size INTEGER)""",
+    """CREATE TABLE IF NOT EXISTS files (
+        archive_id INTEGER REFERENCES archives (archive_id),
+        path TEXT,
+        size INTEGER,
+        mtime REAL,
+        mode INTEGER,
+        sha256 TEXT,
+        PRIMARY KEY (archive_id, path))""",
+    """CREATE TABLE IF NOT EXISTS file_chunks (
+        archive_id INTEGER,
+        path TEXT,
+        seq INTEGER,
+        chunk_hash TEXT,
+        PRIMARY KEY (archive_id, path, seq))"""
+    ]
+
+# content-defined chunking: a cut is made after any byte where the hash of the preceding
+# CDC_WINDOW bytes is below 2 ** 32 / chunk_size, within [chunk_size / 4, chunk_size * 4].
+# Cuts depend only on nearby content, so an insertion or change only re-chunks its neighborhood.
+CDC_WINDOW = 64
+DEFAULT_CHUNK_SIZE = 2 ** 20
+DEFAULT_COMPRESSION_LEVEL = 3
+# never archived: batch job folders (also those of multiplexed sub-runs) and files being written
+DEFAULT_EXCLUDE = ["jobs/*", "*/jobs/*", "*.tmp"]
+# packs are rolled over at this size
+DEFAULT_PACK_SIZE = 2 ** 30
+# new pack data is synced and its index rows committed every this many bytes
+COMMIT_BYTES = 64 * 2 ** 20
+READ_BYTES = 4 * 2 ** 20
+
+# fixed, platform-independent parameters of the rolling hash; changing them changes every chunk boundary
+_CDC_BASE = 0x01000193
+_CDC_TABLE = np.array([int.from_bytes(hashlib.sha256(b"mzkit-cdc-%d" % x).digest()[:4], "little") for x in range(256)],
+                      dtype=np.uint32)
+_cdc_powers = {}
+
+
+def run_archive(module_dict, settings):
+    '''
+    Pack the run's outputs into a compressed, deduplicated archive store
+
+    Files are split into content-defined chunks, and chunks are stored once per
+    store as independent zstd frames in pack files; chunks already stored by
+    earlier archives (e.g., unchanged MSP libraries and tables) are only
+    referenced. An SQLite index maps each archived file to its chunks so that
+    single files can be extracted without reading the rest of the archive, see
+    `python mzkit.py archive`. The archive pipe runs after success.txt and the
+    run's final metrics are written, so both are archived; job folders and
+    temporary files are not.
+
+    Parameters
+    ----------
+    module_dict : dict
+      module configuration; parameters are merged with globals
+    settings : MzkitSettings
+      paths to the dataset, outputs and programming assets, and run settings
+    '''
+
+    parameters = module_dict['parameters']
+
+    output_folder = settings.run['output_folder']
+    store_path = parameters.get('archive_store') or ARCHIVE_STORE_PATH
+    name = parameters.get('archive_name') or os.path.basename(os.path.normpath(output_folder))
+    chunk_size = int(parameters.get('chunk_size', DEFAULT_CHUNK_SIZE))
+    compression_level = int(parameters.get('compression_level', DEFAULT_COMPRESSION_LEVEL))
+    pack_size = int(parameters.get('pack_size', DEFAULT_PACK_SIZE))
+    exclude = DEFAULT_EXCLUDE + list(parameters.get('exclude', []))
+
+    if chunk_size < 4096 or chunk_size & (chunk_size - 1):
+        raise ValueError('invalid chunk_size: %s; must be a power of 2 of at least 4096' % chunk_size)
+
+    relative_paths = list_archive_files(output_folder, exclude)
+    if not relative_paths:
+        raise PipelineFailedException("no files to archive in %s" % output_folder)
+
+    start_time = perf_counter()
+    with ArchiveWriter(store_path, name, output_folder, chunk_size, compression_level, pack_size,
+                       parameters.get('n_workers', 1)) as writer:
+        for n_done, relative_path in enumerate(relative_paths, 1):
+            writer.add_file(relative_path)
+            settings.telemetry.report_progress(module_dict['module'], n_done, len(relative_paths))
+
+    seconds = perf_counter() - start_time
+    print("# Archived %d files (%.2f GB) as %s #%d in %s" % (writer.n_files, writer.total_bytes / 2 ** 30, name, writer.archive_id, store_path))
+    print("# %.2f GB new after deduplication, %.2f GB stored after compression (%.1fx overall); %.0f MB/s" % (
+        writer.new_bytes / 2 ** 30, writer.stored_bytes / 2 ** 30, writer.total_bytes / max(writer.stored_bytes, 1),
+        writer.total_bytes / 2 ** 20 / max(seconds, 1e-6)))
+
+    return
+
+
+def list_archive_files(folder, exclude=DEFAULT_EXCLUDE):
+    '''Regular files under a folder, relative to it and sorted, skipping symlinks and paths matching an exclude pattern'''
+
+    relative_paths = []
+    for root, dirs, files in os.walk(folder):
+        dirs[:] = sorted(x for x in dirs if not os.path.islink(os.path.join(root, x)))
+        for file_name in files:
+            path = os.path.join(root, file_name)
+            relative_path = os.path.relpath(path, folder)
+            if os.path.islink(path) or not os.path.isfile(path):
+                continue
+            if any(fnmatch.fnmatch(relative_path, x) for x in exclude):
+                continue
+            relative_paths.append(relative_path)
+
+    return sorted(relative_paths)
+
+
+def connect_archive_index(store_path):
+    '''Open (and if needed create) the index of an archive store'''
+
+    if not os.path.exists(os.path.join(store_path, "packs")):
+        os.makedirs(os.path.join(store_path, "packs"))
+
+    conn = sqlite3.connect(os.path.join(store_path, "index.db"), timeout=300)
+    conn.execute("PRAGMA journal_mode = WAL")
+    for statement in ARCHIVE_INDEX_SCHEMA:
+        conn.execute(statement)
+    conn.commit()
+
+    return conn
+
+
+def _powers(n):
+    '''Powers 0..n-1 of the rolling hash base and of its inverse, modulo 2 ** 32'''
+
+    if n not in _cdc_powers:
+        powers = []
+        for base in [_CDC_BASE, pow(_CDC_BASE, -1, 2 ** 32)]:
+            values = np.full(n, base, dtype=np.uint32)
+            values[0] = 1
+            powers.append(np.cumprod(values, dtype=np.uint32))
+        _cdc_powers[n] = powers
+
+    return _cdc_powers[n]
+
+
+def cut_candidates(buffer, chunk_size):
+    '''
+    Positions after which a content-defined cut may be made
+
+    The hash of the window ending before position e is the polynomial
+    sum(table[b_i] * base ** (e - 1 - i)) modulo 2 ** 32. Weighting each byte by
+    the inverse base to the power of its position turns every window hash into a
+    difference of prefix sums, so all positions are hashed with a few vectorized
+    numpy operations (which release the GIL).
+
+    Parameters
+    ----------
+    buffer : np.ndarray
+      uint8 bytes
+    chunk_size : int
+      a cut is allowed where the hash is below 2 ** 32 / chunk_size
+
+    Returns
+    -------
+    positions : np.ndarray
+      offsets into buffer (exclusive end of the window) of allowed cuts
+    '''
+
+    n = len(buffer)
+    if n < CDC_WINDOW:
+        return np.zeros(0, dtype=np.int64)
+
+    powers, inverse_powers = _powers(READ_BYTES + CDC_WINDOW if n <= READ_BYTES + CDC_WINDOW else n)
+
+    prefix = _CDC_TABLE[buffer]
+    prefix *= inverse_powers[:n]
+    np.cumsum(prefix, dtype=np.uint32, out=prefix)
+
+    hashes = prefix[CDC_WINDOW - 1:].copy()
+    hashes[1:] -= prefix[:n - CDC_WINDOW]
+    hashes *= powers[CDC_WINDOW - 1:n]
+
+    return np.flatnonzero(hashes < np.uint32(2 ** 32 // chunk_size)) + CDC_WINDOW
+
+
+def iter_chunks(f, chunk_size, pool=None, n_reads=1):
+    '''
+    Split a binary file object into content-defined chunks of chunk_size / 4 to chunk_size * 4 bytes
+
+    With a thread pool, the cut candidates of n_reads successive reads are computed concurrently.
+    '''
+
+    min_size = chunk_size // 4
+    max_size = chunk_size * 4
+
+    pending = bytearray()
+    pending_start = 0  # file offset of pending[0], the last cut
+    candidates = np.zeros(0, dtype=np.int64)  # file offsets of allowed cuts after pending_start
+    tail = b""  # last CDC_WINDOW - 1 bytes read, so windows spanning reads are hashed
+
+    while True:
+        blocks = []
+        block_starts = []
+        end = pending_start + len(pending)
+        for _ in range(n_reads):
+            data = f.read(READ_BYTES)
+            if not data:
+                break
+            pending += data
+            blocks.append(np.frombuffer(tail + data, dtype=np.uint8))
+            block_starts.append(end - len(tail))
+            end += len(data)
+            tail = data[-(CDC_WINDOW - 1):]
+
+        if blocks:
+            block_candidates = pool.map(cut_candidates, blocks, [chunk_size] * len(blocks)) if pool is not None else \
+                [cut_candidates(blocks[0], chunk_size)]
+            candidates = np.concatenate([candidates] + [x + start for x, start in zip(block_candidates, block_starts)])
+
+        while True:
+            first = np.searchsorted(candidates, pending_start + min_size)
+            if first < len(candidates) and candidates[first] <= pending_start + max_size:
+                cut = int(candidates[first])
+            elif end >= pending_start + max_size:
+                cut = pending_start + max_size
+            else:
+                break
+
+            yield bytes(pending[:cut - pending_start])
+            del pending[:cut - pending_start]
+            pending_start = cut
+            candidates = candidates[first + 1:] if first < len(candidates) and candidates[first] == cut else candidates[first:]
+
+        if not blocks:
+            if pending:
+                yield bytes(pending)
+            return
+
+
+class ArchiveWriter(object):
+    '''
+    Adds the files of a folder to an archive store as one archive
+
+    New chunks are compressed by a pool of n_workers threads (zstd and sha256
+    release the GIL) and appended to packs owned by this archive, so several
+    runs may archive into the same store at once. Index rows are committed only
+    after the pack data they point to is synced; the archive is marked complete
+    when the writer is closed without an error.
+    '''
+
+    def __init__(self, store_path, name, source_folder, chunk_size=DEFAULT_CHUNK_SIZE,
+                 compression_level=DEFAULT_COMPRESSION_LEVEL, pack_size=DEFAULT_PACK_SIZE, n_workers=1):
+
+        self.store_path = store_path
+        self.source_folder = source_folder
+        self.chunk_size = chunk_size
+        self.compression_level = compression_level
+        self.pack_size = pack_size
+        self.n_workers = max(int(n_workers or 1), 1)
+
+        self.conn = connect_archive_index(store_path)
+        self.archive_id = self.conn.execute(
+            "INSERT INTO archives (name, source_folder, host, created_at, status, n_files, total_bytes, new_bytes, stored_bytes) "
+            "VALUES (?, ?, ?, ?, 'writing', 0, 0, 0, 0)",
+            (name, os.path.abspath(source_folder), socket.gethostname(), datetime.now().isoformat())).lastrowid
+        self.conn.commit()
+
+        self.n_files = 0
+        self.total_bytes = 0
+        self.new_bytes = 0
+        self.stored_bytes = 0
+
+        self.pack = None
+        self.pack_id = None
+        self.uncommitted_bytes = 0
+        # chunks written by this archive, including ones not yet visible to other index connections
+        self.session_chunks = set()
+
+        self.local = threading.local()
+        self.pool = ThreadPoolExecutor(max_workers=self.n_workers)
+
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close(complete=exc_type is None)
+
+    def _is_stored(self, chunk_hash):
+
+        if chunk_hash in self.session_chunks:
+            return True
+
+        # worker threads read the index through their own connections
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(os.path.join(self.store_path, "index.db"), timeout=300)
+
+        return conn.execute("SELECT 1 FROM chunks WHERE chunk_hash = ?", (chunk_hash,)).fetchone() is not None
+
+    def _prepare_chunk(self, chunk):
+        '''Hash a chunk, and compress it if the store does not have it yet'''
+
+        chunk_hash = hashlib.sha256(chunk).hexdigest()
+        if self._is_stored(chunk_hash):
+            return chunk_hash, len(chunk), None
+
+        compressor = getattr(self.local, "compressor", None)
+        if compressor is None:
+            compressor = self.local.compressor = zstandard.ZstdCompressor(level=self.compression_level)
+
+        return chunk_hash, len(chunk), compressor.compress(chunk)
+
+    def _open_pack(self):
+
+        self._close_pack()
+
+        cursor = self.conn.execute("INSERT INTO packs (archive_id, path) VALUES (?, NULL)", (self.archive_id,))
+        self.pack_id = cursor.lastrowid
+        relative_path = os.path.join("packs", "%06d-%06d.pack" % (self.archive_id, self.pack_id))
+        self.conn.execute("UPDATE packs SET path = ? WHERE pack_id = ?", (relative_path, self.pack_id))
+        self.pack = open(os.path.join(self.store_path, relative_path), "ab")
+
+    def _close_pack(self):
+
+        if self.pack is not None:
+            self._commit()
+            self.pack.close()
+            self.pack = None
+
+    def _commit(self):
+        '''Sync pack data, then commit the index rows which reference it'''
+
+        if self.pack is not None:
+            self.pack.flush()
+            os.fsync(self.pack.fileno())
+        self.conn.commit()
+        self.uncommitted_bytes = 0
+
+    def _store_chunk(self, chunk_hash, size, compressed):
+
+        if chunk_hash in self.session_chunks:
+            return
+
+        if self.pack is None or self.pack.tell() + len(compressed) > self.pack_size:
+            self._open_pack()
+
+        offset = self.pack.tell()
+        self.pack.write(compressed)
+        self.conn.execute("INSERT OR IGNORE INTO chunks (chunk_hash, pack_id, offset, size, stored_size) VALUES (?, ?, ?, ?, ?)",
+                          (chunk_hash, self.pack_id, offset, size, len(compressed)))
+        self.session_chunks.add(chunk_hash)
+
+        self.new_bytes += size
+        self.stored_bytes += len(compressed)
+        self.uncommitted_bytes += len(compressed)
+
+    def add_file(self, relative_path):
+        '''Add a file of the source folder to the archive'''
+
+        path = os.path.join(self.source_folder, relative_path)
+        stat = os.stat(path)
+        file_hash = hashlib.sha256()
+
+        chunk_hashes = []
+        in_flight = deque()
+
+        def store_next():
+            chunk_hash, size, compressed = in_flight.popleft().result()
+            if compressed is not None:
+                self._store_chunk(chunk_hash, size, compressed)
+            chunk_hashes.append(chunk_hash)
+
+        with open(path, "rb") as f:
+            for chunk in iter_chunks(f, self.chunk_size, self.pool, self.n_workers):
+                file_hash.update(chunk)
+                in_flight.append(self.pool.submit(self._prepare_chunk, chunk))
+                # bound the chunks held in memory
+                if len(in_flight) > 2 * self.n_workers:
+                    store_next()
+            while in_flight:
+                store_next()
+
+        self.conn.execute("INSERT INTO files (archive_id, path, size, mtime, mode, sha256) VALUES (?, ?, ?, ?, ?, ?)",
+                          (self.archive_id, relative_path, stat.st_size, stat.st_mtime, stat.st_mode & 0o7777, file_hash.hexdigest()))
+        self.conn.executemany("INSERT INTO file_chunks (archive_id, path, seq, chunk_hash) VALUES (?, ?, ?, ?)",
+                              [(self.archive_id, relative_path, seq, x) for seq, x in enumerate(chunk_hashes)])
+
+        self.n_files += 1
+        self.total_bytes += stat.st_size
+
+        if self.uncommitted_bytes >= COMMIT_BYTES:
+            self._commit()
+
+        return
+
+    def close(self, complete=True):
+
+        self.pool.shutdown()
+        self._close_pack()
+
+        self.conn.execute("UPDATE archives SET status = ?, n_files = ?, total_bytes = ?, new_bytes = ?, stored_bytes = ? WHERE archive_id = ?",
+                          ("complete" if complete else "failed", self.n_files, self.total_bytes, self.new_bytes,
+                           self.stored_bytes, self.archive_id))
+        self.conn.commit()
+        self.conn.close()
+
+        return
+
+
+class ArchiveReader(object):
+    '''Random access to the files of an archive store'''
+
+    def __init__(self, store_path):
+
+        if not os.path.isfile(os.path.join(store_path, "index.db")):
+            raise ValueError("No archive store at %s" % store_path)
+
+        self.store_path = store_path
+        self.conn = sqlite3.connect(os.path.join(store_path, "index.db"), timeout=300)
+        self.conn.row_factory = sqlite3.Row
+        self.decompressor = zstandard.ZstdDecompressor()
+        self.packs = {}
+
+        return
+
+    def close(self):
+
+        for pack in self.packs.values():
+            pack.close()
+        self.conn.close()
+
+    def archives(self, limit=None):
+        query = "SELECT * FROM archives WHERE status = 'complete' ORDER BY archive_id DESC"
+        if limit is not None:
+            query += " LIMIT %d" % limit
+        return self.conn.execute(query).fetchall()[::-1]
+
+    def find_archive(self, archive_ref):
+        '''An archive by id, or the latest complete archive with a name'''
+
+        if str(archive_ref).isdigit():
+            archive = self.conn.execute("SELECT * FROM archives WHERE archive_id = ? AND status = 'complete'", (int(archive_ref),)).fetchone()
+        else:
+            archive = self.conn.execute("SELECT * FROM archives WHERE name = ? AND status = 'complete' ORDER BY archive_id DESC LIMIT 1",
+                                        (archive_ref,)).fetchone()
+        if archive is None:
+            raise ValueError("No complete archive %s in %s" % (archive_ref, self.store_path))
+
+        return archive
+
+    def files(self, archive_id):
+        return self.conn.execute("SELECT * FROM files WHERE archive_id = ? ORDER BY path", (archive_id,)).fetchall()
+
+    def _pack(self, relative_path):
+        if relative_path not in self.packs:
+            self.packs[relative_path] = open(os.path.join(self.store_path, relative_path), "rb")
+        return self.packs[relative_path]
+
+    def read_chunks(self, archive_id, path):
+        '''Yield the decompressed chunks of an archived file in order'''
+
+        rows = self.conn.execute(
+            "SELECT packs.path AS pack_path, chunks.offset, chunks.size, chunks.stored_size "
+            "FROM file_chunks JOIN chunks USING (chunk_hash) JOIN packs USING (pack_id) "
+            "WHERE file_chunks.archive_id = ? AND file_chunks.path = ? ORDER BY file_chunks.seq", (archive_id, path)).fetchall()
+
+        for row in rows:
+            pack = self._pack(row['pack_path'])
+            pack.seek(row['offset'])
+            yield self.decompressor.decompress(pack.read(row['stored_size']), max_output_size=row['size'])
+
+    def extract_file(self, archive_id, path, out):
+        '''Write an archived file to a binary file object, checking its size and checksum'''
+
+        file_row = self.conn.execute("SELECT * FROM files WHERE archive_id = ? AND path = ?", (archive_id, path)).fetchone()
+        if file_row is None:
+            raise ValueError("%s is not in archive %d" % (path, archive_id))
+
+        file_hash = hashlib.sha256()
+        n_bytes = 0
+        for chunk in self.read_chunks(archive_id, path):
+            file_hash.update(chunk)
+            n_bytes += len(chunk)
+            out.write(chunk)
+
+        if n_bytes != file_row['size'] or file_hash.hexdigest() != file_row['sha256']:
+            raise ValueError("%s in archive %d is corrupt" % (path, archive_id))
+
+        return file_row
+
+
+def archive_commandline_parser():
+
+    parser = argparse.ArgumentParser(prog="python mzkit.py archive",
+                                     description="List and extract archived mzkit outputs")
+    parser.add_argument('--store',
+                        dest='store_path',
+                        help='archive store (default: $MZKIT_ARCHIVE_STORE or ~/.mzkit/archive)',
+                        default=ARCHIVE_STORE_PATH)
+
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    list_parser = subparsers.add_parser('list', help='list archives')
+    list_parser.add_argument('-n', '--limit', dest='limit', type=int, default=20, help='number of recent archives to list')
+
+    files_parser = subparsers.add_parser('files', help='list the files of an archive')
+    files_parser.add_argument('archive', help='archive id or name (the latest archive with that name)')
+
+    extract_parser = subparsers.add_parser('extract', help='extract files of an archive')
+    extract_parser.add_argument('archive', help='archive id or name (the latest archive with that name)')
+    extract_parser.add_argument('paths', nargs='*', help='files to extract, relative to the archived folder, or glob patterns (default: all)')
+    extract_parser.add_argument('-o', '--output', dest='output', default=".",
+                                help='folder to extract into, or - to write a single file to stdout')
+
+    return parser
+
+
+def archive_main(argv):
+    '''Entry point of `python mzkit.py archive`'''
+
+    args = archive_commandline_parser().parse_args(argv)
+
+    try:
+        reader = ArchiveReader(args.store_path)
+    except ValueError as e:
+        print(e)
+        return 1
+
+    try:
+        if args.command == "list":
+            print("ARCHIVE\tCREATED\t\t\tFILES\tGB\tNEW GB\tSTORED GB\tNAME")
+            for archive in reader.archives(args.limit):
+                print("%d\t%s\t%d\t%.2f\t%.2f\t%.2f\t\t%s" % (
+                    archive['archive_id'], archive['created_at'][:19], archive['n_files'], archive['total_bytes'] / 2 ** 30,
+                    archive['new_bytes'] / 2 ** 30, archive['stored_bytes'] / 2 ** 30, archive['name']))
+            return 0
+
+        archive = reader.find_archive(args.archive)
+        file_rows = reader.files(archive['archive_id'])
+
+        if args.command == "files":
+            for file_row in file_rows:
+                print("%d\t%s" % (file_row['size'], file_row['path']))
+            return 0
+
+        if args.paths:
+            file_rows = [x for x in file_rows if any(fnmatch.fnmatch(x['path'], pattern) for pattern in args.paths)]
+            if not file_rows:
+                print("No files of archive %d match %s" % (archive['archive_id'], " ".join(args.paths)))
+                return 1
+
+        if args.output == "-":
+            if len(file_rows) != 1:
+                print("Extracting to stdout requires exactly one file; %d match" % len(file_rows))
+                return 1
+            reader.extract_file(archive['archive_id'], file_rows[0]['path'], sys.stdout.buffer)
+            return 0
+
+        for file_row in file_rows:
+            out_path = os.path.join(args.output, file_row['path'])
+            if os.path.dirname(out_path) and not os.path.exists(os.path.dirname(out_path)):
+                os.makedirs(os.path.dirname(out_path))
+            with open(out_path, "wb") as out:
+                reader.extract_file(archive['archive_id'], file_row['path'], out)
+            os.chmod(out_path, file_row['mode'])
+            os.utime(out_path, (file_row['mtime'], file_row['mtime']))
+        print("# Extracted %d files of archive %d to %s" % (len(file_rows), archive['archive_id'], args.output))
+
+    except ValueError as e:
+        print(e)
+        return 1
+    finally:
+        reader.close()
+
+    return 0
@@ -1,12 +1,19 @@
+import hashlib
+import copy
 import json
 import valideer
 import os
 import re
 import argparse
 from collections import OrderedDict
+from collections.abc import Mapping
 from datetime import datetime
 import glob
 from utils import *
+from resources import ResourceCoordinator
+from executors import make_executor
+from pymodules import PyModuleContext, py_module_names
+from telemetry import RunTelemetry
 
 class MzkitConfig(object):
     '''
@@ -28,6 +35,8 @@ class MzkitConfig(object):
     -------
     get_pipe_dict(pipe: str)
         Generates pipe-specific config
+    compile()
+        Validate the config and freeze it as a RunPlan
     write_config(out_path: str)
         Write the config as a .json output
     update_config(updates: [str])
@@ -51,6 +60,20 @@ class MzkitConfig(object):
         None.
         '''
         
+        with open(config_path, 'r') as f:
+            self.config = json.load(f, object_pairs_hook=OrderedDict)
+
+        self.validate()
+
+        self.pipeline = self.config['pipeline']
+        self.globals = self.config['globals']
+        self.modules = self.config['modules']
+
+        return
+
+    def validate(self) -> None:
+        '''Check the config's organization and the syntax of its pipes and modules'''
+
         primary_config_schema = {
             "+pipeline": {},
             "+globals": {
@@ -85,24 +108,17 @@ class MzkitConfig(object):
         pipeline_config_validator = valideer.parse(pipeline_config_schema)
         module_config_validator = valideer.parse(module_config_schema)
         
-        with open(config_path, 'r') as f:
-            # check for primary fields
-            self.config = json.load(f, object_pairs_hook=OrderedDict)
-            # check high-level config organization
-            primary_config_validator.validate(self.config)
-            
-            # check pipeline syntax
-            for pipe in self.config['pipeline']:
-                pipeline_config_validator.validate(self.config['pipeline'][pipe])
-            
-            # check module syntax
-            for module in self.config['modules']:
-                module_config_validator.validate(self.config['modules'][module])
-            
-            self.pipeline = self.config['pipeline']
-            self.globals = self.config['globals']
-            self.modules = self.config['modules']
-            
+        # check high-level config organization
+        primary_config_validator.validate(self.config)
+
+        # check pipeline syntax
+        for pipe in self.config['pipeline']:
+            pipeline_config_validator.validate(self.config['pipeline'][pipe])
+
+        # check module syntax
+        for module in self.config['modules']:
+            module_config_validator.validate(self.config['modules'][module])
+
         return
     
     def print_pipeline_summary(self) -> None:
@@ -128,6 +144,9 @@ class MzkitConfig(object):
     def get_pipe_dict(self, pipe: str) -> dict:
         '''Generates pipeline step (pipe) specific config
         
+        Module parameters are copies with globals merged in; the config itself
+        is not modified.
+        
         Parameters
         ----------
         pipe : str
@@ -139,29 +158,70 @@ class MzkitConfig(object):
           pipeline steps and their associated parameters
         '''
         
-        # check that pipe is defined in pipeline
-        if pipe not in set(self.pipeline.keys()):
-            raise ValueError('invalid step: %s is not defined in pipeline' %pipe)
+        self.check_pipe(pipe)
         
         pipe_dict = OrderedDict()
         pipe_dict["pipe"] = self.pipeline[pipe]
         pipe_dict["modules"] = OrderedDict()
         
-        if len(pipe_dict["pipe"]["modules"]) < 1:
+        for module in pipe_dict["pipe"]["modules"]:
+            pipe_dict["modules"][module] = self.resolve_module(module)
+        
+        return pipe_dict
+    
+    def check_pipe(self, pipe: str) -> None:
+        '''Check that a pipe is defined, has modules which are all defined, and has consistent use flags'''
+        
+        # check that pipe is defined in pipeline
+        if pipe not in set(self.pipeline.keys()):
+            raise ValueError('invalid step: %s is not defined in pipeline' %pipe)
+        
+        pipe_config = self.pipeline[pipe]
+        
+        if len(pipe_config["modules"]) < 1:
            raise ValueError('invalid pipeline step: %s includes no modules' %pipe)
-               
-        # iterate through modules
         
-        for module in pipe_dict["pipe"]["modules"]:
+        for module in pipe_config["modules"]:
             if module not in set(self.modules.keys()):
-                raise ValueError(' %s is an invalid pipeline step: {module} is not defined in modules' %pipe)
+                raise ValueError('%s is an invalid pipeline step: %s is not defined in modules' %(pipe, module))
+            if pipe_config['use'] and self.modules[module]['language'] == "py" and module not in py_module_names():
+                raise ValueError('%s is an invalid pipeline step: no python module is registered as %s' %(pipe, module))
         
-            module_dict = self.modules[module]
-            module_dict['parameters'].update(self.globals)
-            
-            pipe_dict["modules"][module] = module_dict
+        if pipe_config['critical'] and not pipe_config['use']:
+            raise ValueError('the %s pipe is set to not be used, but this pipe is critical' %pipe)
         
-        return pipe_dict
+        if pipe_config['required'] and not pipe_config['use']:
+            raise ValueError('the %s pipe is set to not be used, but this pipe is required' %pipe)
+        
+        if pipe_config['critical'] and not pipe_config['required']:
+            raise ValueError('the %s pipe is set to as critical but not required; all critical steps are required' %pipe)
+        
+        return
+    
+    def resolve_module(self, module: str) -> dict:
+        '''Copy of a module's config with globals merged into (and taking precedence over) its parameters'''
+        
+        module_dict = OrderedDict(self.modules[module])
+        module_dict['parameters'] = OrderedDict(module_dict['parameters'])
+        module_dict['parameters'].update(self.globals)
+        
+        return module_dict
+    
+    def compile(self) -> 'RunPlan':
+        '''Validate every pipe and freeze the pipeline and resolved module parameters as a RunPlan
+        
+        Returns
+        -------
+        run_plan : RunPlan
+          immutable plan which later changes to the config do not affect
+        '''
+        
+        for pipe in self.pipeline.keys():
+            self.check_pipe(pipe)
+        
+        resolved_modules = OrderedDict((module, self.resolve_module(module)) for module in self.modules.keys())
+        
+        return RunPlan(self.config, resolved_modules)
         
     def write_config(self, out_path: str) -> None:
     
@@ -188,6 +248,8 @@ class MzkitConfig(object):
         
         '''Overwrite config with a set of value updates
         
+        Updates are applied in memory and the config is validated again.
+        
         Parameters
         ----------
         updates : [str]
@@ -198,61 +260,44 @@ class MzkitConfig(object):
             split_update = update.split('=', 1)
             print(split_update)
             
-            # overwrite config dict position
-            str_path = split_update[0].split('.')
+            if len(split_update) != 2:
+                raise ValueError('invalid update %s; updates are formatted as path.to.field=value' %update)
             
-            level_dicts = {}
-            level = 0
-            for level_str in str_path:
-                level += 1
-                # find parent dict
-                if level == 1:
-                    if not level_str in self.config.keys():
-                        raise ValueError('%s is not a top-level config field' %level_str)
-                    level_dict = self.config[level_str]
-                else:
-                    if not level_str in level_dicts[str_path[level-2]].keys():
-                        raise ValueError('%s is not defined in current config' %level_str)
-                    level_dict = level_dicts[str_path[level-2]][level_str]
-                
-                # check for level class
-                if level == len(str_path):
-                    if not type(level_dict) in [str, bool, float, int]:
-                        raise ValueError('the terminal level of update path was a %s, classes must be one of str, bool, float or int' %type(level_dict))
-                    else:
-                        # update an entry
-                        
-                        # convert the value to an appropriate class
-                        str_value = split_update[1]
-                        if str_value in ["TRUE", "True", "true"]:
-                            val = True
-                        elif str_value in ["FALSE", "False", "false"]:
-                            val = False
-                        elif re.match('^[0-9e.]+$', str_value):
-                            val = float(str_value)
-                        else:
-                            val = str_value
+            str_path = split_update[0].split('.')
             
-                        # save overwrittin value
-                        level_dict = val
-                        
-                elif not isinstance(level_dict, dict):
+            # find the dict holding the updated field
+            level_dict = self.config
+            for level, level_str in enumerate(str_path):
+                if not isinstance(level_dict, dict):
                     raise ValueError('a level of update path - %s, was not a dict; only dict values can be updated' %type(level_dict))
                 
-                level_dicts[level_str] = level_dict
-            
-            level = len(level_dicts)
-            while not level == 1:
-                level -= 1
-                str_level = str_path[level]
-                update = level_dicts[str_level]
-                level_dicts[str_path[level-1]][str_level] = update
+                if not level_str in level_dict.keys():
+                    if level == 0:
+                        raise ValueError('%s is not a top-level config field' %level_str)
+                    raise ValueError('%s is not defined in current config' %level_str)
+                
+                if level == len(str_path) - 1:
+                    break
+                level_dict = level_dict[level_str]
             
-            self.config[str_path[0]] = level_dicts[str_path[0]]
+            if not type(level_dict[level_str]) in [str, bool, float, int]:
+                raise ValueError('the terminal level of update path was a %s, classes must be one of str, bool, float or int' %type(level_dict[level_str]))
             
-        self.write_config("/tmp/tmp.json")
-        self = MzkitConfig("/tmp/tmp.json")
+            # convert the value to an appropriate class
+            str_value = split_update[1]
+            if str_value in ["TRUE", "True", "true"]:
+                val = True
+            elif str_value in ["FALSE", "False", "false"]:
+                val = False
+            elif re.match('^[0-9e.]+$', str_value):
+                val = float(str_value)
+            else:
+                val = str_value
             
+            level_dict[level_str] = val
+        
+        self.validate()
+        
         return
 
     def configure_peakdetector_searches(self, settings):
@@ -262,6 +307,9 @@ class MzkitConfig(object):
         Here, only the msp file needs to be adjusted, based on its actual location in the docker container,
         instead of the path that is described in the json file.
         """
+        if 'pipeline_standard_search' not in self.modules:
+            return
+
         if self.modules['pipeline_standard_search']['parameters']['matching_model'] != 'peakdetector_mzkitchen_search':
             return
 
@@ -279,6 +327,117 @@ class MzkitConfig(object):
         return
 
 
+class FrozenDict(Mapping):
+    '''
+    Read-only, hashable ordered mapping
+
+    Nested dicts are frozen as FrozenDicts and lists as tuples, so a frozen
+    value can be shared between threads and runs and used as a cache key.
+    '''
+
+    def __init__(self, items=()):
+
+        self._dict = OrderedDict((key, freeze(value)) for key, value in OrderedDict(items).items())
+        self._hash = None
+
+        return
+
+    def __getitem__(self, key):
+        return self._dict[key]
+
+    def __iter__(self):
+        return iter(self._dict)
+
+    def __len__(self):
+        return len(self._dict)
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(frozenset(self._dict.items()))
+        return self._hash
+
+    def __repr__(self):
+        return "FrozenDict(%s)" % dict(self._dict)
+
+
+def freeze(value):
+    '''Immutable copy of a JSON-like value'''
+
+    if isinstance(value, Mapping):
+        return value if isinstance(value, FrozenDict) else FrozenDict(value)
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(x) for x in value)
+
+    return value
+
+
+def fingerprint(value):
+    '''Stable hash of a JSON-like value, independent of key order'''
+
+    value_json = json.dumps(value, sort_keys=True, default=dict)
+
+    return hashlib.sha256(value_json.encode("utf-8")).hexdigest()[:16]
+
+
+class RunPlan(object):
+    '''
+    Immutable, validated plan of a run compiled from an MzkitConfig
+
+    A plan is safe to share between concurrent runs, caches and schedulers:
+    nothing that runs it can change its pipes or parameters.
+
+    Attributes
+    ----------
+    config : FrozenDict
+        the full configuration, after wild card updates
+    pipeline : FrozenDict
+        pipes (use, required, critical, modules) in the order they run
+    globals : FrozenDict
+        parameters which are available to all modules
+    modules : FrozenDict
+        module language and parameters, with globals merged into the parameters
+    fingerprint : str
+        hash of the full configuration
+    module_fingerprints : FrozenDict
+        hash of each module's language and resolved parameters
+
+    Methods
+    -------
+    get_pipe_dict(pipe: str)
+        Pipe-specific plan, in the format of MzkitConfig.get_pipe_dict()
+    '''
+
+    def __init__(self, config: dict, resolved_modules: dict) -> None:
+
+        self.config = freeze(config)
+        self.pipeline = self.config['pipeline']
+        self.globals = self.config['globals']
+        self.modules = freeze(resolved_modules)
+
+        self.fingerprint = fingerprint(self.config)
+        self.module_fingerprints = FrozenDict((module, fingerprint(module_dict)) for module, module_dict in self.modules.items())
+
+        return
+
+    def __eq__(self, other):
+        return isinstance(other, RunPlan) and self.fingerprint == other.fingerprint
+
+    def __hash__(self):
+        return hash(self.fingerprint)
+
+    def get_pipe_dict(self, pipe: str) -> dict:
+        '''Pipeline step (pipe) specific plan: the pipe's settings and the resolved config of its modules'''
+
+        if pipe not in self.pipeline:
+            raise ValueError('invalid step: %s is not defined in pipeline' %pipe)
+
+        pipe_dict = OrderedDict()
+        pipe_dict["pipe"] = self.pipeline[pipe]
+        pipe_dict["modules"] = OrderedDict((module, self.modules[module]) for module in self.pipeline[pipe]["modules"])
+
+        return pipe_dict
+
+
 class MzkitSettings(object):
     '''
     Bundle settings which will be used by the pipeline
@@ -319,7 +478,8 @@ class MzkitSettings(object):
             "+mzdeltas_bin_path": "string",
             "+RCMD": "string",
             "r_scripts_path": "string",
-            "r_mzkit_path": "string"
+            "r_mzkit_path": "string",
+            "library_path": "string"
             }
 
         # run-specific parameters (changes every run)
@@ -371,6 +531,8 @@ class MzkitSettings(object):
         mzdeltas_bin_path = os.path.abspath("./maven/src/maven_core/bin")
         r_scripts_path = os.path.abspath(".")
         r_mzkit_path = os.path.abspath("./mzkit.R")
+        # MSP libraries, matched to a run's methodId by configure_peakdetector_searches()
+        library_path = os.path.abspath(args.library_path) if args.library_path is not None else os.path.join(output_folder, "libraries")
 
         # setup code paths
         settings_program = {
@@ -380,7 +542,8 @@ class MzkitSettings(object):
             "mzdeltas_bin_path": mzdeltas_bin_path,
             "RCMD": "Rscript",
             "r_scripts_path": r_scripts_path,
-            "r_mzkit_path": r_mzkit_path
+            "r_mzkit_path": r_mzkit_path,
+            "library_path": library_path
             }
         
         settings_run = {
@@ -394,9 +557,92 @@ class MzkitSettings(object):
         self.project_files = project_files
         self.args = args
         self.mzrolldb_file = output_folder + "/peakdetector.mzrollDB"
+        self.alignment_file = None  # RT correction file, set when alignment is computed in python
         self.program_settings = settings_program_validator.validate(settings_program)
         self.run = settings_run_validator.validate(settings_run)
 
+        # CPU and memory budget shared by the modules of this run
+        self.resources = ResourceCoordinator()
+        print("# Resource budget: " + str(self.resources))
+        # default worker counts by (pipe, module), set by the run planner
+        self.planned_workers = {}
+        # memory and time limits of batch jobs by (pipe, module), set by the run planner from calibrated estimates
+        self.planned_jobs = {}
+
+        # live progress and resource metrics of this run
+        metrics_file = args.metrics_file if args.metrics_file is not None else os.path.join(output_folder, "mzkit_metrics.prom")
+        self.telemetry = RunTelemetry(metrics_file, args.metrics_port)
+
+        # mzrollDB connection and memory maps shared by the python modules of this run
+        self.py_context = PyModuleContext()
+
+        # local processes or batch scheduler jobs which run the bin and R modules
+        self.executor = make_executor(args, output_folder)
+        print("# Executor: " + str(self.executor))
+
         return
 
+    def derive(self, name: str, project_files: [str]) -> 'MzkitSettings':
+        '''
+        Settings of a sub-run over a subset of this run's spectra files
+        
+        The sub-run gets its own output folder, <output_folder>/<name>, with a
+        data folder of links to its files (peakdetector reads whole folders).
+        Links are named by file name, or by the file's path under the data folder
+        when files in different subfolders share a name.
+        Program settings, the resource budget and the executor are shared with this
+        run; the sub-run plans its own module concurrency.
+        
+        Parameters
+        ----------
+        name : str
+            name of the sub-run, used for its folders and metric labels.
+        project_files : [str]
+            spectra files of the sub-run.
+        
+        Returns
+        -------
+        MzkitSettings
+        '''
+        
+        # links are named by file name; files sharing a name in different
+        # subfolders are named by their path under the data folder instead
+        basenames = [os.path.basename(x) for x in project_files]
+        link_names = []
+        for project_file, basename in zip(project_files, basenames):
+            if basenames.count(basename) > 1:
+                relative_path = os.path.relpath(project_file, self.run['data_folder'])
+                link_names.append(relative_path.replace(os.sep, "_"))
+            else:
+                link_names.append(basename)
+        
+        duplicated = sorted(set(x for x in link_names if link_names.count(x) > 1))
+        if len(duplicated) > 0:
+            raise ValueError("Sub-run " + name + " has several spectra files named " + ", ".join(duplicated))
+        
+        output_folder = initialize_output_folder(os.path.join(self.run['output_folder'], name))
+        
+        data_folder = os.path.join(output_folder, "data")
+        if not os.path.exists(data_folder):
+            os.mkdir(data_folder)
+        for project_file, link_name in zip(project_files, link_names):
+            link_path = os.path.join(data_folder, link_name)
+            if os.path.lexists(link_path):
+                os.remove(link_path)
+            os.symlink(os.path.abspath(project_file), link_path)
+        
+        derived = copy.copy(self)
+        derived.project_files = [os.path.join(data_folder, x) for x in link_names]
+        derived.mzrolldb_file = output_folder + "/peakdetector.mzrollDB"
+        derived.alignment_file = None
+        derived.run = OrderedDict(self.run)
+        derived.run['data_folder'] = data_folder
+        derived.run['output_folder'] = output_folder
+        derived.telemetry = RunTelemetry(labels=OrderedDict([("group", name)]))
+        derived.planned_workers = {}
+        derived.planned_jobs = {}
+        derived.py_context = PyModuleContext()
+        
+        return derived
+
 
@@ -0,0 +1,421 @@
+import os
+import re
+
+import numpy as np
+
+from utils import PipelineFailedException, parse_ppm_tolerance
+
+# header names recognized for the m/z difference and label columns of an adduct (mzDeltas) table
+DELTA_COLUMN_NAMES = ["deltamz", "mzdelta", "mz_delta", "delta", "massdelta", "mass_delta"]
+LABEL_COLUMN_NAMES = ["name", "label", "adduct", "annotation", "adductname"]
+
+
+def run_coelution(module_dict, settings):
+    '''
+    Detect co-eluting peak groups separated by known m/z differences
+
+    Peak groups are binned by RT so that only groups within `rt_tol` minutes of
+    each other are compared. Within a bin all m/z differences are computed at once
+    and looked up in the sorted table of known differences from `adduct_file`
+    (e.g., mzdeltas.out) with a ppm tolerance. Matching pairs are scored by the
+    RT proximity of their peaks within each sample (see rt_proximity()) and the
+    correlation of their intensities across samples. The mzrollDB holds no EIC
+    traces, so peak shapes themselves are not compared.
+
+    Peaks are held sparsely, as arrays sorted by group and sample, so memory
+    grows with the number of peaks rather than groups x samples; pairs are
+    scored from the samples in which both groups were detected.
+
+    Edges passing `min_rt_proximity` and `min_correlation` are written to the
+    coelution_edges table of the mzrollDB.
+
+    Parameters
+    ----------
+    module_dict : dict
+      module configuration; parameters are merged with globals
+    settings : MzkitSettings
+      paths to the dataset, outputs and programming assets, and run settings
+    '''
+
+    parameters = module_dict['parameters']
+
+    adduct_file = os.path.join(settings.run['output_folder'], parameters.get('adduct_file', "mzdeltas.out"))
+    ppm = parse_ppm_tolerance(parameters['ppm'] if 'ppm' in parameters else parameters['MS1tol'])
+    rt_tol = float(parameters.get('rt_tol', 0.1))
+    min_rt_proximity = float(parameters.get('min_rt_proximity', 0.8))
+    min_correlation = float(parameters.get('min_correlation', 0.5))
+    quant_type = parameters.get('quant_type', "peakAreaTop")
+
+    if not os.path.isfile(settings.mzrolldb_file):
+        raise PipelineFailedException("mzrollDB not found: %s" % settings.mzrolldb_file)
+
+    if not os.path.isfile(adduct_file):
+        raise PipelineFailedException("adduct file not found: %s" % adduct_file)
+
+    deltas, delta_labels = read_mz_deltas(adduct_file)
+    print("# Read %d known m/z differences from %s" % (deltas.size, adduct_file))
+
+    conn = settings.py_context.mzrolldb(settings.mzrolldb_file)
+    groups = read_group_summaries(conn)
+    peaks = read_peak_arrays(conn, groups['groupId'], quant_type)
+    standardize_intensities(peaks)
+
+    edges = find_coelution_edges(groups, peaks, deltas, ppm, rt_tol, min_rt_proximity, min_correlation)
+    with settings.py_context.transaction(conn):
+        write_coelution_edges(conn, groups, edges, deltas, delta_labels)
+
+    print("# Found %d co-eluting peak group pairs among %d peak groups" % (edges['i'].size, groups['groupId'].size))
+
+    return
+
+
+def read_mz_deltas(adduct_file):
+    '''
+    Read known m/z differences from a delimited table
+
+    Returns the differences sorted ascending and their labels (empty strings when the
+    table has no label column).
+    '''
+
+    with open(adduct_file, "r") as f:
+        rows = [re.split(r'[\t,]|\s{2,}', x.strip()) for x in f if x.strip() and not x.startswith("#")]
+
+    if len(rows) == 0:
+        raise PipelineFailedException("adduct file %s is empty" % adduct_file)
+
+    def is_number(value):
+        try:
+            float(value)
+            return True
+        except ValueError:
+            return False
+
+    header = None
+    if not any(is_number(x) for x in rows[0]):
+        header = [x.strip().lower() for x in rows[0]]
+        rows = rows[1:]
+
+    delta_column = None
+    label_column = None
+    if header is not None:
+        delta_column = next((header.index(x) for x in DELTA_COLUMN_NAMES if x in header), None)
+        label_column = next((header.index(x) for x in LABEL_COLUMN_NAMES if x in header), None)
+
+    if delta_column is None:
+        # first numeric column
+        delta_column = next((i for i, x in enumerate(rows[0]) if is_number(x)), None)
+        if delta_column is None:
+            raise PipelineFailedException("no m/z difference column found in %s" % adduct_file)
+
+    deltas = []
+    labels = []
+    for row in rows:
+        if len(row) <= delta_column or not is_number(row[delta_column]):
+            continue
+        deltas.append(abs(float(row[delta_column])))
+        labels.append(row[label_column] if label_column is not None and len(row) > label_column else "")
+
+    order = np.argsort(deltas, kind='stable')
+
+    return np.asarray(deltas)[order], [labels[i] for i in order]
+
+
+def read_group_summaries(conn):
+    '''Per-group m/z, RT and peak width (mean over the group's peaks), sorted by RT'''
+
+    rows = conn.execute("SELECT groupId, AVG(peakMz), AVG(rt), AVG(rtmax - rtmin) FROM peaks "
+                        "WHERE groupId IN (SELECT groupId FROM peakgroups) "
+                        "GROUP BY groupId ORDER BY AVG(rt)").fetchall()
+
+    rows = np.array(rows, dtype=np.float64).reshape(-1, 4)
+
+    return {
+        'groupId': rows[:, 0].astype(np.int64),
+        'mz': rows[:, 1],
+        'rt': rows[:, 2],
+        'sigma': peak_sigma(rows[:, 3])
+        }
+
+
+def peak_sigma(width):
+    '''Gaussian sigma of peaks whose bounds span ~4 sigma; the floor avoids degenerate zero-width peaks'''
+
+    return np.maximum(np.nan_to_num(width) / 4, 1e-3)
+
+
+def read_peak_arrays(conn, group_ids, quant_type, chunk_rows=500000):
+    '''
+    Log intensities, apex RTs and Gaussian sigmas of the peaks of each group, in one pass over the peaks table
+
+    Peaks are stored sparsely, sorted by group (position in group_ids) and
+    sample: the peaks of group g are entries indptr[g] to indptr[g + 1], and
+    each entry's key is group position * n_samples + sample position. A group
+    should have at most one peak per sample; the most intense one is kept.
+    '''
+
+    sample_ids = np.array([x[0] for x in conn.execute("SELECT sampleId FROM samples ORDER BY sampleId")], dtype=np.int64)
+    group_order = np.argsort(group_ids)
+    sorted_group_ids = group_ids[group_order]
+    n_samples = max(sample_ids.size, 1)
+
+    keys = []
+    values = []
+
+    cursor = conn.execute('SELECT groupId, sampleId, "%s", rt, rtmax - rtmin FROM peaks WHERE %s > 0' % (quant_type, quant_type))
+    while True:
+        chunk = cursor.fetchmany(chunk_rows)
+        if not chunk:
+            break
+
+        chunk = np.array(chunk, dtype=np.float64)
+        rows = np.searchsorted(sorted_group_ids, chunk[:, 0].astype(np.int64))
+        cols = np.searchsorted(sample_ids, chunk[:, 1].astype(np.int64))
+        rows = np.minimum(rows, max(sorted_group_ids.size - 1, 0))
+        cols = np.minimum(cols, n_samples - 1)
+        valid = (sorted_group_ids[rows] == chunk[:, 0]) & (sample_ids[cols] == chunk[:, 1]) if sample_ids.size else \
+            np.zeros(len(chunk), dtype=bool)
+
+        keys.append(group_order[rows[valid]].astype(np.int64) * n_samples + cols[valid])
+        values.append(np.column_stack([np.log10(chunk[valid, 2]), chunk[valid, 3], peak_sigma(chunk[valid, 4])]).astype(np.float32))
+
+    keys = np.concatenate(keys) if keys else np.empty(0, dtype=np.int64)
+    values = np.concatenate(values) if values else np.empty((0, 3), dtype=np.float32)
+
+    # sort by key and, within a key, by decreasing intensity, then keep the first entry of each key
+    order = np.lexsort((-values[:, 0], keys))
+    keys = keys[order]
+    values = values[order]
+    first = np.ones(keys.size, dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    keys = keys[first]
+    values = values[first]
+
+    return {
+        'n_samples': n_samples,
+        'key': keys,
+        'indptr': np.searchsorted(keys, np.arange(group_ids.size + 1, dtype=np.int64) * n_samples),
+        'log_intensity': values[:, 0],
+        'rt': values[:, 1],
+        'sigma': values[:, 2]
+        }
+
+
+def standardize_intensities(peaks):
+    '''
+    Add what find_coelution_edges() needs for Pearson's r of log intensities across all samples to peaks
+
+    Undetected peaks are imputed with the group's minimum log intensity and
+    each group's log intensities are centered and scaled (z) over all samples.
+    An undetected sample then has the group's constant z, 'missing_z', so only
+    detected peaks are stored: their 'deviation', z minus missing_z, and each
+    group's sum of detected z, 'detected_z_sum'. Groups without variance get
+    z = 0.
+    '''
+
+    n_samples = peaks['n_samples']
+    indptr = peaks['indptr']
+    n_groups = indptr.size - 1
+    group_of_entry = np.repeat(np.arange(n_groups), np.diff(indptr))
+    log_intensity = peaks['log_intensity'].astype(np.float64)
+
+    n_detected = np.diff(indptr)
+    nonempty = n_detected > 0
+    group_min = np.zeros(n_groups)
+    group_min[nonempty] = np.minimum.reduceat(log_intensity, indptr[:-1][nonempty])
+
+    n_missing = n_samples - n_detected
+    mean = (np.bincount(group_of_entry, weights=log_intensity, minlength=n_groups) + n_missing * group_min) / n_samples
+    mean_square = (np.bincount(group_of_entry, weights=log_intensity ** 2, minlength=n_groups) + n_missing * group_min ** 2) / n_samples
+    sd = np.sqrt(np.maximum(mean_square - mean ** 2, 0))
+    scale = np.where(sd > 1e-12, 1 / np.where(sd > 1e-12, sd, 1), 0)
+
+    peaks['missing_z'] = (group_min - mean) * scale
+    peaks['deviation'] = (log_intensity - group_min[group_of_entry]) * scale[group_of_entry]
+    peaks['detected_z_sum'] = n_detected * peaks['missing_z'] + \
+        np.bincount(group_of_entry, weights=peaks['deviation'], minlength=n_groups)
+
+    return peaks
+
+
+def shared_peaks(i, j, peaks):
+    '''
+    Entries of the samples in which both groups of each pair (i, j) have a peak
+
+    Returns the pair index, the entry of group i and the entry of group j of every shared sample.
+    '''
+
+    indptr = peaks['indptr']
+    key = peaks['key']
+    n_samples = peaks['n_samples']
+
+    lengths = indptr[i + 1] - indptr[i]
+    pair = np.repeat(np.arange(i.size), lengths)
+    entry_i = np.repeat(indptr[i] - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+    wanted = j[pair] * n_samples + key[entry_i] % n_samples
+    entry_j = np.minimum(np.searchsorted(key, wanted), max(key.size - 1, 0))
+    shared = key[entry_j] == wanted if key.size else np.zeros(wanted.size, dtype=bool)
+
+    return pair[shared], entry_i[shared], entry_j[shared]
+
+
+def gaussian_overlap(rt_1, sigma_1, rt_2, sigma_2):
+    '''Cosine similarity of Gaussian profiles with the given apex RTs and sigmas (1 for identical peaks)'''
+
+    variance_sum = sigma_1 ** 2 + sigma_2 ** 2
+
+    return np.sqrt(2 * sigma_1 * sigma_2 / variance_sum) * np.exp(-(rt_1 - rt_2) ** 2 / (2 * variance_sum))
+
+
+def rt_proximity(i, j, groups, peaks, shared):
+    '''
+    RT proximity of pairs of groups: the Gaussian overlap of their peaks, averaged over samples
+
+    The overlap of two peaks is computed from their apex RTs and widths within
+    each sample where both groups were detected (shared, see shared_peaks()),
+    so that run-to-run RT shifts shared by both ions do not lower the score.
+    Pairs without a shared sample are scored from the groups' mean RTs and
+    widths. This measures co-apex proximity, not the correlation of peak shapes.
+    '''
+
+    pair, entry_i, entry_j = shared
+
+    per_sample = gaussian_overlap(peaks['rt'][entry_i].astype(np.float64), peaks['sigma'][entry_i].astype(np.float64),
+                                  peaks['rt'][entry_j].astype(np.float64), peaks['sigma'][entry_j].astype(np.float64))
+    n_shared = np.bincount(pair, minlength=i.size)
+    mean_overlap = np.bincount(pair, weights=per_sample, minlength=i.size) / np.maximum(n_shared, 1)
+
+    group_overlap = gaussian_overlap(groups['rt'][i], groups['sigma'][i], groups['rt'][j], groups['sigma'][j])
+
+    return np.where(n_shared > 0, mean_overlap, group_overlap)
+
+
+def intensity_correlation(i, j, peaks, shared):
+    '''
+    Pearson's r of pairs of groups' log intensities across all samples (see standardize_intensities())
+
+    With d = z - missing_z of detected peaks, the sum of z_i * z_j over all
+    samples is the sum of d_i * d_j over shared samples, plus the terms of the
+    groups' constant z in the samples where they were not detected.
+    '''
+
+    pair, entry_i, entry_j = shared
+    n_samples = peaks['n_samples']
+    missing_z = peaks['missing_z']
+    detected_z_sum = peaks['detected_z_sum']
+    n_detected = np.diff(peaks['indptr'])
+
+    shared_sum = np.bincount(pair, weights=peaks['deviation'][entry_i] * peaks['deviation'][entry_j], minlength=i.size)
+    z_sum = shared_sum + missing_z[j] * detected_z_sum[i] + missing_z[i] * detected_z_sum[j] + \
+        missing_z[i] * missing_z[j] * (n_samples - n_detected[i] - n_detected[j])
+
+    return z_sum / n_samples
+
+
+def match_deltas(mz_differences, reference_mz, deltas, ppm):
+    '''
+    Index of the known delta matching each m/z difference, or -1
+
+    The tolerance is ppm of the larger m/z of each pair.
+    '''
+
+    tolerance = reference_mz * ppm * 1e-6
+
+    candidates = np.searchsorted(deltas, mz_differences - tolerance, side='left')
+    in_range = candidates < deltas.size
+    candidates = np.minimum(candidates, deltas.size - 1)
+
+    matched = in_range & (np.abs(deltas[candidates] - mz_differences) <= tolerance)
+
+    # the nearest delta may be the next one when several fall within the tolerance
+    following = np.minimum(candidates + 1, deltas.size - 1)
+    closer = matched & (np.abs(deltas[following] - mz_differences) < np.abs(deltas[candidates] - mz_differences))
+    candidates = np.where(closer, following, candidates)
+
+    return np.where(matched, candidates, -1)
+
+
+def find_coelution_edges(groups, peaks, deltas, ppm, rt_tol, min_rt_proximity, min_correlation):
+    '''
+    Find pairs of groups (indices into groups) co-eluting at a known m/z difference
+
+    Groups are sorted by RT, so each RT bin is a contiguous slice and only
+    neighboring bins need to be compared.
+    '''
+
+    rt = groups['rt']
+    mz = groups['mz']
+
+    bins = np.floor((rt - rt.min()) / rt_tol).astype(np.int64) if rt.size else np.empty(0, dtype=np.int64)
+    bin_starts = np.searchsorted(bins, np.arange(bins.max() + 2)) if rt.size else np.zeros(1, dtype=np.int64)
+
+    edges = {x: [] for x in ['i', 'j', 'delta', 'ppm', 'rt_proximity', 'correlation']}
+
+    for b in range(bin_starts.size - 1):
+        members = np.arange(bin_starts[b], bin_starts[b + 1])
+        if members.size == 0:
+            continue
+
+        # compare against this bin and the next one
+        neighbors = np.arange(bin_starts[b], bin_starts[min(b + 2, bin_starts.size - 1)])
+
+        i, j = np.meshgrid(members, neighbors, indexing='ij')
+        keep = (j > i) & (np.abs(rt[j] - rt[i]) <= rt_tol)
+        i = i[keep]
+        j = j[keep]
+        if i.size == 0:
+            continue
+
+        mz_differences = np.abs(mz[j] - mz[i])
+        delta_index = match_deltas(mz_differences, np.maximum(mz[i], mz[j]), deltas, ppm)
+        matched = delta_index >= 0
+        i, j, delta_index = i[matched], j[matched], delta_index[matched]
+        if i.size == 0:
+            continue
+
+        shared = shared_peaks(i, j, peaks)
+        proximity = rt_proximity(i, j, groups, peaks, shared)
+        correlation = intensity_correlation(i, j, peaks, shared)
+
+        passed = (proximity >= min_rt_proximity) & (correlation >= min_correlation)
+
+        edges['i'].append(i[passed])
+        edges['j'].append(j[passed])
+        edges['delta'].append(delta_index[passed])
+        edges['ppm'].append(((mz_differences[matched] - deltas[delta_index]) / np.maximum(mz[i], mz[j]) * 1e6)[passed])
+        edges['rt_proximity'].append(proximity[passed])
+        edges['correlation'].append(correlation[passed])
+
+    return {x: np.concatenate(y) if y else np.empty(0) for x, y in edges.items()}
+
+
+def write_coelution_edges(conn, groups, edges, deltas, delta_labels):
+    '''Replace the coelution_edges table of the mzrollDB with the detected edges'''
+
+    group_ids = groups['groupId']
+    i = edges['i'].astype(np.int64)
+    j = edges['j'].astype(np.int64)
+    delta_index = edges['delta'].astype(np.int64)
+
+    # store each edge from the lighter to the heavier ion
+    lighter = np.where(groups['mz'][i] <= groups['mz'][j], i, j)
+    heavier = np.where(groups['mz'][i] <= groups['mz'][j], j, i)
+
+    rows = zip(group_ids[lighter].tolist(),
+               group_ids[heavier].tolist(),
+               deltas[delta_index].tolist(),
+               [delta_labels[x] for x in delta_index],
+               edges['ppm'].tolist(),
+               (groups['rt'][heavier] - groups['rt'][lighter]).tolist(),
+               edges['rt_proximity'].tolist(),
+               edges['correlation'].tolist())
+
+    conn.execute("DROP TABLE IF EXISTS coelution_edges")
+    conn.execute("CREATE TABLE coelution_edges ("
+                 "groupId1 INTEGER, groupId2 INTEGER, mzDelta REAL, deltaLabel TEXT, ppmError REAL, "
+                 "rtDiff REAL, rtProximity REAL, intensityCorrelation REAL)")
+    conn.executemany("INSERT INTO coelution_edges VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    conn.execute("CREATE INDEX idx_coelution_edges_groupId1 ON coelution_edges (groupId1)")
+    conn.execute("CREATE INDEX idx_coelution_edges_groupId2 ON coelution_edges (groupId2)")
+
+    return
@@ -0,0 +1,464 @@
+#! /usr/bin/env python3
+
+import json
+import math
+import os
+import shlex
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+from resources import rusage_max_rss_bytes
+
+# outcome of a module command; usage is measured where the command ran
+CommandResult = namedtuple('CommandResult', ['returncode', 'out', 'err', 'max_rss_bytes', 'cpu_seconds'])
+
+EXECUTOR_NAMES = ["local", "batch", "fake-batch"]
+
+DEFAULT_POLL_SECONDS = 5.0
+# time a job may be missing from the scheduler before its result file appears (shared filesystems lag)
+LOST_JOB_GRACE_SECONDS = 60.0
+# memory requested by jobs of modules without a memory limit (e.g., when the host's memory is unknown)
+DEFAULT_BATCH_MEMORY_MB = 4096
+# time limit requested by jobs of modules whose runtime the run plan could not estimate
+DEFAULT_BATCH_MINUTES = 1440
+
+# environment variables passed from the driver to batch jobs; everything else comes from the scheduler
+_JOB_ENVIRONMENT_PREFIXES = ("OMP_", "OPENBLAS_", "MKL_", "MC_CORES", "MZKIT_")
+
+
+def communicate_with_usage(p, on_line=None):
+    '''
+    Popen.communicate() which also returns the finished process's resource usage
+
+    Output is read line by line as it is produced, and each decoded line of
+    stdout and stderr is passed to on_line(stream, line) if given. The process
+    is reaped with os.wait4 so that its peak RSS and CPU time (including the
+    processes it waited for) can be recorded.
+    '''
+
+    outputs = {}
+
+    def read_stream(name, stream):
+        lines = []
+        for line in iter(stream.readline, b""):
+            lines.append(line)
+            if on_line is not None:
+                on_line(name, line.decode("utf-8", errors="replace").rstrip("\r\n"))
+        outputs[name] = b"".join(lines)
+        stream.close()
+
+    # readers are named after the calling thread so that their output can be routed with it
+    readers = [threading.Thread(target=read_stream, args=(name, stream), name=threading.current_thread().name + ":" + name)
+               for name, stream in [("out", p.stdout), ("err", p.stderr)]]
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+
+    _, status, rusage = os.wait4(p.pid, 0)
+    p.returncode = os.waitstatus_to_exitcode(status)
+
+    return outputs["out"], outputs["err"], rusage
+
+
+class LocalExecutor(object):
+    '''Runs module commands as child processes of the driver'''
+
+    name = "local"
+
+    def __str__(self):
+        return "local processes"
+
+    def run(self, cmd_str, env, job_name, allocation, on_start=None, on_line=None):
+        '''
+        Run a shell command and wait for it to finish
+
+        Parameters
+        ----------
+        cmd_str : str
+          shell command
+        env : dict
+          environment of the command
+        job_name : str
+          name of the command's module, for logs and job names
+        allocation : Allocation
+          resources the command may use
+        on_start : callable
+          called with the process id once the command started
+        on_line : callable
+          called with ("out" or "err", line) for every line of output
+
+        Returns
+        -------
+        result : CommandResult
+        '''
+
+        p = subprocess.Popen(cmd_str,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE,
+                             shell=True,
+                             close_fds=True,
+                             env=env)
+
+        if on_start is not None:
+            on_start(p.pid)
+
+        out, err, rusage = communicate_with_usage(p, on_line)
+
+        return CommandResult(p.returncode, out, err, rusage_max_rss_bytes(rusage), rusage.ru_utime + rusage.ru_stime)
+
+
+class BatchExecutor(object):
+    '''
+    Runs module commands as batch scheduler jobs, exchanging inputs and results through a shared filesystem
+
+    Each command gets a job folder under jobs_folder holding the command, the
+    allocation's environment variables and a job script. The script runs
+    `executors.py run-job <job folder>` on the compute node, which writes the
+    command's output to out.log and err.log and, when it finishes,
+    result.json with its exit code and resource usage. The driver submits the
+    script with submit_command, follows the logs and waits for result.json.
+    With a status_command, a job which leaves the scheduler without a result
+    fails the module; cancel_command is used if the driver is interrupted.
+
+    Commands are format strings with the fields {script}, {job_folder},
+    {name}, {n_cpus}, {memory_mb}, {minutes} and {job_id}. memory_mb and
+    minutes come from the run plan's calibrated estimates when it has them
+    (Allocation.job_request); otherwise memory_mb is the module's memory share,
+    or default_memory_mb for modules without a memory limit, and minutes is
+    default_minutes. E.g. for Slurm:
+      submit: sbatch --parsable -J {name} -c {n_cpus} --mem={memory_mb}M -t {minutes} -o {job_folder}/scheduler.log {script}
+      status: squeue -h -j {job_id}
+      cancel: scancel {job_id}
+    The job id is the first field (up to ";") of the last line the submit command prints.
+    Job folders of successful jobs are removed unless keep_jobs is set; those
+    of failed jobs are kept for debugging.
+    '''
+
+    name = "batch"
+
+    def __init__(self, jobs_folder, submit_command, status_command=None, cancel_command=None,
+                 poll_seconds=DEFAULT_POLL_SECONDS, python=sys.executable, keep_jobs=False,
+                 default_memory_mb=DEFAULT_BATCH_MEMORY_MB, default_minutes=DEFAULT_BATCH_MINUTES):
+
+        self.jobs_folder = os.path.abspath(jobs_folder)
+        self.submit_command = submit_command
+        self.status_command = status_command
+        self.cancel_command = cancel_command
+        self.poll_seconds = poll_seconds
+        self.python = python
+        self.keep_jobs = keep_jobs
+        self.default_memory_mb = default_memory_mb
+        self.default_minutes = default_minutes
+
+        return
+
+    def __str__(self):
+        return "batch jobs in " + self.jobs_folder
+
+    def _format(self, command, fields):
+        return command.format(**{key: shlex.quote(str(value)) for key, value in fields.items()})
+
+    def _write_job(self, cmd_str, env, job_name):
+
+        if not os.path.exists(self.jobs_folder):
+            os.makedirs(self.jobs_folder)
+
+        job_folder = tempfile.mkdtemp(prefix=job_name + "-", dir=self.jobs_folder)
+
+        with open(os.path.join(job_folder, "command.sh"), "w") as f:
+            f.write(cmd_str + "\n")
+
+        job_env = {key: value for key, value in env.items() if key.startswith(_JOB_ENVIRONMENT_PREFIXES)}
+        with open(os.path.join(job_folder, "env.json"), "w") as f:
+            json.dump(job_env, f, indent=2)
+
+        script = os.path.join(job_folder, "job.sh")
+        with open(script, "w") as f:
+            f.write("#!/bin/sh\n")
+            f.write("cd %s\n" % shlex.quote(os.getcwd()))
+            f.write("exec %s %s run-job %s\n" % (shlex.quote(self.python), shlex.quote(os.path.abspath(__file__)), shlex.quote(job_folder)))
+        os.chmod(script, 0o755)
+
+        return job_folder, script
+
+    def _submit(self, fields):
+
+        p = subprocess.run(self._format(self.submit_command, fields), shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        lines = [x.strip() for x in p.stdout.decode("utf-8", errors="replace").splitlines() if x.strip()]
+        if p.returncode != 0 or not lines:
+            raise RuntimeError("job submission failed (%d): %s" % (p.returncode, p.stderr.decode("utf-8", errors="replace").strip()))
+
+        return lines[-1].split(";")[0]
+
+    def _is_queued(self, fields):
+        '''Whether the scheduler still lists a job; assumed so without a status command'''
+
+        if self.status_command is None:
+            return True
+
+        p = subprocess.run(self._format(self.status_command, fields), shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        return p.returncode == 0 and p.stdout.strip() != b""
+
+    def _cancel(self, fields):
+
+        if self.cancel_command is not None:
+            subprocess.run(self._format(self.cancel_command, fields), shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def run(self, cmd_str, env, job_name, allocation, on_start=None, on_line=None):
+        '''Submit a shell command as a job and wait for it to finish; see LocalExecutor.run()'''
+
+        job_folder, script = self._write_job(cmd_str, env, job_name)
+        fields = {"script": script,
+                  "job_folder": job_folder,
+                  "name": "mzkit-" + job_name,
+                  "n_cpus": allocation.n_workers,
+                  "memory_mb": int(allocation.memory_bytes / 2 ** 20) if allocation.memory_bytes is not None else self.default_memory_mb,
+                  "minutes": self.default_minutes}
+
+        if allocation.job_request is not None:
+            fields["memory_mb"] = max(int(allocation.job_request.memory_bytes / 2 ** 20), 1)
+            fields["minutes"] = max(int(math.ceil(allocation.job_request.seconds / 60)), 1)
+
+        fields["job_id"] = self._submit(fields)
+        print("    #### Submitted " + job_name + " as job " + fields["job_id"] + " (" + job_folder + ")", flush=True)
+
+        result_path = os.path.join(job_folder, "result.json")
+        logs = [LogFollower(os.path.join(job_folder, name + ".log"), name, on_line) for name in ["out", "err"]]
+        missing_since = None
+
+        try:
+            while not os.path.isfile(result_path):
+                time.sleep(self.poll_seconds)
+                for log in logs:
+                    log.poll()
+
+                if self._is_queued(fields):
+                    missing_since = None
+                elif missing_since is None:
+                    missing_since = time.time()
+                elif time.time() - missing_since > LOST_JOB_GRACE_SECONDS and not os.path.isfile(result_path):
+                    raise RuntimeError("job %s of %s left the scheduler without a result; see %s" % (fields["job_id"], job_name, job_folder))
+        except BaseException:
+            self._cancel(fields)
+            raise
+
+        with open(result_path, "r") as f:
+            result = json.load(f)
+        for log in logs:
+            log.poll(final=True)
+
+        out, err = [log.read() for log in logs]
+        if result['returncode'] != 0:
+            print("    #### Job " + fields["job_id"] + " of " + job_name + " failed; its folder is kept: " + job_folder, flush=True)
+        elif not self.keep_jobs:
+            for name in os.listdir(job_folder):
+                os.remove(os.path.join(job_folder, name))
+            os.rmdir(job_folder)
+
+        return CommandResult(result['returncode'], out, err, result['max_rss_bytes'], result['cpu_seconds'])
+
+
+class LogFollower(object):
+    '''Passes the lines appended to a log file to on_line(stream, line)'''
+
+    def __init__(self, path, stream, on_line):
+
+        self.path = path
+        self.stream = stream
+        self.on_line = on_line
+        self.offset = 0
+        self.partial = b""
+
+        return
+
+    def poll(self, final=False):
+
+        if not os.path.isfile(self.path):
+            return
+
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            data = f.read()
+        self.offset += len(data)
+
+        lines = (self.partial + data).split(b"\n")
+        self.partial = b"" if final else lines.pop()
+        if self.on_line is not None:
+            for line in lines:
+                if line or not final:
+                    self.on_line(self.stream, line.decode("utf-8", errors="replace").rstrip("\r"))
+
+    def read(self):
+
+        if not os.path.isfile(self.path):
+            return b""
+
+        with open(self.path, "rb") as f:
+            return f.read()
+
+
+def run_job(job_folder):
+    '''
+    Run a batch job's command on the compute node (`executors.py run-job <job folder>`)
+
+    The result is written to result.json atomically, so that the driver never reads a partial file.
+    '''
+
+    with open(os.path.join(job_folder, "command.sh"), "r") as f:
+        cmd_str = f.read()
+    with open(os.path.join(job_folder, "env.json"), "r") as f:
+        env = dict(os.environ, **json.load(f))
+
+    with open(os.path.join(job_folder, "out.log"), "wb") as out, open(os.path.join(job_folder, "err.log"), "wb") as err:
+        p = subprocess.Popen(cmd_str, shell=True, stdout=out, stderr=err, close_fds=True, env=env)
+        _, status, rusage = os.wait4(p.pid, 0)
+
+    result = {"returncode": os.waitstatus_to_exitcode(status),
+              "max_rss_bytes": rusage_max_rss_bytes(rusage),
+              "cpu_seconds": rusage.ru_utime + rusage.ru_stime,
+              "host": os.uname()[1]}
+
+    tmp_path = os.path.join(job_folder, "result.json.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(result, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(job_folder, "result.json"))
+
+    return result["returncode"]
+
+
+# a local stand-in for a batch scheduler: jobs are detached processes and job ids are their process ids
+FAKE_SCHEDULER_COMMANDS = {
+    "submit": "%s %s fake-submit {script}" % (shlex.quote(sys.executable), shlex.quote(os.path.abspath(__file__))),
+    "status": "%s %s fake-status {job_id}" % (shlex.quote(sys.executable), shlex.quote(os.path.abspath(__file__))),
+    "cancel": "%s %s fake-cancel {job_id}" % (shlex.quote(sys.executable), shlex.quote(os.path.abspath(__file__)))
+    }
+
+
+def fake_submit(script):
+
+    p = subprocess.Popen(["/bin/sh", script], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL, close_fds=True, start_new_session=True)
+    print(p.pid)
+
+    return 0
+
+
+def fake_status(job_id):
+    '''Prints RUNNING and exits 0 while the job's process is alive (and not a zombie)'''
+
+    try:
+        with open("/proc/%d/stat" % int(job_id), "r") as f:
+            state = f.read().rsplit(")", 1)[1].split()[0]
+    except OSError:
+        return 1
+
+    if state == "Z":
+        return 1
+
+    print("RUNNING")
+
+    return 0
+
+
+def fake_cancel(job_id):
+
+    try:
+        os.killpg(int(job_id), signal.SIGTERM)
+    except OSError:
+        pass
+
+    return 0
+
+
+def self_test(jobs_folder):
+    '''
+    Run jobs through the fake scheduler and check what the driver gets back (`executors.py self-test <jobs folder>`)
+
+    Checks the submit, poll and collect cycle of BatchExecutor: the exit
+    status, streamed and collected output, the job environment and the
+    {minutes} field of a job request, the removal of a successful job's
+    folder, and that a failed job's folder is kept with its logs and result.
+    Returns 0 if every check passes.
+    '''
+
+    # imported here: the planner and resources are not needed to run jobs on a compute node
+    from planner import JobRequest
+    from resources import Allocation
+
+    failures = []
+
+    def check(condition, message):
+        print(("ok    " if condition else "FAIL  ") + message)
+        if not condition:
+            failures.append(message)
+
+    submit_log = os.path.join(os.path.abspath(jobs_folder), "submitted.log")
+    executor = BatchExecutor(jobs_folder, "echo {name} {n_cpus} {memory_mb} {minutes} >> %s && %s" % (shlex.quote(submit_log), FAKE_SCHEDULER_COMMANDS["submit"]),
+                             FAKE_SCHEDULER_COMMANDS["status"], FAKE_SCHEDULER_COMMANDS["cancel"], poll_seconds=0.2)
+
+    allocation = Allocation("self_test", 2, 2 ** 30, job_request=JobRequest(2 ** 29, 90))
+    lines = []
+
+    result = executor.run("echo line 1; echo line 2; echo $MZKIT_SELF_TEST >&2", {"MZKIT_SELF_TEST": "passed", "UNRELATED": "x"},
+                          "ok_job", allocation, on_line=lambda stream, line: lines.append((stream, line)))
+    check(result.returncode == 0, "successful job exits 0")
+    check(result.out == b"line 1\nline 2\n", "stdout is collected")
+    check(result.err == b"passed\n", "MZKIT_ environment variables reach the job")
+    check(("out", "line 2") in lines and ("err", "passed") in lines, "output lines are streamed while polling")
+    check(result.cpu_seconds >= 0 and result.max_rss_bytes > 0, "usage is measured where the job ran")
+    with open(submit_log, "r") as f:
+        check(f.read().split() == ["mzkit-ok_job", "2", "512", "2"], "the job request sets memory_mb and minutes")
+    check(not any(x.startswith("ok_job-") for x in os.listdir(jobs_folder)), "a successful job's folder is removed")
+
+    result = executor.run("echo failing >&2; exit 3", {}, "failed_job", Allocation("self_test", 1, None))
+    check(result.returncode == 3, "failed job returns its exit status")
+    check(result.err == b"failing\n", "stderr of a failed job is collected")
+    job_folders = [os.path.join(jobs_folder, x) for x in os.listdir(jobs_folder) if x.startswith("failed_job-")]
+    check(len(job_folders) == 1 and all(os.path.isfile(os.path.join(job_folders[0], x)) for x in ["err.log", "result.json", "command.sh"]),
+          "a failed job's folder is kept with its logs and result")
+
+    print("%d check(s) failed" % len(failures) if failures else "all checks passed")
+
+    return 1 if failures else 0
+
+
+def make_executor(args, output_folder):
+    '''The executor selected on the command line'''
+
+    if args.executor == "local":
+        return LocalExecutor()
+
+    # job folders sit next to the output folder, so the kept folders of failed jobs do not end up among the outputs
+    jobs_folder = args.batch_jobs_folder if args.batch_jobs_folder is not None else os.path.normpath(output_folder) + "_jobs"
+
+    if args.executor == "fake-batch":
+        return BatchExecutor(jobs_folder, FAKE_SCHEDULER_COMMANDS["submit"], FAKE_SCHEDULER_COMMANDS["status"],
+                             FAKE_SCHEDULER_COMMANDS["cancel"], poll_seconds=min(args.batch_poll_seconds, 1.0),
+                             default_memory_mb=args.batch_default_memory_mb, default_minutes=args.batch_default_minutes)
+
+    if args.batch_submit is None:
+        raise ValueError("--executor batch requires --batch-submit")
+
+    return BatchExecutor(jobs_folder, args.batch_submit, args.batch_status, args.batch_cancel, poll_seconds=args.batch_poll_seconds,
+                         default_memory_mb=args.batch_default_memory_mb, default_minutes=args.batch_default_minutes)
+
+
+if __name__ == '__main__':
+
+    commands = {"run-job": run_job, "fake-submit": fake_submit, "fake-status": fake_status, "fake-cancel": fake_cancel,
+                "self-test": self_test}
+
+    if len(sys.argv) != 3 or sys.argv[1] not in commands:
+        print("usage: executors.py {%s} ARG" % ",".join(commands))
+        exit(2)
+
+    exit(commands[sys.argv[1]](sys.argv[2]))
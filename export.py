@@ -0,0 +1,302 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from utils import PipelineFailedException
+
+# above this fraction of detected sample x group cells a dense float32 matrix is smaller than
+# a COO matrix (int32 row, int32 column and float32 value per detected cell)
+DENSE_MATRIX_MIN_DENSITY = 1 / 3
+
+# files a partitioned export keeps open at once; arrow closes the least recently used ones beyond this
+MAX_OPEN_FILES = 512
+
+
+def run_columnar_export(module_dict, settings):
+    '''
+    Export mzrollDB tables to columnar files
+
+    Tables are streamed out of the mzrollDB in chunks of `chunk_rows` rows and
+    written as a Parquet (or Arrow IPC) dataset per table; peaks are partitioned
+    by `partition_peaks_by`. A group x sample intensity matrix is written as .npy
+    arrays so that it can be memory-mapped with numpy.load(mmap_mode='r'). Memory
+    use is bounded by the chunk size and the number of groups and samples, not by
+    the number of peaks.
+
+    Parameters
+    ----------
+    module_dict : dict
+      module configuration; parameters are merged with globals
+    settings : MzkitSettings
+      paths to the dataset, outputs and programming assets, and run settings
+    '''
+
+    parameters = module_dict['parameters']
+
+    export_folder = os.path.join(settings.run['output_folder'], parameters.get('export_folder', "columnar"))
+    chunk_rows = int(parameters.get('chunk_rows', 500000))
+    export_format = parameters.get('export_format', "parquet")
+    quant_type = parameters.get('quant_type', "peakAreaTop")
+    matrix_format = parameters.get('matrix_format', "auto")
+    partition_peaks_by = parameters.get('partition_peaks_by', "sampleId")
+
+    if export_format not in ["parquet", "arrow"]:
+        raise ValueError('invalid export_format: %s; must be one of parquet or arrow' % export_format)
+
+    if matrix_format not in ["auto", "dense", "sparse"]:
+        raise ValueError('invalid matrix_format: %s; must be one of auto, dense or sparse' % matrix_format)
+
+    if not os.path.isfile(settings.mzrolldb_file):
+        raise PipelineFailedException("mzrollDB not found: %s" % settings.mzrolldb_file)
+
+    if os.path.exists(export_folder):
+        shutil.rmtree(export_folder)
+    os.makedirs(export_folder)
+
+    # arrow consumes the record batch generators from its own writer thread; the shared connection allows that
+    conn = settings.py_context.mzrolldb(settings.mzrolldb_file)
+    for table in ["samples", "peakgroups", "peaks", "compounds"]:
+        if not table_exists(conn, table):
+            print("# " + table + " table not found in mzrollDB, skipping")
+            continue
+
+        partitioning = [partition_peaks_by] if table == "peaks" and partition_peaks_by else []
+        n_rows = export_table(conn, table, os.path.join(export_folder, table), export_format, chunk_rows, partitioning)
+        print("# Exported " + str(n_rows) + " rows of " + table)
+
+    matrix_summary = export_intensity_matrix(conn, os.path.join(export_folder, "intensity_matrix"), quant_type,
+                                             matrix_format, chunk_rows, settings.py_context)
+    print("# Exported %s %d x %d intensity matrix" % (matrix_summary['format'], matrix_summary['shape'][0], matrix_summary['shape'][1]))
+
+    return
+
+
+def table_exists(conn, table):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() is not None
+
+
+def arrow_type(declared_type):
+    '''Map a SQLite declared column type to an arrow type using SQLite's affinity rules'''
+
+    declared_type = (declared_type or "").upper()
+
+    if "INT" in declared_type:
+        return pa.int64()
+    elif any(x in declared_type for x in ["CHAR", "CLOB", "TEXT"]) or declared_type == "":
+        return pa.string()
+    elif "BLOB" in declared_type:
+        return pa.binary()
+    else:
+        return pa.float64()
+
+
+def table_schema(conn, table):
+
+    columns = conn.execute("PRAGMA table_info(%s)" % table).fetchall()
+
+    return pa.schema([(column[1], arrow_type(column[2])) for column in columns])
+
+
+def _coerce(value, arrow_type):
+    try:
+        if value is None:
+            return None
+        elif pa.types.is_integer(arrow_type):
+            return int(value)
+        elif pa.types.is_floating(arrow_type):
+            return float(value)
+        elif pa.types.is_binary(arrow_type):
+            return value if isinstance(value, bytes) else str(value).encode("utf-8")
+        else:
+            return str(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_arrow_array(values, arrow_type):
+    try:
+        return pa.array(values, type=arrow_type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # SQLite does not enforce declared types; coerce stray values and null unconvertible ones
+        return pa.array([_coerce(x, arrow_type) for x in values], type=arrow_type)
+
+
+def iter_record_batches(conn, table, schema, chunk_rows):
+    '''Stream a table as arrow record batches of at most chunk_rows rows'''
+
+    cursor = conn.execute("SELECT %s FROM %s" % (", ".join('"%s"' % x for x in schema.names), table))
+
+    while True:
+        rows = cursor.fetchmany(chunk_rows)
+        if not rows:
+            break
+
+        columns = list(zip(*rows))
+        arrays = [_to_arrow_array(list(columns[i]), field.type) for i, field in enumerate(schema)]
+        yield pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def export_table(conn, table, out_dir, export_format, chunk_rows, partitioning):
+
+    schema = table_schema(conn, table)
+    partitioning = [x for x in partitioning if x in schema.names]
+
+    # arrow refuses to write more than max_partitions partitions (1024 by default), so allow one per
+    # partition value, e.g. one per sample of a large study
+    n_partitions = 1
+    if partitioning:
+        n_partitions = conn.execute("SELECT COUNT(*) FROM (SELECT DISTINCT %s FROM %s)" %
+                                    (", ".join('"%s"' % x for x in partitioning), table)).fetchone()[0]
+
+    n_rows = 0
+
+    def counted_batches():
+        nonlocal n_rows
+        for batch in iter_record_batches(conn, table, schema, chunk_rows):
+            n_rows += batch.num_rows
+            yield batch
+
+    ds.write_dataset(counted_batches(),
+                     out_dir,
+                     schema=schema,
+                     format="parquet" if export_format == "parquet" else "ipc",
+                     partitioning=partitioning if partitioning else None,
+                     partitioning_flavor="hive" if partitioning else None,
+                     max_rows_per_file=max(chunk_rows, 1),
+                     max_rows_per_group=max(chunk_rows, 1),
+                     max_partitions=max(n_partitions, 1024),
+                     max_open_files=MAX_OPEN_FILES,
+                     existing_data_behavior="overwrite_or_ignore")
+
+    return n_rows
+
+
+def export_intensity_matrix(conn, out_dir, quant_type, matrix_format, chunk_rows, py_context):
+    '''
+    Write a group x sample matrix of peak intensities
+
+    Rows follow intensity_matrix/groupIds.npy and columns intensity_matrix/sampleIds.npy.
+    A dense matrix is written to values.npy with NaN for undetected peaks; a sparse
+    matrix is written in COO format to row.npy, col.npy and values.npy. A manifest.json
+    describes the layout, with the number of detected groups per sample (sample_nnz),
+    counted from the written matrix as mapped by py_context (see load_intensity_matrix()).
+    '''
+
+    peak_columns = [x[1] for x in conn.execute("PRAGMA table_info(peaks)").fetchall()]
+    if quant_type not in peak_columns:
+        raise ValueError('invalid quant_type: %s is not a column of the peaks table' % quant_type)
+
+    os.makedirs(out_dir, exist_ok=True)
+
+    group_ids = np.array([x[0] for x in conn.execute("SELECT groupId FROM peakgroups ORDER BY groupId")], dtype=np.int64)
+    sample_ids = np.array([x[0] for x in conn.execute("SELECT sampleId FROM samples ORDER BY sampleId")], dtype=np.int64)
+
+    # peaks whose group or sample is missing from the peakgroups or samples tables are not exported
+    matched_peaks = "FROM peaks WHERE groupId IN (SELECT groupId FROM peakgroups) AND sampleId IN (SELECT sampleId FROM samples)"
+    n_cells_detected = conn.execute("SELECT COUNT(*) FROM (SELECT 1 " + matched_peaks + " GROUP BY groupId, sampleId)").fetchone()[0]
+
+    n_cells = max(group_ids.size * sample_ids.size, 1)
+    if matrix_format == "auto":
+        matrix_format = "dense" if n_cells_detected / n_cells >= DENSE_MATRIX_MIN_DENSITY else "sparse"
+
+    np.save(os.path.join(out_dir, "groupIds.npy"), group_ids)
+    np.save(os.path.join(out_dir, "sampleIds.npy"), sample_ids)
+
+    shape = (int(group_ids.size), int(sample_ids.size))
+
+    if matrix_format == "dense":
+        values = np.lib.format.open_memmap(os.path.join(out_dir, "values.npy"), mode="w+", dtype=np.float32, shape=shape)
+        values[:] = np.nan
+    else:
+        rows = np.lib.format.open_memmap(os.path.join(out_dir, "row.npy"), mode="w+", dtype=np.int32, shape=(n_cells_detected,))
+        cols = np.lib.format.open_memmap(os.path.join(out_dir, "col.npy"), mode="w+", dtype=np.int32, shape=(n_cells_detected,))
+        values = np.lib.format.open_memmap(os.path.join(out_dir, "values.npy"), mode="w+", dtype=np.float32, shape=(n_cells_detected,))
+
+    # a group should have at most one peak per sample; keep the largest if not (MAX, like fmax, skips NULL/NaN).
+    # The dense matrix takes the maximum in place; COO entries must be unique, so SQLite groups them first
+    if matrix_format == "dense":
+        cursor = conn.execute('SELECT groupId, sampleId, "%s" ' % quant_type + matched_peaks)
+    else:
+        cursor = conn.execute('SELECT groupId, sampleId, MAX("%s") ' % quant_type + matched_peaks + " GROUP BY groupId, sampleId")
+    n_written = 0
+
+    while True:
+        chunk = cursor.fetchmany(chunk_rows)
+        if not chunk:
+            break
+
+        chunk = np.array(chunk, dtype=np.float64)
+        row_index = np.searchsorted(group_ids, chunk[:, 0].astype(np.int64))
+        col_index = np.searchsorted(sample_ids, chunk[:, 1].astype(np.int64))
+        intensity = chunk[:, 2].astype(np.float32)
+
+        if matrix_format == "dense":
+            # unbuffered, so that duplicate cells within a chunk are all compared
+            np.fmax.at(values, (row_index, col_index), intensity)
+        else:
+            n_chunk = intensity.size
+            rows[n_written:n_written + n_chunk] = row_index
+            cols[n_written:n_written + n_chunk] = col_index
+            values[n_written:n_written + n_chunk] = intensity
+            n_written += n_chunk
+
+    for array in [values] if matrix_format == "dense" else [rows, cols, values]:
+        array.flush()
+    del values
+    if matrix_format == "sparse":
+        del rows, cols
+
+    # read back through the run's shared memory maps, which later python modules reuse
+    if matrix_format == "dense":
+        values = py_context.array(os.path.join(out_dir, "values.npy"))
+        # count detected cells in blocks of about chunk_rows cells, so that no matrix-sized temporary is made
+        block_rows = max(chunk_rows // max(shape[1], 1), 1)
+        sample_nnz = np.zeros(shape[1], dtype=np.int64)
+        for i in range(0, shape[0], block_rows):
+            sample_nnz += np.count_nonzero(~np.isnan(values[i:i + block_rows]), axis=0)
+    else:
+        sample_nnz = np.bincount(py_context.array(os.path.join(out_dir, "col.npy")), minlength=shape[1])
+
+    matrix_summary = {
+        "format": matrix_format,
+        "shape": shape,
+        "nnz": int(sample_nnz.sum()),
+        "sample_nnz": [int(x) for x in sample_nnz],
+        "quant_type": quant_type,
+        "rows": "groupIds.npy",
+        "columns": "sampleIds.npy",
+        "files": ["values.npy"] if matrix_format == "dense" else ["row.npy", "col.npy", "values.npy"]
+        }
+
+    with open(os.path.join(out_dir, "manifest.json"), "w") as f:
+        json.dump(matrix_summary, f, indent=4)
+
+    return matrix_summary
+
+
+def load_intensity_matrix(matrix_folder, py_context):
+    '''
+    Memory-map an intensity matrix written by export_intensity_matrix()
+
+    Arrays are mapped through the run's PyModuleContext, so python modules of the
+    same run share one read-only map of each file.
+
+    Returns
+    -------
+    matrix : dict
+      the manifest, plus the arrays groupIds, sampleIds and values (and row and col for a sparse matrix)
+    '''
+
+    with open(os.path.join(matrix_folder, "manifest.json"), "r") as f:
+        matrix = json.load(f)
+
+    matrix['groupIds'] = py_context.array(os.path.join(matrix_folder, matrix['rows']))
+    matrix['sampleIds'] = py_context.array(os.path.join(matrix_folder, matrix['columns']))
+    for file_name in matrix['files']:
+        matrix[os.path.splitext(file_name)[0]] = py_context.array(os.path.join(matrix_folder, file_name))
+
+    return matrix
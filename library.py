@@ -0,0 +1,399 @@
+import bisect
+import csv
+import heapq
+import os
+import sqlite3
+import threading
+from collections import deque, namedtuple
+from itertools import groupby
+
+from pymodules import process_pool
+from utils import PipelineFailedException, parse_mz_list
+
+# library spectrum; peaks are (mz, intensity, label) tuples
+LibraryEntry = namedtuple('LibraryEntry', ['entry_id', 'name', 'formula', 'mass', 'precursor_mz', 'adduct', 'charge',
+                                           'rt', 'collision_energy', 'source', 'peaks'])
+
+# entries serialized per process pool task; in-flight tasks are limited to 2 per worker to bound memory
+ENTRIES_PER_BATCH = 2000
+
+# columns of the offset index written next to each library as <library>.idx
+MSP_INDEX_COLUMNS = ["precursorMz", "offset", "length", "id", "name"]
+
+SQLITE_HEADER = b"SQLite format 3\x00"
+
+
+def run_library_export(module_dict, settings):
+    '''
+    Write an MSP spectral library of the run's standards and mzrollDB matches
+
+    Library spectra are streamed, in precursor m/z order, from an SQLite
+    snapshot of the standards database (one entry per MS2 fragmentation at each
+    of the run's collision energies) and from the compounds matched in the
+    mzrollDB (with the retention time observed in this run). Batches of entries
+    are serialized to MSP text in a process pool and written in order, so
+    memory use is bounded by the batch size and number of workers, not the size
+    of the library.
+
+    An offset index, <library>.idx, lists every entry's precursor m/z and its
+    byte offset and length in the .msp, sorted by precursor m/z, so that readers
+    can seek directly to the entries in an m/z window (see read_msp_entries()).
+
+    Parameters
+    ----------
+    module_dict : dict
+      module configuration; parameters are merged with globals
+    settings : MzkitSettings
+      paths to the dataset, outputs and programming assets, and run settings
+    '''
+
+    parameters = module_dict['parameters']
+
+    library_folder = settings.program_settings['library_path']
+    library_path = os.path.join(library_folder, parameters.get('library_file', "mzkit-all_single_energy.msp"))
+    sources = parameters.get('sources', ["standards", "mzrolldb"])
+    energies = parse_mz_list(parameters.get('collision_energies', ""))
+    mode = parameters.get('mode', "")
+    chemical_class = parameters.get('chemical_class', "")
+    n_workers = int(parameters.get('n_workers', 0)) or os.cpu_count()
+
+    invalid_sources = [x for x in sources if x not in ["standards", "mzrolldb"]]
+    if invalid_sources:
+        raise ValueError('invalid library sources: %s; must be standards and/or mzrolldb' % ", ".join(invalid_sources))
+
+    entry_streams = []
+    snapshot_conn = None
+
+    if "standards" in sources:
+        snapshot_path = find_standards_snapshot(parameters)
+        if snapshot_path is None:
+            print("# No SQLite snapshot of the standards database (standards_snapshot); skipping standards")
+        else:
+            print("# Reading standards from " + snapshot_path)
+            snapshot_conn = sqlite3.connect("file:%s?mode=ro" % snapshot_path, uri=True)
+            entry_streams.append(iter_standards_entries(snapshot_conn, energies, mode, chemical_class))
+
+    if "mzrolldb" in sources:
+        if os.path.isfile(settings.mzrolldb_file):
+            entry_streams.append(iter_mzrolldb_entries(settings.py_context.mzrolldb(settings.mzrolldb_file)))
+        else:
+            print("# mzrollDB not found; skipping mzrollDB matches")
+
+    if not entry_streams:
+        raise PipelineFailedException("no library sources available")
+
+    if not os.path.exists(library_folder):
+        os.makedirs(library_folder)
+
+    entries = heapq.merge(*entry_streams, key=lambda x: x.precursor_mz if x.precursor_mz is not None else float("inf"))
+
+    try:
+        n_entries = write_msp_library(entries, library_path, n_workers)
+    finally:
+        if snapshot_conn is not None:
+            snapshot_conn.close()
+
+    print("# Wrote %d library spectra to %s" % (n_entries, library_path))
+
+    return
+
+
+def find_standards_snapshot(parameters):
+    '''The standards_snapshot parameter, or dbname if it is an SQLite file; None if neither is'''
+
+    for path in [parameters.get('standards_snapshot'), parameters.get('dbname')]:
+        if not path or not os.path.isfile(path):
+            continue
+        with open(path, "rb") as f:
+            if f.read(len(SQLITE_HEADER)) == SQLITE_HEADER:
+                return path
+
+    return None
+
+
+def matches_mode(ion_mode, mode):
+    '''Whether an ion's mode (a charge sign, or a polarity name) matches the run's mode'''
+
+    if ion_mode is None or mode not in ["positive", "negative"]:
+        return True
+
+    try:
+        return (float(ion_mode) > 0) == (mode == "positive")
+    except ValueError:
+        return str(ion_mode).lower().startswith(mode[:3])
+
+
+def iter_standards_entries(conn, energies, mode, chemical_class, batch_size=500):
+    '''
+    Stream library entries from a snapshot of the standards database, in precursor m/z order
+
+    Uses the compounds, ions, samples, fragmentation, fragmentationData and
+    elutions tables of the standards database schema. Each MS2 fragmentation
+    at one of the energies (all energies if none are given) becomes an entry;
+    its retention time is the ion's mean elution time. Fragmentations are
+    sorted without their peaks, which are then read for batch_size
+    fragmentations at a time.
+    '''
+
+    mean_rts = dict(conn.execute("SELECT ionId, AVG(rt) FROM elutions GROUP BY ionId"))
+
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND tbl_name = 'fragmentationData'").fetchone() is None:
+        print("# fragmentationData has no index; index its fragmentationId column to speed up library export")
+
+    query = ("SELECT f.fragmentationId, i.ionId, c.compoundId, c.compoundName, c.formula, c.mass, i.adductName, "
+             "i.precursorMz, i.precursorCharge, i.mode, s.chemicalClass, f.energy "
+             "FROM fragmentation f "
+             "JOIN ions i ON i.ionId = f.ionId "
+             "JOIN compounds c ON c.compoundId = i.compoundId "
+             "JOIN samples s ON s.sampleId = f.sampleId "
+             "WHERE f.mslevel = 2")
+    query_args = []
+    if energies:
+        query += " AND f.energy IN (%s)" % ", ".join("?" * len(energies))
+        query_args += energies
+    query += " ORDER BY i.precursorMz IS NULL, i.precursorMz, f.fragmentationId"
+
+    cursor = conn.execute(query, query_args)
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+
+        fragmentations = [x for x in rows if matches_mode(x[9], mode) and
+                          not (chemical_class and x[10] and x[10].lower() != chemical_class.lower())]
+
+        peaks = {}
+        if fragmentations:
+            peak_rows = conn.execute("SELECT fragmentationId, mz, ic, label FROM fragmentationData WHERE fragmentationId IN (%s) "
+                                     "ORDER BY fragmentationId, mz" % ", ".join("?" * len(fragmentations)),
+                                     [x[0] for x in fragmentations])
+            for fragmentation_id, rows in groupby(peak_rows, key=lambda x: x[0]):
+                peaks[fragmentation_id] = [x[1:] for x in rows]
+
+        for (fragmentation_id, ion_id, compound_id, compound_name, formula, mass, adduct, precursor_mz, charge,
+             _, _, energy) in fragmentations:
+            yield LibraryEntry(entry_id="%s_%s_%s" % (compound_id, ion_id, fragmentation_id),
+                               name="%s %s [%s]" % (compound_name, adduct or "", _format_number(energy)),
+                               formula=formula, mass=mass, precursor_mz=precursor_mz, adduct=adduct, charge=charge,
+                               rt=mean_rts.get(ion_id), collision_energy=energy, source="standards",
+                               peaks=peaks.get(fragmentation_id, []))
+
+
+def _split_list(value):
+    return [x for x in str(value or "").replace(",", ";").split(";") if x != ""]
+
+
+def iter_mzrolldb_entries(conn):
+    '''
+    Stream library entries of the compounds matched to peak groups in an mzrollDB, in precursor m/z order
+
+    Retention times are the mean RT of the compound's matched peaks in this run.
+    '''
+
+    query = ("SELECT c.compoundId, c.name, c.formula, c.mass, c.adductString, c.precursorMz, c.charge, "
+             "c.collisionEnergy, c.fragment_mzs, c.fragment_intensity, c.fragment_labels, "
+             "(SELECT AVG(p.rt) FROM peakgroups g JOIN peaks p ON p.groupId = g.groupId WHERE g.compoundId = c.compoundId) "
+             "FROM compounds c "
+             "WHERE c.compoundId IN (SELECT compoundId FROM peakgroups WHERE compoundId IS NOT NULL) "
+             "ORDER BY c.precursorMz IS NULL, c.precursorMz")
+
+    # matched compounds are few; reading them at once leaves no statement open on the shared connection
+    for row in conn.execute(query).fetchall():
+        (compound_id, name, formula, mass, adduct, precursor_mz, charge, energy,
+         fragment_mzs, fragment_intensities, fragment_labels, rt) = row
+
+        mzs = _split_list(fragment_mzs)
+        intensities = _split_list(fragment_intensities)
+        labels = _split_list(fragment_labels)
+        if len(labels) != len(mzs):
+            labels = [None] * len(mzs)
+
+        yield LibraryEntry(entry_id="%s_run" % compound_id, name=name, formula=formula, mass=mass,
+                           precursor_mz=precursor_mz, adduct=adduct, charge=charge, rt=rt, collision_energy=energy,
+                           source="mzrolldb", peaks=list(zip([float(x) for x in mzs], [float(x) for x in intensities], labels)))
+
+
+def _format_number(x, digits=6):
+    if x is None:
+        return ""
+    return ("%." + str(digits) + "f") % x if isinstance(x, float) and not float(x).is_integer() else "%g" % x
+
+
+def format_msp_entry(entry):
+    '''MSP text of a library entry, ending with a blank line'''
+
+    lines = ["Name: " + str(entry.name),
+             "ID: " + str(entry.entry_id)]
+    if entry.formula:
+        lines.append("Formula: " + str(entry.formula))
+    if entry.mass is not None:
+        lines.append("MW: " + _format_number(entry.mass))
+    if entry.precursor_mz is not None:
+        lines.append("PrecursorMZ: " + _format_number(entry.precursor_mz))
+    if entry.adduct:
+        lines.append("Adduct: " + str(entry.adduct))
+    if entry.charge is not None:
+        lines.append("Charge: " + _format_number(entry.charge))
+    if entry.rt is not None:
+        lines.append("RT: " + _format_number(entry.rt, 4))
+    if entry.collision_energy is not None:
+        lines.append("CollisionEnergy: " + _format_number(entry.collision_energy))
+    lines.append("Comment: source=" + entry.source)
+    lines.append("Num Peaks: %d" % len(entry.peaks))
+
+    for mz, intensity, label in entry.peaks:
+        peak = _format_number(float(mz)) + " " + _format_number(float(intensity), 2)
+        lines.append(peak + ' "' + str(label) + '"' if label else peak)
+
+    return "\n".join(lines) + "\n\n"
+
+
+def serialize_msp_batch(entries):
+    '''
+    MSP bytes of a batch of entries, and each entry's (precursor m/z, offset, length, id, name)
+    with offsets relative to the start of the batch
+    '''
+
+    chunks = []
+    index_rows = []
+    offset = 0
+    for entry in entries:
+        data = format_msp_entry(entry).encode("utf-8")
+        chunks.append(data)
+        index_rows.append((entry.precursor_mz, offset, len(data), entry.entry_id, entry.name))
+        offset += len(data)
+
+    return b"".join(chunks), index_rows
+
+
+def _batches(entries, batch_size):
+    batch = []
+    for entry in entries:
+        batch.append(entry)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def write_msp_library(entries, library_path, n_workers=1, batch_size=ENTRIES_PER_BATCH):
+    '''
+    Serialize library entries in a process pool and write them in order, with an offset index
+
+    Entries should be in precursor m/z order; the index is then written as
+    the library is, without sorting. The library and index are written to
+    temporary files of this process and moved into place when complete, so
+    runs sharing a library folder do not write over each other's partial files.
+
+    Returns
+    -------
+    n_entries : int
+    '''
+
+    index_path = os.path.splitext(library_path)[0] + ".idx"
+    tmp_suffix = ".%d-%d.tmp" % (os.getpid(), threading.get_ident())
+    tmp_library_path = library_path + tmp_suffix
+    tmp_index_path = index_path + tmp_suffix
+
+    n_entries = 0
+    sorted_by_mz = True
+    last_mz = float("-inf")
+
+    with open(tmp_library_path, "wb") as library, open(tmp_index_path, "w", newline="") as index, \
+            process_pool(n_workers) as pool:
+        writer = csv.writer(index, delimiter="\t", lineterminator="\n")
+        writer.writerow(MSP_INDEX_COLUMNS)
+
+        in_flight = deque()
+
+        def write_next():
+            nonlocal n_entries, sorted_by_mz, last_mz
+            data, index_rows = in_flight.popleft().result()
+            batch_offset = library.tell()
+            library.write(data)
+            for precursor_mz, offset, length, entry_id, name in index_rows:
+                mz = precursor_mz if precursor_mz is not None else float("inf")
+                sorted_by_mz = sorted_by_mz and mz >= last_mz
+                last_mz = mz
+                writer.writerow(["" if precursor_mz is None else _format_number(precursor_mz), batch_offset + offset, length, entry_id, name])
+            n_entries += len(index_rows)
+
+        for batch in _batches(entries, batch_size):
+            in_flight.append(pool.submit(serialize_msp_batch, batch))
+            if len(in_flight) > 2 * n_workers:
+                write_next()
+        while in_flight:
+            write_next()
+
+    if not sorted_by_mz:
+        sort_msp_index(tmp_index_path)
+
+    os.replace(tmp_library_path, library_path)
+    os.replace(tmp_index_path, index_path)
+
+    return n_entries
+
+
+def sort_msp_index(index_path):
+    '''Sort an offset index by precursor m/z in place (for libraries not written in m/z order)'''
+
+    with open(index_path, "r", newline="") as f:
+        reader = csv.reader(f, delimiter="\t")
+        header = next(reader)
+        rows = sorted(reader, key=lambda x: float(x[0]) if x[0] else float("inf"))
+
+    with open(index_path, "w", newline="") as f:
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def read_msp_index(index_path):
+    '''Precursor m/z, offset and length lists of an offset index, sorted by precursor m/z'''
+
+    precursor_mzs = []
+    offsets = []
+    lengths = []
+    with open(index_path, "r", newline="") as f:
+        reader = csv.DictReader(f, delimiter="\t")
+        for row in reader:
+            precursor_mzs.append(float(row['precursorMz']) if row['precursorMz'] else float("inf"))
+            offsets.append(int(row['offset']))
+            lengths.append(int(row['length']))
+
+    return precursor_mzs, offsets, lengths
+
+
+def read_msp_entries(library_path, min_mz, max_mz, index=None):
+    '''
+    MSP text of the entries of a library with precursor m/z in [min_mz, max_mz], read by seeking with its offset index
+
+    Parameters
+    ----------
+    library_path : str
+      .msp file written by write_msp_library()
+    min_mz, max_mz : float
+      precursor m/z window
+    index : tuple
+      result of read_msp_index(), to reuse across lookups; read from <library>.idx by default
+
+    Returns
+    -------
+    entries : [str]
+    '''
+
+    if index is None:
+        index = read_msp_index(os.path.splitext(library_path)[0] + ".idx")
+    precursor_mzs, offsets, lengths = index
+
+    first = bisect.bisect_left(precursor_mzs, min_mz)
+    last = bisect.bisect_right(precursor_mzs, max_mz)
+
+    entries = []
+    with open(library_path, "rb") as f:
+        for i in range(first, last):
+            f.seek(offsets[i])
+            entries.append(f.read(lengths[i]).decode("utf-8"))
+
+    return entries
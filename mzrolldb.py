@@ -0,0 +1,212 @@
+import csv
+import os
+import sqlite3
+from time import perf_counter
+
+from utils import PipelineFailedException
+
+# (index name, table, columns) for lookups made by downstream modules. peaks indexes
+# include the common quantification columns so group and sample lookups are covered.
+MZROLLDB_INDEXES = [
+    ("idx_peaks_groupId", "peaks", ["groupId", "sampleId", "peakAreaTop", "rt", "peakMz"]),
+    ("idx_peaks_sampleId", "peaks", ["sampleId", "groupId", "peakAreaTop"]),
+    ("idx_peakgroups_compoundId", "peakgroups", ["compoundId"]),
+    ("idx_peakgroups_compoundName", "peakgroups", ["compoundName"]),
+    ("idx_peakgroups_parentGroupId", "peakgroups", ["parentGroupId"]),
+    ("idx_compounds_compoundId", "compounds", ["compoundId"])
+    ]
+
+# rows read by the group_sample_matrix probe
+N_MATRIX_PROBE_ROWS = 100000
+
+# (name, query, table and column used to pick query arguments) timed before and after tuning;
+# queries are bounded so that probing a large mzrollDB stays cheap
+REPRESENTATIVE_QUERIES = [
+    ("peaks_by_group", "SELECT sampleId, peakAreaTop FROM peaks WHERE groupId = ?", ("peakgroups", "groupId")),
+    ("peaks_by_sample", "SELECT groupId, peakAreaTop FROM peaks WHERE sampleId = ?", ("samples", "sampleId")),
+    ("groups_by_compound", "SELECT groupId FROM peakgroups WHERE compoundName = ?", ("peakgroups", "compoundName")),
+    ("group_sample_matrix", "SELECT groupId, sampleId, peakAreaTop FROM peaks ORDER BY groupId, sampleId LIMIT %d" % N_MATRIX_PROBE_ROWS, None)
+    ]
+
+# largest number of distinct arguments each parameterized query is timed with
+N_QUERY_PROBES = 25
+
+
+def run_mzrolldb_tuning(module_dict, settings):
+    '''
+    Index, analyze and compact the mzrollDB before delivery
+
+    Parameters
+    ----------
+    module_dict : dict
+      module configuration; parameters are merged with globals
+    settings : MzkitSettings
+      paths to the dataset, outputs and programming assets, and run settings
+    '''
+
+    parameters = module_dict['parameters']
+
+    if not os.path.isfile(settings.mzrolldb_file):
+        raise PipelineFailedException("mzrollDB not found: %s" % settings.mzrolldb_file)
+
+    tune_mzrolldb(settings.mzrolldb_file,
+                  stage="delivery",
+                  report_path=os.path.join(settings.run['output_folder'], "QC", "mzrolldb_query_timings.tsv"),
+                  journal_mode=parameters.get('journal_mode', "wal"),
+                  vacuum=parameters.get('vacuum', True),
+                  conn=settings.py_context.mzrolldb(settings.mzrolldb_file))
+
+    return
+
+
+def table_columns(conn, table):
+    return [x[1] for x in conn.execute("PRAGMA table_info(%s)" % table).fetchall()]
+
+
+def create_indexes(conn):
+    '''Create the MZROLLDB_INDEXES whose table and columns exist; returns the names of created indexes'''
+
+    created = []
+    for index_name, table, columns in MZROLLDB_INDEXES:
+        existing_columns = table_columns(conn, table)
+        if not existing_columns or not all(x in existing_columns for x in columns):
+            continue
+
+        conn.execute("CREATE INDEX IF NOT EXISTS %s ON %s (%s)" % (index_name, table, ", ".join(columns)))
+        created.append(index_name)
+
+    return created
+
+
+def _query_arguments(conn, source):
+    '''
+    Values of a column at evenly spaced rows of its table, so the same probes are used before and after tuning
+
+    Rows are looked up by rowid, so only N_QUERY_PROBES rows are read
+    however large the table is.
+    '''
+
+    if source is None:
+        return [()]
+
+    table, column = source
+    if column not in table_columns(conn, table):
+        return []
+
+    lowest, highest = conn.execute("SELECT MIN(rowid), MAX(rowid) FROM %s" % table).fetchone()
+    if lowest is None:
+        return []
+
+    step = max((highest - lowest) / N_QUERY_PROBES, 1)
+    query = "SELECT %s FROM %s WHERE rowid >= ? AND %s IS NOT NULL ORDER BY rowid LIMIT 1" % (column, table, column)
+
+    values = []
+    for i in range(N_QUERY_PROBES):
+        row = conn.execute(query, (int(lowest + i * step),)).fetchone()
+        if row is not None and row[0] not in values:
+            values.append(row[0])
+
+    return [(x,) for x in values]
+
+
+def time_queries(conn):
+    '''
+    Returns {query name: seconds} for REPRESENTATIVE_QUERIES which can be run against this mzrollDB
+
+    Each query is run once untimed to warm the page cache, so that timings
+    before and after tuning are not biased by the first read of the file.
+    Result rows are stepped through without being kept.
+    '''
+
+    probes = []
+    for name, query, source in REPRESENTATIVE_QUERIES:
+        try:
+            arguments = _query_arguments(conn, source)
+        except sqlite3.OperationalError:
+            # table or column missing from this mzrollDB
+            continue
+        if arguments:
+            probes.append((name, query, arguments))
+
+    timings = {}
+    for timed in [False, True]:
+        for name, query, arguments in probes:
+            try:
+                start = perf_counter()
+                for argument in arguments:
+                    for _ in conn.execute(query, argument):
+                        pass
+                if timed:
+                    timings[name] = perf_counter() - start
+            except sqlite3.OperationalError:
+                continue
+
+    return timings
+
+
+def tune_mzrolldb(db_path, stage, report_path, journal_mode="wal", vacuum=False, conn=None):
+    '''
+    Index and analyze an mzrollDB, optionally compacting it
+
+    Representative queries are timed before and after, and the timings are appended
+    to report_path so that each tuning stage of a run can be compared.
+
+    Parameters
+    ----------
+    db_path : str
+      path to the mzrollDB
+    stage : str
+      label for the report, e.g. the pipe which last modified the mzrollDB
+    report_path : str
+      .tsv file to append query timings to
+    journal_mode : str
+      SQLite journal mode to leave the mzrollDB in between pipes; WAL lets readers proceed during writes
+    vacuum : bool
+      rebuild the file to drop free pages and defragment tables. This is the final
+      (delivery) stage, so the file is left in DELETE journal mode: WAL databases
+      cannot be opened from read-only or network locations, e.g. by MAVEN
+    conn : sqlite3.Connection
+      open autocommit connection to db_path to use (and leave open); by default one is opened and closed
+    '''
+
+    size_before = os.path.getsize(db_path)
+
+    owns_connection = conn is None
+    if owns_connection:
+        conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        before = time_queries(conn)
+
+        created = create_indexes(conn)
+        conn.execute("ANALYZE")
+        conn.execute("PRAGMA optimize")
+
+        if vacuum:
+            conn.execute("VACUUM")
+
+        mode = conn.execute("PRAGMA journal_mode=%s" % ("delete" if vacuum else journal_mode)).fetchone()[0]
+        if mode == "wal":
+            conn.execute("PRAGMA main.wal_checkpoint(TRUNCATE)")
+
+        after = time_queries(conn)
+    finally:
+        if owns_connection:
+            conn.close()
+
+    size_after = os.path.getsize(db_path)
+
+    print("# mzrollDB tuned after " + stage + ": " + str(len(created)) + " indexes, journal_mode=" + mode +
+          ", size " + str(size_before) + " -> " + str(size_after) + " bytes")
+
+    write_header = not os.path.exists(report_path)
+    with open(report_path, "a", newline="") as f:
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        if write_header:
+            writer.writerow(["stage", "query", "seconds_before", "seconds_after", "speedup"])
+
+        for name in before:
+            speedup = before[name] / after[name] if after.get(name) else float("nan")
+            print("    " + name + ": %.4fs -> %.4fs" % (before[name], after.get(name, float("nan"))))
+            writer.writerow([stage, name, "%.6f" % before[name], "%.6f" % after.get(name, float("nan")), "%.2f" % speedup])
+
+    return before, after
@@ -0,0 +1,470 @@
+import argparse
+import hashlib
+import math
+import os
+import platform
+import socket
+import sqlite3
+import statistics
+import subprocess
+from collections import OrderedDict
+from datetime import datetime
+
+PERF_DB_PATH = os.environ.get("MZKIT_PERF_DB", os.path.join(os.path.expanduser("~"), ".mzkit", "perf.db"))
+
+# seconds to wait for a lock held by another run (e.g., concurrent multiplexed groups) before giving up
+PERF_DB_TIMEOUT_SECONDS = 60
+
+PERF_DB_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS runs (
+        run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        started_at TEXT,
+        finished_at TEXT,
+        host TEXT,
+        output_folder TEXT,
+        config_path TEXT,
+        config_fingerprint TEXT,
+        status TEXT,
+        seconds REAL,
+        n_files INTEGER,
+        total_bytes INTEGER,
+        max_file_bytes INTEGER,
+        n_scans INTEGER,
+        minintensity REAL,
+        ms2 REAL,
+        n_cpus INTEGER,
+        memory_bytes INTEGER)""",
+    """CREATE TABLE IF NOT EXISTS module_runs (
+        run_id INTEGER REFERENCES runs (run_id),
+        pipe TEXT,
+        module TEXT,
+        language TEXT,
+        message TEXT,
+        seconds REAL,
+        cpu_seconds REAL,
+        max_rss_bytes INTEGER,
+        n_workers INTEGER)""",
+    """CREATE TABLE IF NOT EXISTS tool_versions (
+        run_id INTEGER REFERENCES runs (run_id),
+        tool TEXT,
+        version TEXT)""",
+    "CREATE INDEX IF NOT EXISTS idx_module_runs_run_id ON module_runs (run_id)",
+    "CREATE INDEX IF NOT EXISTS idx_module_runs_module ON module_runs (pipe, module)",
+    "CREATE INDEX IF NOT EXISTS idx_tool_versions_run_id ON tool_versions (run_id)",
+    "CREATE INDEX IF NOT EXISTS idx_runs_config_fingerprint ON runs (config_fingerprint)"
+    ]
+
+FEATURE_COLUMNS = ['n_files', 'total_bytes', 'max_file_bytes', 'n_scans', 'minintensity', 'ms2']
+
+# columns added to the runs table after it was first released, added to older databases when opened
+ADDED_RUN_COLUMNS = [('n_scans', 'INTEGER')]
+
+# python packages whose versions are recorded when installed
+RECORDED_PACKAGES = ["numpy", "pyarrow", "valideer", "pytz"]
+
+# defaults for flagging a slowdown: z-score against the baseline runs and minimum relative slowdown
+DEFAULT_BASELINE_RUNS = 10
+DEFAULT_Z_THRESHOLD = 3.0
+DEFAULT_MIN_SLOWDOWN = 0.1
+MIN_BASELINE_RUNS = 3
+# floor on the baseline's log-runtime standard deviation so that a few identical runs do not flag noise
+MIN_LOG_SD = 0.05
+
+
+def connect_perf_db(db_path=PERF_DB_PATH):
+    '''Open (and if needed create) the performance database'''
+
+    db_folder = os.path.dirname(db_path)
+    if db_folder and not os.path.exists(db_folder):
+        os.makedirs(db_folder)
+
+    conn = sqlite3.connect(db_path, timeout=PERF_DB_TIMEOUT_SECONDS)
+    for statement in PERF_DB_SCHEMA:
+        conn.execute(statement)
+
+    run_columns = [x[1] for x in conn.execute("PRAGMA table_info(runs)").fetchall()]
+    for column, column_type in ADDED_RUN_COLUMNS:
+        if column not in run_columns:
+            conn.execute("ALTER TABLE runs ADD COLUMN %s %s" % (column, column_type))
+    conn.commit()
+
+    return conn
+
+
+def _command_output(cmd, cwd=None):
+    '''First line of a version command's output, None if it could not be run'''
+
+    try:
+        p = subprocess.run(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=30)
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+    if p.returncode != 0:
+        return None
+
+    lines = p.stdout.decode("utf-8", errors="replace").strip().splitlines()
+
+    return lines[0].strip() if lines else None
+
+
+def _file_sha256(path):
+
+    if not os.path.isfile(path):
+        return None
+
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            file_hash.update(block)
+
+    return "sha256:" + file_hash.hexdigest()[:16]
+
+
+def collect_tool_versions(run_plan, settings):
+    '''
+    Versions of the code a run used
+
+    The pipeline and maven checkouts are identified by their git commit and the
+    C++ executables by a hash of the binary, since they do not report a version.
+    '''
+
+    open_CLaM_path = settings.program_settings['open_CLaM_path']
+
+    versions = OrderedDict()
+    versions['mzkit'] = _command_output(["git", "rev-parse", "HEAD"], cwd=open_CLaM_path)
+    versions['maven'] = _command_output(["git", "rev-parse", "HEAD"], cwd=os.path.join(open_CLaM_path, "maven"))
+    versions['python'] = platform.python_version()
+    versions['peakdetector'] = _file_sha256(os.path.join(settings.program_settings['peakdetector_bin_path'], "peakdetector"))
+    versions['mzDeltas'] = _file_sha256(os.path.join(settings.program_settings['mzdeltas_bin_path'], "mzDeltas"))
+
+    used_languages = set(run_plan.modules[module]['language']
+                         for pipe_dict in run_plan.pipeline.values() if pipe_dict['use']
+                         for module in pipe_dict['modules'])
+    if "R" in used_languages:
+        versions['R'] = _command_output([settings.program_settings['RCMD'], "--version"])
+
+    try:
+        from importlib.metadata import version, PackageNotFoundError
+        for package in RECORDED_PACKAGES:
+            try:
+                versions[package] = version(package)
+            except PackageNotFoundError:
+                pass
+    except ImportError:
+        pass
+
+    return OrderedDict((tool, version) for tool, version in versions.items() if version is not None)
+
+
+def record_run(pipeline_status_dict, run_plan, settings, features, status, db_path=PERF_DB_PATH):
+    '''
+    Save a run's inputs, config fingerprint, tool versions and per-module usage
+
+    Parameters
+    ----------
+    pipeline_status_dict : OrderedDict
+      status and timing of each pipe which ran, from run_pipe()
+    run_plan : RunPlan
+      validated pipeline plan; its fingerprint identifies runs with the same config
+    settings : MzkitSettings
+      paths to the dataset, outputs and programming assets, and run settings
+    features : InputFeatures
+      summary of the run's inputs, see planner.collect_input_features()
+    status : str
+      outcome of the run, e.g. success or critical_fail
+
+    Returns
+    -------
+    run_id : int
+      None if the run could not be recorded; a finished run does not fail over its performance record
+    '''
+
+    start_time = settings.run['start_time']
+    end_time = datetime.now()
+
+    try:
+        run_id = _insert_run(pipeline_status_dict, run_plan, settings, features, status, start_time, end_time, db_path)
+    except (OSError, sqlite3.Error) as e:
+        print("# Could not record run performance in %s: %s" % (db_path, e))
+        return None
+
+    print("# Recorded run performance as run %d in %s" % (run_id, db_path))
+
+    return run_id
+
+
+def _insert_run(pipeline_status_dict, run_plan, settings, features, status, start_time, end_time, db_path):
+
+    conn = connect_perf_db(db_path)
+    try:
+        with conn:
+            cursor = conn.execute(
+                "INSERT INTO runs (started_at, finished_at, host, output_folder, config_path, config_fingerprint, status, seconds, "
+                "n_cpus, memory_bytes, %s) VALUES (%s)" % (", ".join(FEATURE_COLUMNS), ", ".join("?" * (10 + len(FEATURE_COLUMNS)))),
+                [start_time.isoformat(), end_time.isoformat(), socket.gethostname(), settings.run['output_folder'],
+                 settings.run['configfile'], run_plan.fingerprint, status, (end_time - start_time).total_seconds(),
+                 settings.resources.n_cpus, settings.resources.memory_bytes] + [getattr(features, x) for x in FEATURE_COLUMNS])
+            run_id = cursor.lastrowid
+
+            module_rows = []
+            for pipe, pipe_status_dict in pipeline_status_dict.items():
+                for module, module_timing_dict in pipe_status_dict['timing_dict'].items():
+                    usage_dict = module_timing_dict.get('usage') or {}
+                    module_rows.append((run_id, pipe, module, run_plan.modules[module]['language'], module_timing_dict['message'],
+                                        usage_dict.get('seconds'), usage_dict.get('cpu_seconds'),
+                                        usage_dict.get('max_rss_bytes'), usage_dict.get('n_workers')))
+            conn.executemany("INSERT INTO module_runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", module_rows)
+
+            conn.executemany("INSERT INTO tool_versions VALUES (?, ?, ?)",
+                             [(run_id, tool, version) for tool, version in collect_tool_versions(run_plan, settings).items()])
+    finally:
+        conn.close()
+
+    return run_id
+
+
+def read_module_history(db_path=PERF_DB_PATH):
+    '''Successful module runs with their run's input features, oldest first, as used by the planner'''
+
+    if not os.path.isfile(db_path):
+        return []
+
+    # planning falls back to the uncalibrated cost model if the history cannot be read
+    try:
+        conn = connect_perf_db(db_path)
+        try:
+            rows = conn.execute(
+                "SELECT m.pipe, m.module, m.seconds, m.cpu_seconds, m.max_rss_bytes, m.n_workers, %s "
+                "FROM module_runs m JOIN runs r ON r.run_id = m.run_id "
+                "WHERE m.message = 'success' AND m.seconds IS NOT NULL "
+                "ORDER BY r.started_at, r.run_id" % ", ".join("r." + x for x in FEATURE_COLUMNS)).fetchall()
+        finally:
+            conn.close()
+    except (OSError, sqlite3.Error) as e:
+        print("# Could not read run performance history from %s: %s" % (db_path, e))
+        return []
+
+    return [{'pipe': row[0], 'module': row[1], 'seconds': row[2], 'cpu_seconds': row[3],
+             'max_rss_bytes': row[4], 'n_workers': row[5] or 1,
+             'features': dict(zip(FEATURE_COLUMNS, row[6:]))} for row in rows]
+
+
+def _read_run(conn, run_ref):
+    '''Look up a run by id, or "latest"'''
+
+    if str(run_ref) == "latest":
+        row = conn.execute("SELECT * FROM runs ORDER BY run_id DESC LIMIT 1").fetchone()
+    else:
+        row = conn.execute("SELECT * FROM runs WHERE run_id = ?", (int(run_ref),)).fetchone()
+
+    if row is None:
+        raise ValueError("run %s is not in the performance database" % run_ref)
+
+    return row
+
+
+def _read_module_runs(conn, run_id):
+
+    return OrderedDict(((x['pipe'], x['module']), x) for x in conn.execute(
+        "SELECT * FROM module_runs WHERE run_id = ? AND message = 'success' AND seconds IS NOT NULL", (run_id,)))
+
+
+def _read_tool_versions(conn, run_id):
+
+    return dict(conn.execute("SELECT tool, version FROM tool_versions WHERE run_id = ?", (run_id,)).fetchall())
+
+
+def _normalized_log_seconds(run, module_run):
+    '''
+    log of a module's runtime relative to the planner's uncalibrated estimate
+
+    Dividing by the estimate removes the expected effect of input size and
+    worker count, so runs of differently sized datasets can be compared.
+    '''
+
+    # imported here: the planner reads its history from this module
+    from planner import InputFeatures, default_estimate
+
+    features = InputFeatures(**{x: run[x] if run[x] is not None else 0 for x in FEATURE_COLUMNS})
+    expected_seconds, _ = default_estimate(module_run['language'] or "bin", features, max(module_run['n_workers'] or 1, 1))
+
+    return math.log(max(module_run['seconds'], 1e-3) / expected_seconds)
+
+
+def compare_runs(conn, run, baseline_runs, z_threshold=DEFAULT_Z_THRESHOLD, min_slowdown=DEFAULT_MIN_SLOWDOWN):
+    '''
+    Per-module runtime and memory deltas of a run against one or more baseline runs
+
+    Runtimes are compared after normalizing for input size and worker count. A
+    module is flagged as slower when its normalized runtime is at least
+    min_slowdown above the baseline mean and, given at least MIN_BASELINE_RUNS
+    baseline runs, its z-score against the baseline's spread (a prediction
+    interval for one new run) exceeds z_threshold.
+
+    Returns
+    -------
+    comparisons : [dict]
+      one entry per module of the run, in pipeline order
+    '''
+
+    module_runs = _read_module_runs(conn, run['run_id'])
+    baseline_module_runs = [(x, _read_module_runs(conn, x['run_id'])) for x in baseline_runs]
+
+    comparisons = []
+    for key, module_run in module_runs.items():
+        matched = [(baseline_run, x[key]) for baseline_run, x in baseline_module_runs if key in x]
+
+        comparison = {'pipe': key[0], 'module': key[1], 'seconds': module_run['seconds'],
+                      'max_rss_bytes': module_run['max_rss_bytes'], 'n_baseline': len(matched),
+                      'baseline_seconds': None, 'baseline_rss_bytes': None, 'slowdown': None, 'z': None, 'flagged': False}
+
+        if matched:
+            comparison['baseline_seconds'] = statistics.median(x['seconds'] for _, x in matched)
+            rss_values = [x['max_rss_bytes'] for _, x in matched if x['max_rss_bytes']]
+            comparison['baseline_rss_bytes'] = statistics.median(rss_values) if rss_values else None
+
+            value = _normalized_log_seconds(run, module_run)
+            baseline_values = [_normalized_log_seconds(baseline_run, x) for baseline_run, x in matched]
+            mean = statistics.mean(baseline_values)
+            comparison['slowdown'] = math.exp(value - mean) - 1
+
+            if len(baseline_values) >= MIN_BASELINE_RUNS:
+                sd = max(statistics.stdev(baseline_values), MIN_LOG_SD)
+                comparison['z'] = (value - mean) / (sd * math.sqrt(1 + 1 / len(baseline_values)))
+                comparison['flagged'] = comparison['z'] > z_threshold and comparison['slowdown'] > min_slowdown
+            else:
+                comparison['flagged'] = comparison['slowdown'] > min_slowdown
+
+        comparisons.append(comparison)
+
+    return comparisons
+
+
+def print_run_table(runs):
+
+    print("RUN\tSTARTED\t\t\tSTATUS\t\tTIME\tFILES\tGB\tCONFIG\t\t\tOUTPUT")
+    for run in runs:
+        print("%d\t%s\t%-12s\t%s\t%s\t%s\t%s\t%s" % (
+            run['run_id'], (run['started_at'] or "")[:19], run['status'],
+            "NA" if run['seconds'] is None else "%.0fs" % run['seconds'],
+            run['n_files'], "NA" if run['total_bytes'] is None else "%.2f" % (run['total_bytes'] / 2 ** 30),
+            run['config_fingerprint'] or "NA", run['output_folder'] or ""))
+
+
+def print_comparison(run, baseline_runs, comparisons, tool_version_changes):
+
+    def format_bytes(x):
+        return "NA" if x is None else "%.2f GB" % (x / 2 ** 30)
+
+    def format_optional(x, fmt):
+        return "NA" if x is None else fmt % x
+
+    print("=================================================")
+    print("PERFORMANCE OF RUN %d (%s) VS %s" % (
+        run['run_id'], (run['started_at'] or "")[:19],
+        "RUN %d" % baseline_runs[0]['run_id'] if len(baseline_runs) == 1 else "%d BASELINE RUNS" % len(baseline_runs)))
+
+    if run['config_fingerprint'] is not None and any(x['config_fingerprint'] != run['config_fingerprint'] for x in baseline_runs):
+        print("config differs from baseline: " + run['config_fingerprint'])
+    for tool, (old, new) in tool_version_changes.items():
+        print("%s changed: %s -> %s" % (tool, old, new))
+
+    print("MODULE\t\t\t\tTIME\tBASELINE\tNORM DELTA\tZ\tRSS\t\tBASELINE RSS\tFLAG")
+    for x in comparisons:
+        print("%-31s\t%.1fs\t%s\t\t%s\t\t%s\t%s\t%s\t%s" % (
+            x['pipe'] + "/" + x['module'], x['seconds'],
+            format_optional(x['baseline_seconds'], "%.1fs"),
+            format_optional(None if x['slowdown'] is None else 100 * x['slowdown'], "%+.0f%%"),
+            format_optional(x['z'], "%.1f"),
+            format_bytes(x['max_rss_bytes']), format_bytes(x['baseline_rss_bytes']),
+            "SLOWER" if x['flagged'] else ""))
+
+    print("=================================================")
+
+    return
+
+
+def perf_commandline_parser():
+
+    parser = argparse.ArgumentParser(prog="python mzkit.py perf",
+                                     description="Inspect and compare the performance of recorded mzkit runs")
+    parser.add_argument('--db',
+                        dest='db_path',
+                        help='performance database (default: $MZKIT_PERF_DB or ~/.mzkit/perf.db)',
+                        default=PERF_DB_PATH)
+
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    list_parser = subparsers.add_parser('list', help='list recorded runs')
+    list_parser.add_argument('-n', '--limit', dest='limit', type=int, default=20, help='number of recent runs to list')
+
+    compare_parser = subparsers.add_parser('compare',
+                                           help='compare a run to another run, or to a rolling baseline of earlier runs')
+    compare_parser.add_argument('run', nargs='?', default="latest", help='run id to evaluate (default: latest)')
+    compare_parser.add_argument('baseline', nargs='?', default=None,
+                                help='run id to compare to (default: a rolling baseline of earlier runs)')
+    compare_parser.add_argument('-b', '--baseline-runs', dest='baseline_runs', type=int, default=DEFAULT_BASELINE_RUNS,
+                                help='number of earlier successful runs in the rolling baseline')
+    compare_parser.add_argument('--any-config', dest='any_config', action='store_true', default=False,
+                                help='include runs with a different config in the rolling baseline')
+    compare_parser.add_argument('-z', '--z-threshold', dest='z_threshold', type=float, default=DEFAULT_Z_THRESHOLD,
+                                help='z-score above which a slowdown is significant')
+    compare_parser.add_argument('--min-slowdown', dest='min_slowdown', type=float, default=DEFAULT_MIN_SLOWDOWN,
+                                help='smallest relative slowdown to flag, e.g. 0.1 for 10%%')
+
+    return parser
+
+
+def perf_main(argv):
+    '''
+    Entry point of `python mzkit.py perf`
+
+    Returns 1 if a compared run has flagged slowdowns (so that it can gate CI), else 0.
+    '''
+
+    args = perf_commandline_parser().parse_args(argv)
+
+    if not os.path.isfile(args.db_path):
+        print("No performance database at %s; runs are recorded there when the pipeline completes." % args.db_path)
+        return 1
+
+    conn = connect_perf_db(args.db_path)
+    conn.row_factory = sqlite3.Row
+    try:
+        if args.command == "list":
+            runs = conn.execute("SELECT * FROM runs ORDER BY run_id DESC LIMIT ?", (args.limit,)).fetchall()
+            print_run_table(runs[::-1])
+            return 0
+
+        try:
+            run = _read_run(conn, args.run)
+            baseline_runs = [_read_run(conn, args.baseline)] if args.baseline is not None else None
+        except ValueError as e:
+            print(e)
+            return 1
+
+        if baseline_runs is None:
+            query = "SELECT * FROM runs WHERE run_id < ? AND status = 'success'"
+            query_args = [run['run_id']]
+            if not args.any_config:
+                query += " AND config_fingerprint IS ?"
+                query_args.append(run['config_fingerprint'])
+            baseline_runs = conn.execute(query + " ORDER BY run_id DESC LIMIT ?", query_args + [args.baseline_runs]).fetchall()
+
+        if not baseline_runs:
+            print("No earlier successful runs with the same config to compare run %d to; try --any-config." % run['run_id'])
+            return 0
+
+        run_versions = _read_tool_versions(conn, run['run_id'])
+        baseline_versions = _read_tool_versions(conn, baseline_runs[0]['run_id'])
+        tool_version_changes = OrderedDict((tool, (baseline_versions.get(tool), version))
+                                           for tool, version in sorted(run_versions.items())
+                                           if baseline_versions.get(tool) != version)
+
+        comparisons = compare_runs(conn, run, baseline_runs, args.z_threshold, args.min_slowdown)
+        print_comparison(run, baseline_runs, comparisons, tool_version_changes)
+    finally:
+        conn.close()
+
+    return 1 if any(x['flagged'] for x in comparisons) else 0
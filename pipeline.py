@@ -0,0 +1,406 @@
+import csv
+import os
+import sys
+import threading
+import traceback
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from classes import MzkitConfig
+from utils import MspFileMissingException
+from perfdb import record_run
+from planner import collect_input_features, plan_resources, print_resource_plan
+from telemetry import MetricsPublisher
+from utils import create_success_file, get_elapsed_time, read_acquisition_info, run_pipe
+
+# run statuses after which mzkit exits successfully (non-critical pipes may have failed)
+SUCCESS_STATUSES = ["success", "failed_non_critical"]
+
+# pipes run after success.txt and the run's final metrics are written, so that they can archive them
+FINAL_PIPES = ["archive"]
+
+AcquisitionGroup = namedtuple('AcquisitionGroup', ['name', 'method_id', 'polarity', 'files'])
+
+
+def run_pipeline(config, settings, wild_cards, ignore_plan=False, configure_searches=False):
+    '''
+    Run every pipe of a config
+
+    Parameters
+    ----------
+    config : MzkitConfig
+      pipeline configuration, as read from the config file
+    settings : MzkitSettings
+      paths to the dataset, outputs and programming assets, and run settings
+    wild_cards : [str]
+      config overrides, e.g. pipeline.search.use=false
+    ignore_plan : bool
+      run even if the resource plan predicts that a required pipe will not fit in memory
+    configure_searches : bool
+      match an MSP library to the run's methodId, see MzkitConfig.configure_peakdetector_searches()
+
+    Returns
+    -------
+    run_status : str
+      success, failed_non_critical, critical_fail, error, invalid_config or plan_rejected
+    pipeline_status_dict : OrderedDict
+      status and timing of each pipe which ran
+    '''
+
+    pipeline_status_dict = OrderedDict()
+
+    # overwrite config with wild cards specifications and compile the validated, immutable run plan
+    try:
+        config.update_config(wild_cards)
+        if configure_searches:
+            config.configure_peakdetector_searches(settings)
+        run_plan = config.compile()
+    except Exception as e:
+        print(e)
+        print("Configuration is invalid - Exiting program.")
+        return "invalid_config", pipeline_status_dict
+
+    # save config
+    config.write_config(os.path.join(settings.run['output_folder'], 'config.json'))
+
+    # print a summary of the pipeline pipes (steps)
+    config.print_pipeline_summary()
+
+    # estimate runtime and memory from the inputs and earlier runs, and size module concurrency to fit
+    input_features = collect_input_features(settings.project_files, run_plan)
+    resource_plan = plan_resources(run_plan, settings, input_features)
+    print_resource_plan(resource_plan, settings)
+
+    blocking_estimates = resource_plan.blocking_estimates(run_plan)
+    if blocking_estimates and not ignore_plan:
+        for estimate in blocking_estimates:
+            print("required module %s (%s pipe) is expected to need %.1f GB, more than its memory budget" % (estimate.module, estimate.pipe, estimate.rss_bytes / 2 ** 30))
+        print("Run plan does not fit this node; rerun with --ignore-plan to run anyway. Exiting program.")
+        return "plan_rejected", pipeline_status_dict
+
+    # publish live progress and resource metrics while the pipeline runs
+    settings.telemetry.start(run_plan, settings, resource_plan)
+
+    method_id = run_plan.globals['methodId']
+
+    try:
+        print("=================================================")
+        print("mzkit_v2.py CONFIG PARAMETERS:")
+        print("use config pipeline search? " + str(run_plan.pipeline['search']['use']))
+        print("method id? " + str(method_id))
+        print("matching model? " + str(run_plan.modules['pipeline_standard_search']['parameters']['matching_model']))
+
+        print("use config pipeline search? " + str(run_plan.pipeline['search']['use'] is True))
+        print("method id is lipid search? " + str((method_id == 'M004A' or method_id == 'M005A')))
+        print("pipeline search is peakdetector_mzkitchen_search? " + str(
+            run_plan.modules['pipeline_standard_search']['parameters']['matching_model'] == 'peakdetector_mzkitchen_search'))
+        print("=================================================")
+    except KeyError:
+        print("mzkit_v2.py CONFIG PARAMETERS missing one or more keys.")
+
+    # archival pipes run last, once the output folder holds success.txt and the run's final metrics
+    final_pipes = [x for x in run_plan.pipeline.keys() if x in FINAL_PIPES]
+    pipes = [x for x in run_plan.pipeline.keys() if x not in FINAL_PIPES] + final_pipes
+
+    try:
+        for pipe in pipes:
+            try:
+
+                if final_pipes and pipe == final_pipes[0]:
+                    settings.py_context.close()
+                    create_success_file(pipeline_status_dict, settings)
+                    settings.telemetry.publish_status(get_run_status(pipeline_status_dict))
+
+                # iterate through steps in the pipeline
+                pipe_status_dict = run_pipe(run_plan, settings, pipe)
+
+                if pipe_status_dict['status']['critical_fail']:
+                    pipeline_status_dict[pipe] = pipe_status_dict
+                    record_run(pipeline_status_dict, run_plan, settings, input_features, "critical_fail")
+                    settings.telemetry.stop("critical_fail")
+                    remove_success_file(settings)
+                    print('pipeline stage \"' + pipe + '\" experienced a critical failure. Halting execution.')
+                    print('ERROR')
+                    return "critical_fail", pipeline_status_dict
+
+            except ValueError as e:
+                print("Unexpected ValueError occurred while executing mzkit pipeline. Halting execution.")
+                print('ERROR')
+                print(traceback.format_exception(None,  # <- type(e) by docs, but ignored
+                                                 e, e.__traceback__),
+                      file=sys.stderr, flush=True)
+                settings.telemetry.stop("error")
+                remove_success_file(settings)
+                return "error", pipeline_status_dict
+
+            except RuntimeError as e:
+                print("Unexpected runtime error occurred while executing mzkit pipeline. Halting execution.")
+                print('ERROR')
+                print(traceback.format_exception(None,  # <- type(e) by docs, but ignored
+                                                 e, e.__traceback__),
+                      file=sys.stderr, flush=True)
+                settings.telemetry.stop("error")
+                remove_success_file(settings)
+                return "error", pipeline_status_dict
+
+            pipeline_status_dict[pipe] = pipe_status_dict
+    finally:
+        # close the python modules' shared mzrollDB connection
+        settings.py_context.close()
+
+    if not final_pipes:
+        create_success_file(pipeline_status_dict, settings)
+    run_status = get_run_status(pipeline_status_dict)
+    record_run(pipeline_status_dict, run_plan, settings, input_features, run_status)
+    settings.telemetry.stop(run_status)
+
+    return run_status, pipeline_status_dict
+
+
+def get_run_status(pipeline_status_dict):
+    '''Status of a run whose pipes all ran without a critical failure'''
+
+    run_failed = any(x['status']['fail'] for x in pipeline_status_dict.values())
+
+    return "failed_non_critical" if run_failed else "success"
+
+
+def remove_success_file(settings):
+    '''Remove success.txt of a run which failed after it was written (or of an earlier run in the same folder)'''
+
+    success_file = os.path.join(settings.run['output_folder'], "success.txt")
+    if os.path.exists(success_file):
+        os.remove(success_file)
+
+
+class ThreadOutputRouter(object):
+    '''
+    File-like object which sends each thread's writes to the stream registered for it
+
+    Threads are matched by name; threads named "<name>:<suffix>" (e.g. the
+    output readers of a module process) write to the stream of <name>. Writes
+    from unregistered threads go to the default stream.
+    '''
+
+    def __init__(self, default):
+
+        self.default = default
+        self.streams = {}
+        self.lock = threading.Lock()
+
+        return
+
+    def register(self, thread_name, stream):
+        with self.lock:
+            self.streams[thread_name] = stream
+
+    def unregister(self, thread_name):
+        with self.lock:
+            self.streams.pop(thread_name, None)
+
+    def _stream(self):
+        return self.streams.get(threading.current_thread().name.split(":")[0], self.default)
+
+    def write(self, s):
+        return self._stream().write(s)
+
+    def flush(self):
+        return self._stream().flush()
+
+    def __getattr__(self, attr):
+        return getattr(self.default, attr)
+
+
+def group_project_files(project_files, default_method_id, default_mode, method_pattern):
+    '''
+    Group spectra files by the polarity and methodId in their headers
+
+    Files whose method or polarity cannot be read take the config's methodId
+    and mode. Polarity-switching files form their own "mixed" groups, which
+    keep the config's mode.
+
+    Returns
+    -------
+    groups : [AcquisitionGroup]
+      sorted by name
+    '''
+
+    grouped_files = OrderedDict()
+    for project_file in sorted(project_files):
+        polarity, method_id = read_acquisition_info(project_file, method_pattern)
+        key = (method_id or default_method_id, polarity or default_mode)
+        grouped_files.setdefault(key, []).append(project_file)
+
+    groups = [AcquisitionGroup("%s_%s" % key, key[0], key[1], files) for key, files in grouped_files.items()]
+
+    return sorted(groups, key=lambda x: x.name)
+
+
+def run_multiplexed(settings, args):
+    '''
+    Split a run's spectra files into groups by polarity and methodId and run each group as a sub-run
+
+    Each group gets a derived config (globals.methodId and globals.mode set
+    from the file headers, and the matching MSP library) and its own output
+    folder, <output_folder>/<methodId>_<polarity>. Groups run concurrently and
+    share the run's CPU and memory budget; their output goes to mzkit.log in
+    their folder and their metrics are published together, labeled by group.
+    A combined report is written to multiplex_report.tsv.
+
+    Parameters
+    ----------
+    settings : MzkitSettings
+      settings of the whole run
+    args : argparse.Namespace
+      command-line arguments passed to pipeline
+
+    Returns
+    -------
+    run_status : str
+      success if every group succeeded (non-critical failures allowed), else the first failed group's status
+    '''
+
+    config_path = settings.run['configfile']
+
+    # config defaults for files whose headers do not identify their method or polarity
+    try:
+        default_config = MzkitConfig(config_path)
+        default_config.update_config(args.wild_cards)
+    except Exception as e:
+        print(e)
+        print("Configuration file missing or unreadable - Exiting program.")
+        return "invalid_config"
+
+    groups = group_project_files(settings.project_files, default_config.globals['methodId'],
+                                 default_config.globals['mode'], args.method_pattern)
+
+    n_concurrent = min(len(groups), args.max_concurrent_groups or len(groups))
+    settings.resources.set_slots(n_concurrent)
+
+    print("=================================================")
+    print("MULTIPLEXED RUN: %d groups, %d at a time; budget %s" % (len(groups), n_concurrent, settings.resources))
+    group_settings = OrderedDict()
+    for group in groups:
+        print("%s\t%d files" % (group.name, len(group.files)))
+        try:
+            group_settings[group.name] = settings.derive(group.name, group.files)
+        except ValueError as e:
+            print(e)
+            return "invalid_data"
+    print("=================================================")
+
+    # sub-runs match their MSP library when they start; find missing libraries before any group runs
+    missing_libraries = check_search_libraries(config_path, groups, settings, args)
+    if missing_libraries:
+        for group_name, error in missing_libraries:
+            print("%s: %s" % (group_name, error))
+        print("No MSP library in %s for the methodId of %d group(s); pass --library-path with a folder of "
+              "*<methodId>*.msp files for the peakdetector_mzkitchen_search matching model - Exiting program." % (settings.program_settings['library_path'], len(missing_libraries)))
+        return "invalid_config"
+
+    publisher = MetricsPublisher([x.telemetry for x in group_settings.values()],
+                                 settings.telemetry.metrics_file, settings.telemetry.port)
+    publisher.start()
+
+    router = ThreadOutputRouter(sys.stdout)
+    sys.stdout = router
+
+    def run_group(group):
+
+        thread = threading.current_thread()
+        thread.name = "mzkit-" + group.name
+        start_time = datetime.now()
+
+        wild_cards = group_wild_cards(group, args)
+
+        with open(os.path.join(group_settings[group.name].run['output_folder'], "mzkit.log"), "w", buffering=1) as log:
+            router.register(thread.name, log)
+            try:
+                run_status, pipeline_status_dict = run_pipeline(MzkitConfig(config_path), group_settings[group.name], wild_cards,
+                                                                ignore_plan=args.ignore_plan, configure_searches=True)
+            except Exception:
+                traceback.print_exc(file=log)
+                run_status, pipeline_status_dict = "error", OrderedDict()
+            finally:
+                router.unregister(thread.name)
+
+        print("# %s finished: %s in %s" % (group.name, run_status, get_elapsed_time(start_time, datetime.now())))
+
+        return run_status, pipeline_status_dict, start_time, datetime.now()
+
+    try:
+        with ThreadPoolExecutor(max_workers=n_concurrent) as pool:
+            results = OrderedDict(zip([x.name for x in groups], pool.map(run_group, groups)))
+    finally:
+        sys.stdout = router.default
+        publisher.stop()
+
+    create_multiplex_report(groups, group_settings, results, os.path.join(settings.run['output_folder'], "multiplex_report.tsv"))
+
+    failed = [results[x.name][0] for x in groups if results[x.name][0] not in SUCCESS_STATUSES]
+
+    return failed[0] if failed else "success"
+
+
+def group_wild_cards(group, args):
+    '''Config overrides of a multiplexed group: the run's wild cards plus its methodId and polarity'''
+
+    wild_cards = list(args.wild_cards) + ["globals.methodId=" + group.method_id]
+    if group.polarity in ["positive", "negative"]:
+        wild_cards.append("globals.mode=" + group.polarity)
+
+    return wild_cards
+
+
+def check_search_libraries(config_path, groups, settings, args):
+    '''
+    Match each multiplexed group's MSP library as its sub-run will, without running anything
+
+    Returns [(group name, error)] of the groups whose search would not find a
+    library, e.g. because the default library folder (libraries in the output
+    folder) is still empty.
+    '''
+
+    missing = []
+    for group in groups:
+        config = MzkitConfig(config_path)
+        config.update_config(group_wild_cards(group, args))
+        try:
+            config.configure_peakdetector_searches(settings)
+        except MspFileMissingException as e:
+            missing.append((group.name, str(e)))
+
+    return missing
+
+
+def create_multiplex_report(groups, group_settings, results, out_path):
+    '''Write and print each group's status, files and timing, and the per-module timing of its pipes'''
+
+    with open(out_path, "w", newline="") as f:
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        writer.writerow(["group", "methodId", "polarity", "n_files", "status", "elapsed", "pipe", "module", "message", "seconds", "max_rss_bytes"])
+
+        for group in groups:
+            run_status, pipeline_status_dict, start_time, end_time = results[group.name]
+            group_row = [group.name, group.method_id, group.polarity, len(group.files), run_status, get_elapsed_time(start_time, end_time)]
+
+            module_rows = [[pipe, module, module_timing_dict['message'],
+                            (module_timing_dict.get('usage') or {}).get('seconds', ""),
+                            (module_timing_dict.get('usage') or {}).get('max_rss_bytes', "")]
+                           for pipe, pipe_status_dict in pipeline_status_dict.items()
+                           for module, module_timing_dict in pipe_status_dict['timing_dict'].items()]
+
+            for module_row in module_rows or [["", "", "", "", ""]]:
+                writer.writerow(group_row + module_row)
+
+    print("=================================================")
+    print("GROUP\tFILES\tSTATUS\tELAPSED\tOUTPUT")
+    for group in groups:
+        run_status, _, start_time, end_time = results[group.name]
+        print("%s\t%d\t%s\t%s\t%s" % (group.name, len(group.files), run_status, get_elapsed_time(start_time, end_time),
+                                      group_settings[group.name].run['output_folder']))
+    print("# Combined report: " + out_path)
+    print("=================================================")
+
+    return
@@ -0,0 +1,270 @@
+import os
+import statistics
+from collections import namedtuple
+
+from perfdb import read_module_history
+from utils import read_scan_count
+
+# uncalibrated cost model by module language; history from earlier runs rescales these estimates
+#   seconds_per_file: per-sample overhead (reading headers, writing per-sample results), not parallelized
+#   seconds_per_gb: single-worker runtime per GB of (intensity and ms2 adjusted) spectra
+#   parallel_efficiency: runtime scales with n_workers ** -parallel_efficiency
+#   rss_fixed_gb / rss_per_gb: peak RSS = fixed + per_gb * (largest file, or all files if rss_basis is total)
+#   rss_per_worker: whether every worker holds its own copy of the per_gb part
+DEFAULT_COST_MODEL = {
+    "bin": {"seconds_fixed": 10, "seconds_per_file": 2, "seconds_per_gb": 600, "parallel_efficiency": 0.8,
+            "rss_fixed_gb": 0.5, "rss_per_gb": 3.0, "rss_basis": "max_file", "rss_per_worker": False},
+    "R": {"seconds_fixed": 30, "seconds_per_file": 1, "seconds_per_gb": 120, "parallel_efficiency": 0.5,
+          "rss_fixed_gb": 1.0, "rss_per_gb": 0.5, "rss_basis": "total", "rss_per_worker": False},
+    "py": {"seconds_fixed": 1, "seconds_per_file": 0.05, "seconds_per_gb": 60, "parallel_efficiency": 0.9,
+           "rss_fixed_gb": 0.2, "rss_per_gb": 1.5, "rss_basis": "max_file", "rss_per_worker": True}
+    }
+
+# number of recent runs of a module used for calibration, and needed before a plan is trusted to stop a run
+HISTORY_WINDOW = 20
+MIN_HISTORY_TO_ENFORCE = 3
+
+# scans per GB of a typical spectra file; converts header scan counts to the cost model's GB of work
+REFERENCE_SCANS_PER_GB = 10000
+
+# margins on calibrated estimates when they size a module's batch jobs
+BATCH_MEMORY_HEADROOM = 1.5
+BATCH_TIME_HEADROOM = 2.0
+
+InputFeatures = namedtuple('InputFeatures', ['n_files', 'total_bytes', 'max_file_bytes', 'n_scans', 'minintensity', 'ms2'])
+
+# memory (bytes) and time limit (seconds) requested by a module's batch jobs
+JobRequest = namedtuple('JobRequest', ['memory_bytes', 'seconds'])
+
+ModuleEstimate = namedtuple('ModuleEstimate', ['pipe', 'module', 'language', 'n_workers',
+                                               'seconds', 'rss_bytes', 'n_history', 'fits'])
+
+
+class ResourcePlan(object):
+    '''
+    Estimated runtime and peak memory of every module which will run
+
+    Attributes
+    ----------
+    features : InputFeatures
+        summary of the run's inputs which the estimates are based on
+    estimates : [ModuleEstimate]
+        one estimate per module of each used pipe, in pipeline order
+    '''
+
+    def __init__(self, features, estimates):
+
+        self.features = features
+        self.estimates = estimates
+
+        return
+
+    @property
+    def seconds(self):
+        return sum(x.seconds for x in self.estimates)
+
+    @property
+    def peak_rss_bytes(self):
+        return max([x.rss_bytes for x in self.estimates] + [0])
+
+    def blocking_estimates(self, run_plan):
+        '''Estimates of required pipes which will not fit in memory and are backed by enough history to trust'''
+
+        return [x for x in self.estimates
+                if not x.fits and x.n_history >= MIN_HISTORY_TO_ENFORCE and run_plan.pipeline[x.pipe]['required']]
+
+
+def collect_input_features(project_files, run_plan):
+    '''Summarize the size of a run's inputs, reading only spectra file headers, and the peakdetector parameters which scale its work'''
+
+    file_sizes = [os.path.getsize(x) for x in project_files]
+
+    # files without a declared count are assumed to have the scan density of those with one
+    scan_counts = [read_scan_count(x) for x in project_files]
+    known = [(count, size) for count, size in zip(scan_counts, file_sizes) if count is not None]
+    if known:
+        scans_per_byte = sum(x[0] for x in known) / max(sum(x[1] for x in known), 1)
+        n_scans = int(sum(count if count is not None else size * scans_per_byte for count, size in zip(scan_counts, file_sizes)))
+    else:
+        n_scans = None
+
+    peakdetector_parameters = run_plan.modules['peakdetector']['parameters'] if 'peakdetector' in run_plan.modules else {}
+
+    return InputFeatures(n_files=len(project_files),
+                         total_bytes=sum(file_sizes),
+                         max_file_bytes=max(file_sizes + [0]),
+                         n_scans=n_scans,
+                         minintensity=float(peakdetector_parameters.get('minintensity', 10000) or 10000),
+                         ms2=float(peakdetector_parameters.get('ms2', 0) or 0))
+
+
+def _work_gb(features):
+    '''
+    GB of spectra, scaled up for low intensity thresholds (more features) and ms2 processing
+
+    Bytes per scan vary widely between profile and centroid data and between
+    encodings, so the scan count declared in the file headers measures the
+    work when it is known; it is converted to GB at REFERENCE_SCANS_PER_GB.
+    '''
+
+    intensity_factor = (10000 / max(features.minintensity, 1)) ** 0.25
+    ms2_factor = 1.25 if features.ms2 != 0 else 1.0
+
+    if features.n_scans:
+        spectra_gb = features.n_scans / REFERENCE_SCANS_PER_GB
+    else:
+        spectra_gb = features.total_bytes / 2 ** 30
+
+    return spectra_gb * intensity_factor * ms2_factor
+
+
+def default_estimate(language, features, n_workers):
+    '''Uncalibrated (seconds, peak RSS bytes) of a module'''
+
+    model = DEFAULT_COST_MODEL.get(language, DEFAULT_COST_MODEL["bin"])
+
+    seconds = (model["seconds_fixed"] + model["seconds_per_file"] * features.n_files +
+               model["seconds_per_gb"] * _work_gb(features) / n_workers ** model["parallel_efficiency"])
+
+    basis_bytes = features.max_file_bytes if model["rss_basis"] == "max_file" else features.total_bytes
+    variable_gb = model["rss_per_gb"] * basis_bytes / 2 ** 30
+    if model["rss_per_worker"]:
+        variable_gb = variable_gb * n_workers
+
+    return seconds, int((model["rss_fixed_gb"] + variable_gb) * 2 ** 30)
+
+
+def calibration(pipe, module, language, history):
+    '''
+    Median ratio of observed to default-model runtime and peak RSS over a module's recent runs in a pipe
+
+    Returns (runtime ratio, RSS ratio, number of runs used).
+    '''
+
+    records = [x for x in history if x.get('pipe') == pipe and x.get('module') == module and x.get('seconds')][-HISTORY_WINDOW:]
+    if not records:
+        return 1.0, 1.0, 0
+
+    time_ratios = []
+    rss_ratios = []
+    for record in records:
+        features = InputFeatures(**record['features'])
+        seconds, rss_bytes = default_estimate(language, features, max(record.get('n_workers', 1), 1))
+        time_ratios.append(record['seconds'] / seconds)
+        if record.get('max_rss_bytes'):
+            rss_ratios.append(record['max_rss_bytes'] / rss_bytes)
+
+    return statistics.median(time_ratios), statistics.median(rss_ratios) if rss_ratios else 1.0, len(records)
+
+
+def plan_resources(run_plan, settings, features, history=None):
+    '''
+    Estimate every used module's runtime and peak RSS, choose its concurrency and size its batch jobs
+
+    Each module starts from its share of the resource budget and gives up workers
+    until its estimated peak RSS fits the memory budget. The chosen worker counts
+    become the modules' defaults in settings.planned_workers, keyed by (pipe,
+    module) since a module may run in several pipes (n_workers set in a module's
+    parameters still takes precedence). Modules whose estimates are calibrated by
+    at least MIN_HISTORY_TO_ENFORCE earlier runs also get a JobRequest in
+    settings.planned_jobs: their batch jobs request the estimated peak RSS and
+    runtime with some headroom rather than the whole memory share and the
+    scheduler's default time limit. Each multiplexed group keeps its own plan.
+
+    Parameters
+    ----------
+    run_plan : RunPlan
+      validated pipeline plan
+    settings : MzkitSettings
+      paths to the dataset, outputs and programming assets, and run settings
+    features : InputFeatures
+      summary of the run's inputs, see collect_input_features()
+    history : [dict]
+      per-module records of earlier runs; read from the performance database by default
+
+    Returns
+    -------
+    plan : ResourcePlan
+    '''
+
+    if history is None:
+        history = read_module_history()
+
+    resources = settings.resources
+    memory_bytes = resources.memory_bytes
+
+    estimates = []
+    for pipe, pipe_dict in run_plan.pipeline.items():
+        if not pipe_dict['use']:
+            continue
+
+        for module in pipe_dict['modules']:
+            module_dict = run_plan.modules[module]
+            language = module_dict['language']
+            parameters = module_dict['parameters']
+
+            time_ratio, rss_ratio, n_history = calibration(pipe, module, language, history)
+            n_workers, module_memory_bytes = resources.share(parameters)
+            if module_memory_bytes is None:
+                module_memory_bytes = memory_bytes
+
+            def calibrated(n):
+                seconds, rss_bytes = default_estimate(language, features, n)
+                return seconds * time_ratio, int(rss_bytes * rss_ratio)
+
+            seconds, rss_bytes = calibrated(n_workers)
+            # only workers whose memory was not set explicitly are reduced to fit
+            if not parameters.get('n_workers') and module_memory_bytes is not None:
+                while n_workers > 1 and rss_bytes > module_memory_bytes:
+                    fewer_seconds, fewer_rss_bytes = calibrated(n_workers - 1)
+                    if fewer_rss_bytes >= rss_bytes:
+                        break
+                    n_workers -= 1
+                    seconds, rss_bytes = fewer_seconds, fewer_rss_bytes
+                settings.planned_workers[(pipe, module)] = n_workers
+
+            fits = module_memory_bytes is None or rss_bytes <= module_memory_bytes
+
+            if n_history >= MIN_HISTORY_TO_ENFORCE:
+                job_memory_bytes = int(rss_bytes * BATCH_MEMORY_HEADROOM)
+                if module_memory_bytes is not None:
+                    job_memory_bytes = min(job_memory_bytes, module_memory_bytes)
+                settings.planned_jobs[(pipe, module)] = JobRequest(job_memory_bytes, seconds * BATCH_TIME_HEADROOM)
+
+            estimates.append(ModuleEstimate(pipe, module, language, n_workers, seconds, rss_bytes, n_history, fits))
+
+    return ResourcePlan(features, estimates)
+
+
+def format_seconds(seconds):
+
+    hours, remainder = divmod(int(round(seconds)), 3600)
+    minutes, seconds = divmod(remainder, 60)
+
+    return '{:03}hr {:02}m {:02}s'.format(hours, minutes, seconds)
+
+
+def print_resource_plan(plan, settings):
+    '''Prints estimated runtime, memory and concurrency, in the style of MzkitConfig.print_pipeline_summary()'''
+
+    features = plan.features
+
+    max_name_char = max([len(x.pipe) + len(x.module) + 1 for x in plan.estimates] + [6])
+
+    print("=================================================")
+    scans_str = "unknown" if features.n_scans is None else str(features.n_scans)
+
+    print("RESOURCE PLAN: %d files, %.2f GB, %s scans; budget %s" % (features.n_files, features.total_bytes / 2 ** 30, scans_str, settings.resources))
+    print("MODULE" + " " * (max_name_char - 3) + "WORKERS\tEST TIME\t\tEST RSS\tRUNS")
+
+    for estimate in plan.estimates:
+        name = estimate.pipe + "/" + estimate.module
+        padding = " " * (max_name_char + 3 - len(name))
+        fits_str = "" if estimate.fits else "\tEXCEEDS MEMORY"
+        print(name + padding + "%d\t%s\t%.1f GB\t%d%s" % (estimate.n_workers, format_seconds(estimate.seconds),
+                                                        estimate.rss_bytes / 2 ** 30, estimate.n_history, fits_str))
+
+    print("Estimated total: " + format_seconds(plan.seconds) + ", peak RSS %.1f GB" % (plan.peak_rss_bytes / 2 ** 30))
+    print("=================================================")
+
+    return
@@ -0,0 +1,214 @@
+import importlib
+import multiprocessing
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+# entry point group through which installed packages register python modules, e.g. in setup.cfg:
+#   [options.entry_points]
+#   mzkit.modules =
+#       my_step = my_package.steps:run_my_step
+PY_MODULE_ENTRY_POINT_GROUP = "mzkit.modules"
+
+# python modules of this repository; targets are imported when a module is first run so that
+# their dependencies (e.g., numpy) are only required by runs which use them
+BUILTIN_PY_MODULES = OrderedDict([
+    ("mzkit_qc", "qc:run_qc"),
+    ("mzkit_columnar_export", "export:run_columnar_export"),
+    ("mzrolldb_tuning", "mzrolldb:run_mzrolldb_tuning"),
+    ("mzkit_alignment", "alignment:run_alignment"),
+    ("mzkit_coelution", "coelution:run_coelution"),
+    ("mzkit_split_peaks", "splitting:run_split_peak_aggregation"),
+    ("mzkit_archive", "archive:run_archive"),
+    ("mzkit_library_export", "library:run_library_export"),
+    ("mzkit_targeted_extraction", "targeted:run_targeted_extraction")
+    ])
+
+# how python modules start worker processes: the driver runs threads (multiplexed sub-runs, telemetry, the
+# metrics publisher), and a forked worker may inherit a lock another thread held, e.g. of stdout or logging
+WORKER_START_METHOD = "spawn"
+
+_registered_py_modules = OrderedDict(BUILTIN_PY_MODULES)
+_loaded_py_modules = {}
+_registry_lock = threading.Lock()
+
+
+def register_py_module(name, target):
+    '''
+    Register a python module under a name used in configs
+
+    Parameters
+    ----------
+    name : str
+      module name, as used in the config's modules and pipeline
+    target : callable or str
+      function called as target(module_dict, settings), or its "package.module:function" path
+    '''
+
+    with _registry_lock:
+        _registered_py_modules[name] = target
+        _loaded_py_modules.pop(name, None)
+
+    return
+
+
+def _entry_points():
+
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        return []
+
+    eps = entry_points()
+    # entry_points() returns a dict of groups before python 3.10
+    if hasattr(eps, "select"):
+        return list(eps.select(group=PY_MODULE_ENTRY_POINT_GROUP))
+    return list(eps.get(PY_MODULE_ENTRY_POINT_GROUP, []))
+
+
+def py_module_names():
+    '''Names of the registered python modules, including those of installed entry points'''
+
+    return list(OrderedDict.fromkeys(list(_registered_py_modules.keys()) + [x.name for x in _entry_points()]))
+
+
+def load_py_module(name):
+    '''
+    The function which runs a python module
+
+    Modules registered with register_py_module() (including this repository's)
+    take precedence over installed entry points. Loaded functions are cached.
+
+    Raises
+    ------
+    ValueError
+      if no python module is registered under name
+    ImportError
+      if the module's code or one of its dependencies cannot be imported
+    '''
+
+    with _registry_lock:
+        if name in _loaded_py_modules:
+            return _loaded_py_modules[name]
+
+        target = _registered_py_modules.get(name)
+        if target is None:
+            entry_points = [x for x in _entry_points() if x.name == name]
+            if not entry_points:
+                raise ValueError("%s doesn't have a defined python implementation" % name)
+            function = entry_points[0].load()
+        elif callable(target):
+            function = target
+        else:
+            module_path, _, attribute = target.partition(":")
+            function = getattr(importlib.import_module(module_path), attribute)
+
+        _loaded_py_modules[name] = function
+
+    return function
+
+
+def process_pool(n_workers):
+    '''Pool of n_workers worker processes for a python module, started with WORKER_START_METHOD'''
+
+    return ProcessPoolExecutor(max_workers=max(int(n_workers), 1), mp_context=multiprocessing.get_context(WORKER_START_METHOD))
+
+
+class PyModuleContext(object):
+    '''
+    State shared by the python modules of a run, which all run in the driver process
+
+    Python modules which run one after another share a single open mzrollDB
+    connection and memory-mapped arrays instead of reopening and re-reading
+    them. The connection is in autocommit mode (isolation_level=None), so
+    modules group their writes with transaction(). It is closed before any bin
+    or R module runs (those processes may rewrite the mzrollDB) and when the
+    run finishes, and is reopened if the file is replaced.
+    '''
+
+    def __init__(self):
+
+        self.conn = None
+        self.conn_path = None
+        self.conn_identity = None
+        self.arrays = {}
+        self.lock = threading.Lock()
+
+        return
+
+    @staticmethod
+    def _file_identity(path):
+        stat = os.stat(path)
+        return stat.st_dev, stat.st_ino
+
+    def mzrolldb(self, path):
+        '''Open connection to an mzrollDB, shared with the python modules which run before and after'''
+
+        with self.lock:
+            identity = self._file_identity(path)
+            if self.conn is not None and (self.conn_path != os.path.abspath(path) or self.conn_identity != identity):
+                self._close_connection()
+
+            if self.conn is None:
+                # modules may hand the connection to their own threads (e.g., arrow's writer)
+                self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+                self.conn_path = os.path.abspath(path)
+                self.conn_identity = identity
+
+            return self.conn
+
+    @contextmanager
+    def transaction(self, conn):
+        '''Run a block of writes in one transaction of a shared connection, rolled back if the block raises'''
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def array(self, path):
+        '''Read-only memory map of a .npy array, shared until the file changes'''
+
+        import numpy as np
+
+        with self.lock:
+            stat = os.stat(path)
+            key = os.path.abspath(path)
+            state = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            if key not in self.arrays or self.arrays[key][0] != state:
+                self.arrays[key] = (state, np.load(path, mmap_mode='r'))
+
+            return self.arrays[key][1]
+
+    def after_module(self):
+        '''Roll back a transaction left open by a failed module, so the next module starts clean'''
+
+        with self.lock:
+            if self.conn is not None and self.conn.in_transaction:
+                self.conn.execute("ROLLBACK")
+
+    def _close_connection(self):
+
+        if self.conn is not None:
+            if self.conn.in_transaction:
+                self.conn.execute("ROLLBACK")
+            self.conn.close()
+        self.conn = None
+        self.conn_path = None
+        self.conn_identity = None
+
+    def close(self):
+        '''Close the shared connection and release memory maps'''
+
+        with self.lock:
+            self._close_connection()
+            self.arrays = {}
+
+        return
@@ -0,0 +1,410 @@
+import csv
+import gzip
+import os
+from concurrent.futures import as_completed
+
+import numpy as np
+
+from pymodules import process_pool
+from spectra import iter_scans, sample_name
+from utils import PipelineFailedException, parse_ppm_tolerance, parse_mz_list
+
+# log10(intensity) histogram bins shared by all samples so they can be compared directly
+INTENSITY_BIN_EDGES = np.linspace(0, 12, 121)
+
+
+def run_qc(module_dict, settings):
+    '''
+    Streaming QC of all spectra files in a run
+
+    Each file is read exactly once, in parallel across files, and summarized as
+    TIC/BPC traces, an MS1 intensity distribution and the mass and retention time
+    of a set of landmark ions. Landmarks are the `internal_standards` m/z values and,
+    when `referenceSample` is part of the run, the most intense ions of the
+    reference sample. The reference is summarized first so that its landmarks can
+    be tracked in every other sample.
+
+    Summaries are written to the QC folder of the output folder.
+
+    Parameters
+    ----------
+    module_dict : dict
+      module configuration and name; parameters are merged with globals
+    settings : MzkitSettings
+      paths to the dataset, outputs and programming assets, and run settings
+    '''
+
+    parameters = module_dict['parameters']
+
+    ppm = parse_ppm_tolerance(parameters['MS1tol'])
+    standards_mz = parse_mz_list(parameters.get('internal_standards', ""))
+    n_landmarks = int(parameters.get('n_reference_landmarks', 20))
+    n_workers = int(parameters.get('n_workers', 0)) or os.cpu_count()
+
+    qc_folder = os.path.join(settings.run['output_folder'], "QC")
+
+    project_files = sorted(settings.project_files)
+    reference_path = find_reference_sample(project_files, parameters.get('referenceSample', ""))
+
+    summaries = OrderedSummaries()
+    landmarks_mz = standards_mz
+
+    if reference_path is not None:
+        print("# QC reference sample: " + reference_path)
+        reference_summary = summarize_spectra_file(reference_path, standards_mz, ppm)
+        summaries.add(reference_summary)
+
+        add_reference_landmarks(reference_summary, n_landmarks, ppm)
+        landmarks_mz = reference_summary['landmarks_mz']
+    else:
+        print("# No QC reference sample found; mass and RT drift will only be reported for internal standards")
+
+    remaining_files = [x for x in project_files if x != reference_path]
+
+    with process_pool(n_workers) as pool:
+        futures = {pool.submit(summarize_spectra_file, path, landmarks_mz, ppm): path for path in remaining_files}
+
+        for n_done, future in enumerate(as_completed(futures), start=len(summaries) + 1):
+            try:
+                summaries.add(future.result())
+            except Exception as e:
+                print("# QC failed for " + futures[future] + ": " + str(e))
+            settings.telemetry.report_progress(module_dict['module'], n_done, len(project_files))
+
+    if len(summaries) == 0:
+        raise PipelineFailedException("QC could not summarize any spectra files")
+
+    reference_summary = summaries.get(reference_path)
+
+    write_sample_summary(summaries, reference_summary, standards_mz, os.path.join(qc_folder, "qc_sample_summary.tsv"))
+    write_landmark_summary(summaries, reference_summary, standards_mz, os.path.join(qc_folder, "qc_landmarks.tsv"))
+    write_intensity_histograms(summaries, os.path.join(qc_folder, "qc_intensity_histograms.tsv"))
+    write_traces(summaries, os.path.join(qc_folder, "qc_traces.tsv.gz"))
+
+    print("# QC summarized " + str(len(summaries)) + " of " + str(len(project_files)) + " samples")
+
+    return
+
+
+class OrderedSummaries(object):
+    '''Per-sample summaries keyed by file path and iterated in sample name order'''
+
+    def __init__(self):
+        self.summaries = {}
+
+    def __len__(self):
+        return len(self.summaries)
+
+    def __iter__(self):
+        return iter(sorted(self.summaries.values(), key=lambda x: x['sample']))
+
+    def add(self, summary):
+        self.summaries[summary['path']] = summary
+
+    def get(self, path):
+        return self.summaries.get(path)
+
+
+def find_reference_sample(project_files, reference_sample):
+    '''Returns the project file matching referenceSample (by file name or sample name), if any'''
+
+    if not reference_sample:
+        return None
+
+    for path in project_files:
+        if os.path.basename(path) == reference_sample or sample_name(path) == sample_name(reference_sample):
+            return path
+
+    return None
+
+
+def summarize_spectra_file(path, landmarks_mz, ppm):
+    '''
+    Summarize a spectra file in a single pass
+
+    Parameters
+    ----------
+    path : str
+      path to a .mzML or .mzXML file
+    landmarks_mz : np.ndarray
+      m/z values whose mass accuracy and elution should be tracked
+    ppm : float
+      mass tolerance used to match landmarks
+
+    Returns
+    -------
+    summary : dict
+      scan counts, MS1 TIC/BPC traces, an MS1 log10 intensity histogram and the
+      landmark ions' apex RT, apex intensity and observed m/z (NaN when not found)
+    '''
+
+    landmarks_mz = np.asarray(landmarks_mz, dtype=np.float64)
+    n_landmarks = landmarks_mz.size
+
+    lower_mz = landmarks_mz * (1 - ppm * 1e-6)
+    upper_mz = landmarks_mz * (1 + ppm * 1e-6)
+
+    rts = []
+    tics = []
+    bpcs = []
+    bpc_mzs = []
+    histogram = np.zeros(INTENSITY_BIN_EDGES.size - 1, dtype=np.int64)
+    n_scans = 0
+    n_ms2 = 0
+
+    apex_intensity = np.zeros(n_landmarks)
+    apex_rt = np.full(n_landmarks, np.nan)
+    apex_mz = np.full(n_landmarks, np.nan)
+
+    for scan in iter_scans(path):
+        n_scans += 1
+        if scan.ms_level != 1:
+            n_ms2 += 1
+            continue
+
+        rts.append(scan.rt)
+        if scan.intensity.size == 0:
+            tics.append(0.0)
+            bpcs.append(0.0)
+            bpc_mzs.append(0.0)
+            continue
+
+        base_peak = np.argmax(scan.intensity)
+        tics.append(scan.intensity.sum())
+        bpcs.append(scan.intensity[base_peak])
+        bpc_mzs.append(scan.mz[base_peak])
+
+        positive = scan.intensity[scan.intensity > 0]
+        histogram += np.histogram(np.log10(positive), bins=INTENSITY_BIN_EDGES)[0]
+
+        if n_landmarks == 0:
+            continue
+
+        # most intense centroid within tolerance of each landmark
+        starts = np.searchsorted(scan.mz, lower_mz, side='left')
+        ends = np.searchsorted(scan.mz, upper_mz, side='right')
+        for i in np.nonzero(ends > starts)[0]:
+            window = scan.intensity[starts[i]:ends[i]]
+            best = starts[i] + np.argmax(window)
+            if scan.intensity[best] > apex_intensity[i]:
+                apex_intensity[i] = scan.intensity[best]
+                apex_rt[i] = scan.rt
+                apex_mz[i] = scan.mz[best]
+
+    return {
+        'path': path,
+        'sample': sample_name(path),
+        'n_scans': n_scans,
+        'n_ms1': len(rts),
+        'n_ms2': n_ms2,
+        'rt': np.asarray(rts, dtype=np.float32),
+        'tic': np.asarray(tics, dtype=np.float64),
+        'bpc': np.asarray(bpcs, dtype=np.float64),
+        'bpc_mz': np.asarray(bpc_mzs, dtype=np.float64),
+        'intensity_histogram': histogram,
+        'landmarks_mz': landmarks_mz,
+        'apex_intensity': apex_intensity,
+        'apex_rt': apex_rt,
+        'apex_mz': apex_mz
+        }
+
+
+def add_reference_landmarks(reference_summary, n_landmarks, ppm):
+    '''
+    Add the reference sample's base peak ions to its landmarks
+
+    The most intense base peaks are taken greedily, skipping ions within the mass
+    tolerance of an existing landmark, so landmarks are distinct ions. Their
+    observed m/z, RT and intensity in the reference are read from the BPC trace.
+    '''
+
+    order = np.argsort(reference_summary['bpc'])[::-1]
+
+    selected = []
+    selected_mz = list(reference_summary['landmarks_mz'])
+    for i in order:
+        if len(selected) >= n_landmarks:
+            break
+
+        mz = reference_summary['bpc_mz'][i]
+        if mz <= 0:
+            continue
+        if any(abs(mz - x) / mz * 1e6 <= ppm for x in selected_mz):
+            continue
+
+        selected.append(i)
+        selected_mz.append(mz)
+
+    selected = np.asarray(selected, dtype=np.int64)
+
+    reference_summary['landmarks_mz'] = np.concatenate([reference_summary['landmarks_mz'], reference_summary['bpc_mz'][selected]])
+    reference_summary['apex_mz'] = np.concatenate([reference_summary['apex_mz'], reference_summary['bpc_mz'][selected]])
+    reference_summary['apex_rt'] = np.concatenate([reference_summary['apex_rt'], reference_summary['rt'][selected]])
+    reference_summary['apex_intensity'] = np.concatenate([reference_summary['apex_intensity'], reference_summary['bpc'][selected]])
+
+    return
+
+
+def histogram_quantile(histogram, quantile):
+    '''Approximate an intensity quantile from a log10 intensity histogram'''
+
+    total = histogram.sum()
+    if total == 0:
+        return np.nan
+
+    cumulative = np.cumsum(histogram)
+    i = int(np.searchsorted(cumulative, quantile * total))
+
+    return 10 ** INTENSITY_BIN_EDGES[i + 1]
+
+
+def ppm_difference(observed_mz, expected_mz):
+    return (observed_mz - expected_mz) / expected_mz * 1e6
+
+
+def landmark_deviations(summary, reference_summary, standards_mz):
+    '''
+    Mass and retention time deviations of a sample's landmarks
+
+    Internal standards are compared against their theoretical m/z; all landmarks
+    are compared against the observed m/z and apex RT in the reference sample.
+    '''
+
+    n_standards = len(standards_mz)
+    landmarks_mz = summary['landmarks_mz']
+
+    theoretical_ppm = np.full(landmarks_mz.size, np.nan)
+    theoretical_ppm[:n_standards] = ppm_difference(summary['apex_mz'][:n_standards], landmarks_mz[:n_standards])
+
+    reference_ppm = np.full(landmarks_mz.size, np.nan)
+    rt_shift = np.full(landmarks_mz.size, np.nan)
+    if reference_summary is not None:
+        # landmarks are aligned by position; samples share the reference's landmarks
+        n_shared = min(reference_summary['landmarks_mz'].size, landmarks_mz.size)
+        reference_ppm[:n_shared] = ppm_difference(summary['apex_mz'][:n_shared], reference_summary['apex_mz'][:n_shared])
+        rt_shift[:n_shared] = summary['apex_rt'][:n_shared] - reference_summary['apex_rt'][:n_shared]
+
+    return theoretical_ppm, reference_ppm, rt_shift
+
+
+def _nan_median(values):
+    values = values[np.isfinite(values)]
+    if values.size == 0:
+        return np.nan
+    return float(np.median(values))
+
+
+def _mass_drift(apex_rt, ppm_errors):
+    '''Slope of mass error (ppm) against retention time (min), NaN when under-determined'''
+
+    finite = np.isfinite(apex_rt) & np.isfinite(ppm_errors)
+    if np.count_nonzero(finite) < 3 or np.ptp(apex_rt[finite]) == 0:
+        return np.nan
+
+    return float(np.polyfit(apex_rt[finite], ppm_errors[finite], 1)[0])
+
+
+def _format(value):
+    if isinstance(value, (float, np.floating)):
+        return "NA" if not np.isfinite(value) else "%.6g" % value
+    return str(value)
+
+
+def write_sample_summary(summaries, reference_summary, standards_mz, out_path):
+
+    header = ["sample", "is_reference", "n_scans", "n_ms1", "n_ms2", "rt_min", "rt_max",
+              "tic_total", "tic_median", "bpc_max",
+              "intensity_p05", "intensity_p50", "intensity_p95",
+              "standards_found", "standards_ppm_median", "standards_ppm_drift_per_min",
+              "reference_ppm_median", "reference_ppm_drift_per_min", "reference_rt_shift_median"]
+
+    with open(out_path, "w", newline="") as f:
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        writer.writerow(header)
+
+        for summary in summaries:
+            theoretical_ppm, reference_ppm, rt_shift = landmark_deviations(summary, reference_summary, standards_mz)
+            rt = summary['rt']
+            histogram = summary['intensity_histogram']
+
+            writer.writerow([_format(x) for x in [
+                summary['sample'],
+                reference_summary is not None and summary['path'] == reference_summary['path'],
+                summary['n_scans'],
+                summary['n_ms1'],
+                summary['n_ms2'],
+                float(rt.min()) if rt.size else np.nan,
+                float(rt.max()) if rt.size else np.nan,
+                float(summary['tic'].sum()),
+                float(np.median(summary['tic'])) if rt.size else np.nan,
+                float(summary['bpc'].max()) if rt.size else np.nan,
+                histogram_quantile(histogram, 0.05),
+                histogram_quantile(histogram, 0.5),
+                histogram_quantile(histogram, 0.95),
+                int(np.count_nonzero(np.isfinite(theoretical_ppm))),
+                _nan_median(theoretical_ppm),
+                _mass_drift(summary['apex_rt'], theoretical_ppm),
+                _nan_median(reference_ppm),
+                _mass_drift(summary['apex_rt'], reference_ppm),
+                _nan_median(rt_shift)
+                ]])
+
+    return
+
+
+def write_landmark_summary(summaries, reference_summary, standards_mz, out_path):
+
+    n_standards = len(standards_mz)
+
+    with open(out_path, "w", newline="") as f:
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        writer.writerow(["sample", "landmark_type", "landmark_mz", "apex_rt", "apex_intensity", "observed_mz",
+                         "ppm_error", "reference_ppm_difference", "reference_rt_shift"])
+
+        for summary in summaries:
+            theoretical_ppm, reference_ppm, rt_shift = landmark_deviations(summary, reference_summary, standards_mz)
+
+            for i, landmark_mz in enumerate(summary['landmarks_mz']):
+                writer.writerow([_format(x) for x in [
+                    summary['sample'],
+                    "internal_standard" if i < n_standards else "reference_landmark",
+                    float(landmark_mz),
+                    float(summary['apex_rt'][i]),
+                    float(summary['apex_intensity'][i]),
+                    float(summary['apex_mz'][i]),
+                    float(theoretical_ppm[i]),
+                    float(reference_ppm[i]),
+                    float(rt_shift[i])
+                    ]])
+
+    return
+
+
+def write_intensity_histograms(summaries, out_path):
+
+    with open(out_path, "w", newline="") as f:
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        writer.writerow(["sample", "log10_intensity_min", "log10_intensity_max", "count"])
+
+        for summary in summaries:
+            histogram = summary['intensity_histogram']
+            for i in np.nonzero(histogram)[0]:
+                writer.writerow([summary['sample'],
+                                 "%.1f" % INTENSITY_BIN_EDGES[i],
+                                 "%.1f" % INTENSITY_BIN_EDGES[i + 1],
+                                 int(histogram[i])])
+
+    return
+
+
+def write_traces(summaries, out_path):
+
+    with gzip.open(out_path, "wt", newline="") as f:
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        writer.writerow(["sample", "rt", "tic", "bpc", "bpc_mz"])
+
+        for summary in summaries:
+            for rt, tic, bpc, bpc_mz in zip(summary['rt'], summary['tic'], summary['bpc'], summary['bpc_mz']):
+                writer.writerow([summary['sample'], "%.4f" % rt, "%.6g" % tic, "%.6g" % bpc, "%.5f" % bpc_mz])
+
+    return
@@ -0,0 +1,318 @@
+import os
+import platform
+import resource
+import threading
+from contextlib import contextmanager
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+# module parameters which override a module's share of the resource budget or where it runs
+RESOURCE_PARAMETERS = ["n_workers", "memory_limit_gb", "executor"]
+
+# cgroup v1 reports "no limit" as a very large number rather than "max"
+CGROUP_V1_UNLIMITED_MEMORY = 2 ** 60
+
+
+
+def rusage_max_rss_bytes(rusage):
+    '''Peak resident set size of a struct rusage in bytes (Linux reports kB, macOS bytes)'''
+
+    if platform.system() == "Darwin":
+        return int(rusage.ru_maxrss)
+
+    return int(rusage.ru_maxrss) * 1024
+
+
+class Allocation(object):
+    '''
+    A module's share of the resource budget and the resources it was measured to use
+
+    Attributes
+    ----------
+    module : str
+        module name
+    n_workers : int
+        threads / worker processes the module may use
+    memory_bytes : int
+        memory the module may use, None if unknown
+    max_rss_bytes : int
+        peak resident set size measured while the module ran
+    cpu_seconds : float
+        user + system CPU time measured while the module ran
+    executor : str
+        executor the module's commands run with, None for the run's executor
+    job_request : JobRequest
+        memory and time limit requested by the module's batch jobs, from the run plan; None to request
+        memory_bytes and the scheduler's default time limit
+    '''
+
+    def __init__(self, module, n_workers, memory_bytes, executor=None, job_request=None):
+
+        self.module = module
+        self.n_workers = n_workers
+        self.memory_bytes = memory_bytes
+        self.executor = executor
+        self.job_request = job_request
+        self.max_rss_bytes = 0
+        self.cpu_seconds = 0.0
+
+        return
+
+    def record_usage(self, rusage):
+        '''Add the usage of a finished module process (from os.wait4)'''
+
+        self.add_usage(rusage_max_rss_bytes(rusage), rusage.ru_utime + rusage.ru_stime)
+
+    def add_usage(self, max_rss_bytes, cpu_seconds):
+        '''Add usage measured elsewhere, e.g. by a batch job on another host'''
+
+        self.max_rss_bytes = max(self.max_rss_bytes, max_rss_bytes)
+        self.cpu_seconds += cpu_seconds
+
+    @contextmanager
+    def measure_in_process(self):
+        '''
+        Measure a module running inside the driver process
+
+        CPU time is exact; getrusage only reports the peak RSS of the process's
+        lifetime, so the recorded peak is an upper bound.
+        '''
+
+        before = [resource.getrusage(x) for x in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]]
+        try:
+            yield self
+        finally:
+            after = [resource.getrusage(x) for x in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]]
+            for start, end in zip(before, after):
+                self.cpu_seconds += (end.ru_utime - start.ru_utime) + (end.ru_stime - start.ru_stime)
+                self.max_rss_bytes = max(self.max_rss_bytes, rusage_max_rss_bytes(end))
+
+
+def _read_first_line(path):
+    try:
+        with open(path, "r") as f:
+            return f.readline().strip()
+    except OSError:
+        return None
+
+
+def _cgroup_ancestors(path):
+    '''A cgroup folder and its parents up to CGROUP_ROOT, most specific first'''
+
+    dirs = [path]
+    while path.startswith(CGROUP_ROOT + os.sep):
+        path = os.path.dirname(path)
+        dirs.append(path)
+
+    return dirs
+
+
+def _cgroup_dirs():
+    '''
+    cgroup folders which may hold this process's limits, most specific first
+
+    A limit set on any ancestor cgroup also applies to this process (e.g. a
+    container's limit sits above the leaf cgroup a systemd session or the
+    runtime creates), so every ancestor of the process's cgroups is included.
+    '''
+
+    dirs = []
+
+    try:
+        with open("/proc/self/cgroup", "r") as f:
+            cgroup_entries = f.read().splitlines()
+    except OSError:
+        cgroup_entries = []
+
+    for entry in cgroup_entries:
+        # v2: "0::/path"; v1: "4:cpu,cpuacct:/path"
+        hierarchy_id, controllers, path = entry.split(":", 2)
+        if hierarchy_id == "0" and controllers == "":
+            dirs += _cgroup_ancestors(os.path.join(CGROUP_ROOT, path.lstrip("/")).rstrip(os.sep))
+        else:
+            for controller in controllers.split(","):
+                dirs += _cgroup_ancestors(os.path.join(CGROUP_ROOT, controller, path.lstrip("/")).rstrip(os.sep))
+                dirs += _cgroup_ancestors(os.path.join(CGROUP_ROOT, controllers, path.lstrip("/")).rstrip(os.sep))
+
+    dirs += [CGROUP_ROOT,
+             os.path.join(CGROUP_ROOT, "cpu"),
+             os.path.join(CGROUP_ROOT, "cpu,cpuacct"),
+             os.path.join(CGROUP_ROOT, "memory")]
+
+    unique_dirs = []
+    for cgroup_dir in dirs:
+        if cgroup_dir not in unique_dirs and os.path.isdir(cgroup_dir):
+            unique_dirs.append(cgroup_dir)
+
+    return unique_dirs
+
+
+def read_cgroup_cpu_limit():
+    '''Number of CPUs allowed by the cgroup v2 cpu.max or v1 CFS quota, or None when unlimited'''
+
+    limits = []
+
+    for cgroup_dir in _cgroup_dirs():
+        cpu_max = _read_first_line(os.path.join(cgroup_dir, "cpu.max"))
+        if cpu_max is not None:
+            quota, period = (cpu_max.split() + ["100000"])[:2]
+            if quota != "max":
+                limits.append(float(quota) / float(period))
+            continue
+
+        quota = _read_first_line(os.path.join(cgroup_dir, "cpu.cfs_quota_us"))
+        period = _read_first_line(os.path.join(cgroup_dir, "cpu.cfs_period_us"))
+        if quota is not None and period is not None and int(quota) > 0:
+            limits.append(float(quota) / float(period))
+
+    # the tightest limit along the hierarchy applies
+    return min(limits) if limits else None
+
+
+def read_cgroup_memory_limit():
+    '''Memory limit in bytes from the cgroup v2 memory.max or v1 memory.limit_in_bytes, or None when unlimited'''
+
+    limits = []
+
+    for cgroup_dir in _cgroup_dirs():
+        memory_max = _read_first_line(os.path.join(cgroup_dir, "memory.max"))
+        if memory_max is not None:
+            if memory_max != "max":
+                limits.append(int(memory_max))
+            continue
+
+        limit = _read_first_line(os.path.join(cgroup_dir, "memory.limit_in_bytes"))
+        if limit is not None and int(limit) < CGROUP_V1_UNLIMITED_MEMORY:
+            limits.append(int(limit))
+
+    return min(limits) if limits else None
+
+
+def host_cpu_count():
+    '''CPUs this process may be scheduled on'''
+
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+
+    return os.cpu_count() or 1
+
+
+def host_memory_bytes():
+
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+class ResourceCoordinator(object):
+    '''
+    Divides the CPU and memory budget of the container among running modules
+
+    The budget is the smaller of the host's resources and the cgroup (v1 or v2)
+    CPU quota and memory limit. Each module gets 1 / n_slots of it, where n_slots
+    is the number of modules expected to run at the same time, unless its config
+    parameters override the share with n_workers or memory_limit_gb. A run plan
+    may lower a module's default worker count (planned_n_workers), e.g. so that
+    its workers fit in memory.
+
+    Attributes
+    ----------
+    n_cpus : int
+        CPUs available to the whole run
+    memory_bytes : int
+        memory available to the whole run, None if unknown
+    n_slots : int
+        number of modules sharing the budget concurrently
+    '''
+
+    def __init__(self, n_cpus=None, memory_bytes=None):
+
+        if n_cpus is None:
+            n_cpus = host_cpu_count()
+            cgroup_cpus = read_cgroup_cpu_limit()
+            if cgroup_cpus is not None:
+                n_cpus = min(n_cpus, max(int(cgroup_cpus), 1))
+
+        if memory_bytes is None:
+            memory_bytes = host_memory_bytes()
+            cgroup_memory = read_cgroup_memory_limit()
+            if cgroup_memory is not None:
+                memory_bytes = cgroup_memory if memory_bytes is None else min(memory_bytes, cgroup_memory)
+
+        self.n_cpus = max(int(n_cpus), 1)
+        self.memory_bytes = memory_bytes
+        self.n_slots = 1
+        self.active = {}
+        self.lock = threading.Lock()
+
+        return
+
+    def __str__(self):
+        memory_str = "unknown" if self.memory_bytes is None else "%.1f GB" % (self.memory_bytes / 2 ** 30)
+        return "%d CPUs, %s memory" % (self.n_cpus, memory_str)
+
+    def set_slots(self, n_slots):
+        '''Set the number of modules which will run concurrently and share the budget'''
+
+        with self.lock:
+            self.n_slots = max(int(n_slots), 1)
+
+    def share(self, parameters=None, planned_n_workers=None):
+        '''Resolve the workers and memory a module gets, applying its parameter overrides and planned worker count'''
+
+        parameters = parameters or {}
+
+        n_workers = int(float(parameters.get('n_workers', 0) or 0))
+        if n_workers <= 0:
+            n_workers = max(self.n_cpus // self.n_slots, 1)
+            if planned_n_workers is not None:
+                n_workers = max(min(n_workers, planned_n_workers), 1)
+
+        memory_limit_gb = float(parameters.get('memory_limit_gb', 0) or 0)
+        if memory_limit_gb > 0:
+            memory_bytes = int(memory_limit_gb * 2 ** 30)
+        elif self.memory_bytes is not None:
+            memory_bytes = self.memory_bytes // self.n_slots
+        else:
+            memory_bytes = None
+
+        return n_workers, memory_bytes
+
+    @contextmanager
+    def allocate(self, module, parameters=None, planned_n_workers=None, planned_job=None):
+        '''Context manager holding a module's share of the budget while it runs'''
+
+        n_workers, memory_bytes = self.share(parameters, planned_n_workers)
+        allocation = Allocation(module, n_workers, memory_bytes, (parameters or {}).get('executor'), planned_job)
+
+        with self.lock:
+            self.active[id(allocation)] = allocation
+        try:
+            yield allocation
+        finally:
+            with self.lock:
+                self.active.pop(id(allocation), None)
+
+
+def allocation_environment(allocation, base_env=None):
+    '''
+    Environment for a module process limited to its allocation
+
+    OpenMP (peakdetector, mzDeltas), BLAS libraries and R's parallel/future
+    workers otherwise size themselves from the host's core count.
+    '''
+
+    env = dict(os.environ if base_env is None else base_env)
+
+    n_workers = str(allocation.n_workers)
+    env['OMP_NUM_THREADS'] = n_workers
+    env['OPENBLAS_NUM_THREADS'] = n_workers
+    env['MKL_NUM_THREADS'] = n_workers
+    env['MC_CORES'] = n_workers
+    env['MZKIT_N_WORKERS'] = n_workers
+
+    if allocation.memory_bytes is not None:
+        env['MZKIT_MEMORY_LIMIT_BYTES'] = str(allocation.memory_bytes)
+
+    return env
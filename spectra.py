@@ -0,0 +1,222 @@
+import base64
+import os
+import re
+import zlib
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+
+import numpy as np
+
+
+Scan = namedtuple('Scan', ['scan_num', 'ms_level', 'rt', 'polarity', 'precursor_mz', 'mz', 'intensity'])
+'''
+One spectrum read from a raw file
+
+rt is in minutes (matching MAVEN), polarity is one of "+", "-" or "" and
+precursor_mz is 0 for MS1 scans. mz and intensity are numpy arrays sorted by mz.
+'''
+
+# PSI-MS controlled vocabulary terms used by the mzML reader
+CV_MS_LEVEL = "MS:1000511"
+CV_POSITIVE_SCAN = "MS:1000130"
+CV_NEGATIVE_SCAN = "MS:1000129"
+CV_SCAN_START_TIME = "MS:1000016"
+CV_SELECTED_ION_MZ = "MS:1000744"
+CV_MZ_ARRAY = "MS:1000514"
+CV_INTENSITY_ARRAY = "MS:1000515"
+CV_FLOAT_32 = "MS:1000521"
+CV_FLOAT_64 = "MS:1000523"
+CV_ZLIB = "MS:1000574"
+CV_NO_COMPRESSION = "MS:1000576"
+
+
+def spectra_file_format(path):
+    '''Returns "mzML" or "mzXML" based on a spectra file's extension, None otherwise'''
+
+    lower_path = path.lower()
+    if lower_path.endswith(".mzml"):
+        return "mzML"
+    elif lower_path.endswith(".mzxml"):
+        return "mzXML"
+
+    return None
+
+
+def sample_name(path):
+    '''Strips the folder and spectra file extension from a path'''
+
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def iter_scans(path):
+    '''
+    Stream the scans of a spectra file
+
+    Scans are parsed one at a time and discarded once yielded, so memory use
+    is bounded by the size of a single spectrum rather than the file.
+
+    Parameters
+    ----------
+    path : str
+      path to a .mzML or .mzXML file
+
+    Returns
+    -------
+    generator of Scan
+    '''
+
+    file_format = spectra_file_format(path)
+
+    if file_format == "mzML":
+        return _iter_mzml_scans(path)
+    elif file_format == "mzXML":
+        return _iter_mzxml_scans(path)
+    else:
+        raise ValueError('unsupported spectra file format: %s' % path)
+
+
+def _local_tag(elem):
+    return elem.tag.rsplit('}', 1)[-1]
+
+
+def _iter_closed_elements(path, tags):
+    '''Yields elements with a tag in tags as they are closed, then frees them'''
+
+    stack = []
+    for event, elem in ET.iterparse(path, events=('start', 'end')):
+        if event == 'start':
+            stack.append(elem)
+            continue
+
+        stack.pop()
+        if _local_tag(elem) in tags:
+            yield elem
+            if stack:
+                stack[-1].remove(elem)
+        elif _local_tag(elem) in ('chromatogram', 'index', 'indexList') and stack:
+            stack[-1].remove(elem)
+
+
+def _sorted_by_mz(mz, intensity):
+    if mz.size > 1 and np.any(mz[1:] < mz[:-1]):
+        order = np.argsort(mz, kind='stable')
+        return mz[order], intensity[order]
+
+    return mz, intensity
+
+
+def _decode_mzml_array(binary_array):
+
+    dtype = '<f8'
+    compressed = False
+    array_type = None
+    encoded = ""
+
+    for child in binary_array.iter():
+        tag = _local_tag(child)
+        if tag == 'cvParam':
+            accession = child.get('accession')
+            if accession == CV_FLOAT_32:
+                dtype = '<f4'
+            elif accession == CV_FLOAT_64:
+                dtype = '<f8'
+            elif accession == CV_ZLIB:
+                compressed = True
+            elif accession in (CV_MZ_ARRAY, CV_INTENSITY_ARRAY):
+                array_type = accession
+            elif child.get('name', '').startswith('MS-Numpress'):
+                raise ValueError('MS-Numpress compressed mzML arrays are not supported')
+        elif tag == 'binary':
+            encoded = child.text or ""
+
+    raw = base64.b64decode(encoded)
+    if compressed:
+        raw = zlib.decompress(raw)
+
+    return array_type, np.frombuffer(raw, dtype=dtype).astype(np.float64)
+
+
+def _iter_mzml_scans(path):
+
+    for scan_num, spectrum in enumerate(_iter_closed_elements(path, ('spectrum',))):
+        ms_level = 1
+        polarity = ""
+        rt = 0.0
+        precursor_mz = 0.0
+        mz = np.empty(0)
+        intensity = np.empty(0)
+
+        for child in spectrum.iter():
+            tag = _local_tag(child)
+            if tag == 'cvParam':
+                accession = child.get('accession')
+                if accession == CV_MS_LEVEL:
+                    ms_level = int(child.get('value'))
+                elif accession == CV_POSITIVE_SCAN:
+                    polarity = "+"
+                elif accession == CV_NEGATIVE_SCAN:
+                    polarity = "-"
+                elif accession == CV_SCAN_START_TIME:
+                    rt = float(child.get('value'))
+                    if child.get('unitName', 'minute') == 'second':
+                        rt = rt / 60
+                elif accession == CV_SELECTED_ION_MZ and not precursor_mz:
+                    precursor_mz = float(child.get('value'))
+            elif tag == 'binaryDataArray':
+                array_type, values = _decode_mzml_array(child)
+                if array_type == CV_MZ_ARRAY:
+                    mz = values
+                elif array_type == CV_INTENSITY_ARRAY:
+                    intensity = values
+
+        mz, intensity = _sorted_by_mz(mz, intensity)
+
+        yield Scan(scan_num, ms_level, rt, polarity, precursor_mz, mz, intensity)
+
+
+def _mzxml_retention_time(value):
+    '''Converts an xs:duration retention time (e.g., PT123.4S) to minutes'''
+
+    if not value:
+        return 0.0
+
+    match = re.match(r'^-?P(?:T)?(?:(\d+(?:\.\d*)?)H)?(?:(\d+(?:\.\d*)?)M)?(?:(\d+(?:\.\d*)?)S)?$', value)
+    if match is None:
+        return float(value) / 60
+
+    hours, minutes, seconds = [float(x) if x else 0.0 for x in match.groups()]
+
+    return hours * 60 + minutes + seconds / 60
+
+
+def _iter_mzxml_scans(path):
+
+    for scan in _iter_closed_elements(path, ('scan',)):
+        precursor_mz = 0.0
+        mz = np.empty(0)
+        intensity = np.empty(0)
+
+        for child in scan:
+            tag = _local_tag(child)
+            if tag == 'precursorMz' and child.text:
+                precursor_mz = float(child.text)
+            elif tag == 'peaks' and child.text:
+                dtype = '>f8' if child.get('precision', '32') == '64' else '>f4'
+                if child.get('byteOrder', 'network') not in ('network', 'big'):
+                    dtype = dtype.replace('>', '<')
+                raw = base64.b64decode(child.text)
+                if child.get('compressionType', 'none') == 'zlib':
+                    raw = zlib.decompress(raw)
+                pairs = np.frombuffer(raw, dtype=dtype).astype(np.float64)
+                mz = pairs[0::2]
+                intensity = pairs[1::2]
+
+        mz, intensity = _sorted_by_mz(mz, intensity)
+
+        yield Scan(int(scan.get('num', 0)),
+                   int(scan.get('msLevel', 1)),
+                   _mzxml_retention_time(scan.get('retentionTime')),
+                   scan.get('polarity', ""),
+                   precursor_mz,
+                   mz,
+                   intensity)
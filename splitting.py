@@ -0,0 +1,227 @@
+import os
+
+from mzrolldb import create_indexes
+from utils import PipelineFailedException, parse_ppm_tolerance
+
+
+def run_split_peak_aggregation(module_dict, settings):
+    '''
+    Merge peak groups which were split from a single chromatographic peak
+
+    Groups are candidates for merging when their m/z agree within MS1tol, their
+    RT bounds are within `max_rt_gap` minutes and their apex RTs within
+    `max_rt_diff`, and they rarely share samples (at most `max_shared_fraction`
+    of the smaller group's samples), as happens when RT drift pushes some
+    samples' peaks into a separate group. Candidates are merged pair by pair
+    (see aggregate_split_peaks()), into the group with more samples, keeping
+    the most intense peak per sample; merged groups' summary columns are then
+    recomputed from their peaks.
+
+    Everything runs as set-based SQL against the mzrollDB in one transaction;
+    merges are recorded in the split_peak_merges table.
+
+    Parameters
+    ----------
+    module_dict : dict
+      module configuration; parameters are merged with globals
+    settings : MzkitSettings
+      paths to the dataset, outputs and programming assets, and run settings
+    '''
+
+    parameters = module_dict['parameters']
+
+    ppm = parse_ppm_tolerance(parameters['MS1tol'])
+    max_rt_gap = float(parameters.get('max_rt_gap', 0.05))
+    max_rt_diff = float(parameters.get('max_rt_diff', 0.5))
+    max_shared_fraction = float(parameters.get('max_shared_fraction', 0.1))
+    quant_type = parameters.get('quant_type', "peakAreaTop")
+
+    if not os.path.isfile(settings.mzrolldb_file):
+        raise PipelineFailedException("mzrollDB not found: %s" % settings.mzrolldb_file)
+
+    conn = settings.py_context.mzrolldb(settings.mzrolldb_file)
+    try:
+        # group and sample lookups of the pair and merge queries rely on the peaks indexes
+        create_indexes(conn)
+
+        with settings.py_context.transaction(conn):
+            n_merged = aggregate_split_peaks(conn, ppm, max_rt_gap, max_rt_diff, max_shared_fraction, quant_type)
+    finally:
+        # the connection is shared with later modules
+        for table in SPLIT_TABLES:
+            conn.execute("DROP TABLE IF EXISTS temp.%s" % table)
+
+    print("# Merged %d split peak groups" % n_merged)
+
+    return
+
+
+# (peakgroups column, aggregate, peaks column) of group summaries which are recomputed for groups that
+# received merged peaks; columns missing from the mzrollDB are skipped
+GROUP_SUMMARY_COLUMNS = [
+    ("meanMz", "AVG", "peakMz"),
+    ("meanRt", "AVG", "rt"),
+    ("minMz", "MIN", "mzmin"),
+    ("maxMz", "MAX", "mzmax"),
+    ("minRt", "MIN", "rtmin"),
+    ("maxRt", "MAX", "rtmax"),
+    ("sampleCount", "COUNT", "sampleId"),
+    ("maxIntensity", "MAX", "peakIntensity"),
+    ("maxAreaTop", "MAX", "peakAreaTop"),
+    ("maxArea", "MAX", "peakArea"),
+    ("maxQuality", "MAX", "quality")
+    ]
+
+# candidate pairs: same m/z, adjacent RT, few shared samples. {scope} restricts the first group of a
+# pair and {order} the second (b.groupId > a.groupId for all pairs once, != for the pairs of a scope)
+SPLIT_EDGES_QUERY = """
+    SELECT DISTINCT MIN(groupId1, groupId2), MAX(groupId1, groupId2), rt_diff FROM (
+        SELECT a.groupId AS groupId1, b.groupId AS groupId2, ABS(a.rt - b.rt) AS rt_diff,
+               MIN(a.n_samples, b.n_samples) AS min_samples,
+               (SELECT COUNT(*) FROM peaks x JOIN peaks y ON y.groupId = b.groupId AND y.sampleId = x.sampleId
+                WHERE x.groupId = a.groupId) AS n_shared
+        FROM split_groups a
+        JOIN split_groups b
+          ON b.mz BETWEEN a.mz * (1 - :ppm * 1e-6) AND a.mz * (1 + :ppm * 1e-6)
+         AND b.groupId {order} a.groupId
+        WHERE a.groupId IN ({scope})
+          AND b.rtmin <= a.rtmax + :max_rt_gap
+          AND a.rtmin <= b.rtmax + :max_rt_gap
+          AND ABS(a.rt - b.rt) <= :max_rt_diff
+    )
+    WHERE n_shared <= :max_shared_fraction * min_samples
+    """
+
+SPLIT_GROUPS_QUERY = ("SELECT groupId, AVG(peakMz) AS mz, AVG(rt) AS rt, MIN(rtmin) AS rtmin, MAX(rtmax) AS rtmax, "
+                      "COUNT(DISTINCT sampleId) AS n_samples FROM peaks WHERE groupId IN ({scope}) GROUP BY groupId")
+
+SPLIT_TABLES = ["split_groups", "split_edges", "split_pairs", "split_merged"]
+
+
+def aggregate_split_peaks(conn, ppm, max_rt_gap, max_rt_diff, max_shared_fraction, quant_type):
+    '''
+    Find and merge split peak groups within the caller's transaction; returns the number of groups merged away
+
+    Groups are merged greedily in rounds. In each round, every group whose
+    best candidate (the closest in RT) also has it as its best candidate is
+    merged with it, into the one of the two with more samples. The merged
+    group's summary and candidate pairs are then recomputed from its peaks,
+    so a group only merges further while the shared-sample bound holds for
+    the union of its peaks, never through a chain of pairs.
+    '''
+
+    for table in SPLIT_TABLES:
+        conn.execute("DROP TABLE IF EXISTS temp.%s" % table)
+
+    bounds = {"ppm": ppm, "max_rt_gap": max_rt_gap, "max_rt_diff": max_rt_diff, "max_shared_fraction": max_shared_fraction}
+
+    # group summaries, indexed by m/z for the range join
+    conn.execute("CREATE TEMP TABLE split_groups AS " + SPLIT_GROUPS_QUERY.format(scope="SELECT groupId FROM peakgroups"))
+    conn.execute("CREATE UNIQUE INDEX temp.idx_split_groups ON split_groups (groupId)")
+    conn.execute("CREATE INDEX temp.idx_split_groups_mz ON split_groups (mz)")
+
+    conn.execute("CREATE TEMP TABLE split_edges (groupId1 INTEGER, groupId2 INTEGER, rt_diff REAL)")
+    conn.execute("INSERT INTO split_edges " + SPLIT_EDGES_QUERY.format(order=">", scope="SELECT groupId FROM split_groups"), bounds)
+    conn.execute("CREATE INDEX temp.idx_split_edges_1 ON split_edges (groupId1)")
+    conn.execute("CREATE INDEX temp.idx_split_edges_2 ON split_edges (groupId2)")
+
+    # every group merged away, with the group it ended up in
+    conn.execute("CREATE TEMP TABLE split_merged (groupId INTEGER PRIMARY KEY, keeperId INTEGER)")
+
+    while True:
+        conn.execute("DROP TABLE IF EXISTS temp.split_pairs")
+        conn.execute("""
+            CREATE TEMP TABLE split_pairs AS
+            WITH directed AS (
+                SELECT groupId1 AS groupId, groupId2 AS partnerId, rt_diff FROM split_edges
+                UNION ALL
+                SELECT groupId2, groupId1, rt_diff FROM split_edges
+            ),
+            best AS (
+                SELECT groupId, partnerId FROM (
+                    SELECT groupId, partnerId, ROW_NUMBER() OVER (PARTITION BY groupId ORDER BY rt_diff, partnerId) AS rank
+                    FROM directed
+                ) WHERE rank = 1
+            )
+            SELECT x.groupId,
+                   CASE WHEN a.n_samples > b.n_samples OR (a.n_samples = b.n_samples AND x.groupId < x.partnerId)
+                        THEN x.groupId ELSE x.partnerId END AS keeperId
+            FROM best x
+            JOIN best y ON y.groupId = x.partnerId AND y.partnerId = x.groupId
+            JOIN split_groups a ON a.groupId = x.groupId
+            JOIN split_groups b ON b.groupId = x.partnerId
+            """)
+        conn.execute("CREATE UNIQUE INDEX temp.idx_split_pairs ON split_pairs (groupId)")
+
+        if conn.execute("SELECT COUNT(*) FROM split_pairs").fetchone()[0] == 0:
+            break
+
+        merge_split_pairs(conn, quant_type)
+
+        # the pairs' groups changed: drop their candidate pairs, then recompute the keepers' summaries and pairs
+        conn.execute("DELETE FROM split_edges WHERE groupId1 IN (SELECT groupId FROM split_pairs) "
+                     "OR groupId2 IN (SELECT groupId FROM split_pairs)")
+        conn.execute("DELETE FROM split_groups WHERE groupId IN (SELECT groupId FROM split_pairs)")
+        keepers = "SELECT keeperId FROM split_pairs WHERE groupId = keeperId"
+        conn.execute("INSERT INTO split_groups " + SPLIT_GROUPS_QUERY.format(scope=keepers))
+        conn.execute("INSERT INTO split_edges " + SPLIT_EDGES_QUERY.format(order="!=", scope=keepers), bounds)
+
+    n_merged = conn.execute("SELECT COUNT(*) FROM split_merged").fetchone()[0]
+    if n_merged == 0:
+        return 0
+
+    update_group_summaries(conn, "SELECT DISTINCT keeperId FROM split_merged")
+
+    conn.execute("CREATE TABLE IF NOT EXISTS split_peak_merges (groupId INTEGER, mergedIntoGroupId INTEGER)")
+    conn.execute("INSERT INTO split_peak_merges SELECT groupId, keeperId FROM split_merged")
+
+    return n_merged
+
+
+def merge_split_pairs(conn, quant_type):
+    '''Merge each group of split_pairs into its keeper, keeping the most intense peak of each sample'''
+
+    merged = "SELECT groupId FROM split_pairs WHERE groupId != keeperId"
+
+    conn.execute("""
+        DELETE FROM peaks WHERE peakId IN (
+            SELECT peakId FROM (
+                SELECT p.peakId,
+                       ROW_NUMBER() OVER (PARTITION BY m.keeperId, p.sampleId ORDER BY p."%s" DESC, p.peakId) AS rank
+                FROM peaks p JOIN split_pairs m ON m.groupId = p.groupId
+            ) WHERE rank > 1
+        )
+        """ % quant_type)
+
+    conn.execute("UPDATE peaks SET groupId = (SELECT keeperId FROM split_pairs m WHERE m.groupId = peaks.groupId) "
+                 "WHERE groupId IN (%s)" % merged)
+
+    conn.execute("UPDATE peakgroups SET parentGroupId = (SELECT keeperId FROM split_pairs m WHERE m.groupId = peakgroups.parentGroupId) "
+                 "WHERE parentGroupId IN (%s)" % merged)
+
+    conn.execute("DELETE FROM peakgroups WHERE groupId IN (%s)" % merged)
+
+    # groups merged in earlier rounds follow their keeper
+    conn.execute("UPDATE split_merged SET keeperId = (SELECT keeperId FROM split_pairs m WHERE m.groupId = split_merged.keeperId) "
+                 "WHERE keeperId IN (%s)" % merged)
+    conn.execute("INSERT INTO split_merged SELECT groupId, keeperId FROM split_pairs WHERE groupId != keeperId")
+
+    return
+
+
+def update_group_summaries(conn, scope):
+    '''Recompute the GROUP_SUMMARY_COLUMNS of the peakgroups in scope (a query of groupIds) from their peaks'''
+
+    group_columns = [x[1] for x in conn.execute("PRAGMA table_info(peakgroups)").fetchall()]
+    peak_columns = [x[1] for x in conn.execute("PRAGMA table_info(peaks)").fetchall()]
+
+    assignments = []
+    for group_column, aggregate, peak_column in GROUP_SUMMARY_COLUMNS:
+        if group_column in group_columns and peak_column in peak_columns:
+            value = "COUNT(DISTINCT p.%s)" % peak_column if aggregate == "COUNT" else "%s(p.%s)" % (aggregate, peak_column)
+            assignments.append("%s = (SELECT %s FROM peaks p WHERE p.groupId = peakgroups.groupId)" % (group_column, value))
+
+    if assignments:
+        conn.execute("UPDATE peakgroups SET %s WHERE groupId IN (%s)" % (", ".join(assignments), scope))
+
+    return
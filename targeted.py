@@ -0,0 +1,460 @@
+import csv
+import gzip
+import os
+import sqlite3
+from collections import namedtuple
+from concurrent.futures import as_completed
+
+import numpy as np
+
+from library import find_standards_snapshot, matches_mode
+from pymodules import process_pool
+from spectra import iter_scans, sample_name
+from utils import PipelineFailedException, parse_ppm_tolerance
+
+Target = namedtuple('Target', ['target_id', 'name', 'adduct', 'mz', 'rt'])
+'''A known compound ion to quantify; rt is in minutes, None if unknown'''
+
+# measurements of a target's peak in one sample, in output column order
+PEAK_COLUMNS = ["detected", "rt", "rtmin", "rtmax", "peakMz", "ppmError", "peakIntensity",
+                "peakArea", "peakAreaCorrected", "peakAreaTop", "peakBaseLineLevel", "signalBaselineRatio", "width"]
+
+TARGET_COLUMNS = ["targetId", "name", "adductName", "targetMz", "expectedRt"]
+
+
+def run_targeted_extraction(module_dict, settings):
+    '''
+    Quantify known compounds in every spectra file without untargeted peak picking
+
+    Targets are the ions of the standards database snapshot (with their mean
+    elution time) or the rows of a `targets_file` (name, mz and rt columns).
+    Each target's m/z window is MS1tol and its retention time window is
+    `rt_window_sds` x RTsd around the expected retention time.
+
+    Each spectra file is streamed once, in parallel across files. For every
+    MS1 scan, the sorted centroids are binned against the sorted m/z windows
+    of all targets eluting at that time, building all targets' EICs in one
+    pass. Each EIC is then smoothed and its most intense peak integrated.
+    As in peakdetector, a peak counts as detected only if its intensity is at
+    least `minintensity` and its signal to baseline ratio at least
+    `minSignalBaseLineRatio`.
+
+    Peaks are written to targeted/targeted_peaks.tsv (or .parquet) in the
+    output folder and, when the run has an mzrollDB, to its targeted_peaks
+    table. Every target has a row for every sample; undetected targets have
+    detected = 0.
+
+    Parameters
+    ----------
+    module_dict : dict
+      module configuration; parameters are merged with globals
+    settings : MzkitSettings
+      paths to the dataset, outputs and programming assets, and run settings
+    '''
+
+    parameters = module_dict['parameters']
+
+    ppm = parse_ppm_tolerance(parameters['MS1tol'])
+    rt_window = float(parameters.get('rt_window_sds', 2)) * float(parameters.get('RTsd', 0.5))
+    mode = parameters.get('mode', "")
+    smoothing_window = int(parameters.get('eic_smoothingWindow', 5))
+    baseline_drop_top_x = float(parameters.get('baseline_dropTopX', 60))
+    min_intensity = float(parameters.get('minintensity', 10000))
+    min_signal_baseline_ratio = float(parameters.get('minSignalBaseLineRatio', 1.1))
+    output_format = parameters.get('output_format', "tsv")
+    n_workers = int(parameters.get('n_workers', 0)) or os.cpu_count()
+
+    if output_format not in ["tsv", "parquet"]:
+        raise ValueError('invalid output_format: %s; must be one of tsv or parquet' % output_format)
+
+    targets = read_targets(parameters, mode)
+    if not targets:
+        raise PipelineFailedException("no targets to extract; set targets_file or standards_snapshot")
+    print("# Extracting %d targets (%.1f ppm, +/- %.2f min)" % (len(targets), ppm, rt_window))
+
+    index = build_target_index(targets, ppm, rt_window)
+    polarity = {"positive": "+", "negative": "-"}.get(mode, "")
+
+    targeted_folder = os.path.join(settings.run['output_folder'], "targeted")
+    if not os.path.exists(targeted_folder):
+        os.makedirs(targeted_folder)
+
+    project_files = sorted(settings.project_files)
+    results = {}
+
+    with process_pool(n_workers) as pool:
+        futures = {pool.submit(extract_spectra_file, path, index, polarity, smoothing_window, baseline_drop_top_x,
+                               min_intensity, min_signal_baseline_ratio, parameters.get('write_eics', False)): path
+                   for path in project_files}
+
+        for n_done, future in enumerate(as_completed(futures), start=1):
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                print("# Targeted extraction failed for " + futures[future] + ": " + str(e))
+            settings.telemetry.report_progress(module_dict['module'], n_done, len(project_files))
+
+    if not results:
+        raise PipelineFailedException("targeted extraction could not read any spectra files")
+
+    rows = [[sample_name(path)] + list(target[:4]) + [target.rt if target.rt is not None else np.nan] + list(peak)
+            for path in sorted(results, key=sample_name)
+            for target, peak in zip(targets, results[path]['peaks'])]
+    columns = ["sample"] + TARGET_COLUMNS + PEAK_COLUMNS
+
+    if output_format == "parquet":
+        out_path = os.path.join(targeted_folder, "targeted_peaks.parquet")
+        write_parquet(rows, columns, out_path)
+    else:
+        out_path = os.path.join(targeted_folder, "targeted_peaks.tsv")
+        write_tsv(rows, columns, out_path)
+
+    if parameters.get('write_eics', False):
+        write_eics(results, targets, os.path.join(targeted_folder, "targeted_eics.tsv.gz"))
+
+    if parameters.get('write_mzrolldb', True) and os.path.isfile(settings.mzrolldb_file):
+        conn = settings.py_context.mzrolldb(settings.mzrolldb_file)
+        with settings.py_context.transaction(conn):
+            write_mzrolldb_table(conn, rows, columns)
+
+    n_detected = sum(1 for x in rows if x[len(TARGET_COLUMNS) + 1])
+    print("# Detected %d of %d target peaks in %d of %d samples; wrote %s" %
+          (n_detected, len(rows), len(results), len(project_files), out_path))
+
+    return
+
+
+def read_targets(parameters, mode):
+    '''Targets of the targets_file parameter, or else of the standards database snapshot'''
+
+    targets_file = parameters.get('targets_file', "")
+    if targets_file:
+        return read_targets_file(targets_file)
+
+    snapshot_path = find_standards_snapshot(parameters)
+    if snapshot_path is None:
+        return []
+
+    print("# Reading targets from " + snapshot_path)
+    conn = sqlite3.connect("file:%s?mode=ro" % snapshot_path, uri=True)
+    try:
+        return read_standards_targets(conn, mode, parameters.get('chemical_class', ""))
+    finally:
+        conn.close()
+
+
+def read_targets_file(path):
+    '''
+    Read targets from a tab-separated file with name, mz and (optionally empty or NA) rt columns
+
+    Optional id and adductName columns are used as target ids and adducts;
+    ids default to the row number.
+    '''
+
+    targets = []
+    with open(path, "r", newline="") as f:
+        for i, row in enumerate(csv.DictReader(f, delimiter="\t"), start=1):
+            if 'mz' not in row or 'name' not in row:
+                raise ValueError('targets file %s must have name and mz columns' % path)
+
+            rt = row.get('rt') or ""
+            targets.append(Target(target_id=row.get('id') or str(i),
+                                  name=row['name'],
+                                  adduct=row.get('adductName') or "",
+                                  mz=float(row['mz']),
+                                  rt=float(rt) if rt.strip() not in ["", "NA"] else None))
+
+    return targets
+
+
+def read_standards_targets(conn, mode, chemical_class):
+    '''
+    Targets for the ions of a standards database snapshot which match the run's mode
+
+    An ion's expected retention time is the mean of its elutions (restricted
+    to samples of chemical_class if given); ions without elutions are
+    searched across the whole run.
+    '''
+
+    elution_filter = ""
+    query_args = []
+    if chemical_class:
+        elution_filter = " AND e.sampleId IN (SELECT sampleId FROM samples WHERE lower(chemicalClass) = lower(?))"
+        query_args.append(chemical_class)
+
+    query = ("SELECT i.ionId, c.compoundName, i.adductName, i.precursorMz, i.mode, AVG(e.rt) "
+             "FROM ions i "
+             "JOIN compounds c ON c.compoundId = i.compoundId "
+             "LEFT JOIN elutions e ON e.ionId = i.ionId" + elution_filter + " "
+             "WHERE i.precursorMz IS NOT NULL "
+             "GROUP BY i.ionId "
+             "ORDER BY i.precursorMz")
+
+    return [Target(target_id=str(ion_id), name=name, adduct=adduct or "", mz=precursor_mz, rt=rt)
+            for ion_id, name, adduct, precursor_mz, ion_mode, rt in conn.execute(query, query_args)
+            if matches_mode(ion_mode, mode)]
+
+
+def build_target_index(targets, ppm, rt_window):
+    '''
+    Sorted m/z interval index of the targets' extraction windows
+
+    Windows are sorted by their lower m/z bound, so that a scan's sorted
+    centroids can be binned against all of them with two binary searches.
+    `order` maps index positions back to positions in targets.
+    '''
+
+    mz = np.array([x.mz for x in targets], dtype=np.float64)
+    rt = np.array([x.rt if x.rt is not None else np.nan for x in targets], dtype=np.float64)
+
+    order = np.argsort(mz, kind='stable')
+    mz = mz[order]
+    rt = rt[order]
+
+    return {
+        'order': order,
+        'mz': mz,
+        'mz_lower': mz * (1 - ppm * 1e-6),
+        'mz_upper': mz * (1 + ppm * 1e-6),
+        'rt': rt,
+        'rt_lower': np.where(np.isnan(rt), -np.inf, rt - rt_window),
+        'rt_upper': np.where(np.isnan(rt), np.inf, rt + rt_window)
+        }
+
+
+def extract_eics(path, index, polarity):
+    '''
+    Build the EICs of all targets in a single pass over a spectra file
+
+    An EIC point is the most intense centroid within a target's m/z window
+    in an MS1 scan, and its m/z the intensity-weighted mean of the window's
+    centroids. Only scans within a target's retention time window are
+    considered.
+
+    Returns
+    -------
+    rts : np.ndarray
+      retention times of the file's MS1 scans
+    eics : list of (np.ndarray, np.ndarray, np.ndarray)
+      scan positions, intensities and m/z of each target's non-empty EIC points, in index order
+    '''
+
+    mz_lower = index['mz_lower']
+    mz_upper = index['mz_upper']
+    rt_lower = index['rt_lower']
+    rt_upper = index['rt_upper']
+
+    rts = []
+    hit_targets = []
+    hit_scans = []
+    hit_intensities = []
+    hit_mzs = []
+
+    for scan in iter_scans(path):
+        if scan.ms_level != 1 or (polarity and scan.polarity and scan.polarity != polarity):
+            continue
+
+        scan_position = len(rts)
+        rts.append(scan.rt)
+        if scan.mz.size == 0:
+            continue
+
+        active = np.nonzero((rt_lower <= scan.rt) & (rt_upper >= scan.rt))[0]
+        if active.size == 0:
+            continue
+
+        starts = np.searchsorted(scan.mz, mz_lower[active], side='left')
+        ends = np.searchsorted(scan.mz, mz_upper[active], side='right')
+        hit = ends > starts
+        if not np.any(hit):
+            continue
+
+        # reduce over [start, end) of every hit window at once: reduceat over interleaved bounds reduces
+        # each window at even positions; a trailing zero keeps end bounds valid indices
+        bounds = np.empty(2 * np.count_nonzero(hit), dtype=np.intp)
+        bounds[0::2] = starts[hit]
+        bounds[1::2] = ends[hit]
+        intensity = np.append(scan.intensity, 0.0)
+        weighted_mz = np.append(scan.mz * scan.intensity, 0.0)
+
+        total = np.add.reduceat(intensity, bounds)[0::2]
+        hit_targets.append(active[hit])
+        hit_scans.append(np.full(bounds.size // 2, scan_position, dtype=np.int64))
+        hit_intensities.append(np.maximum.reduceat(intensity, bounds)[0::2])
+        hit_mzs.append(np.add.reduceat(weighted_mz, bounds)[0::2] / np.where(total > 0, total, 1))
+
+    rts = np.asarray(rts, dtype=np.float64)
+    n_targets = mz_lower.size
+    if not hit_targets:
+        empty = (np.empty(0, dtype=np.int64), np.empty(0), np.empty(0))
+        return rts, [empty] * n_targets
+
+    hit_targets = np.concatenate(hit_targets)
+    order = np.argsort(hit_targets, kind='stable')
+    splits = np.searchsorted(hit_targets[order], np.arange(1, n_targets))
+
+    eics = zip(np.split(np.concatenate(hit_scans)[order], splits),
+               np.split(np.concatenate(hit_intensities)[order], splits),
+               np.split(np.concatenate(hit_mzs)[order], splits))
+
+    return rts, list(eics)
+
+
+def integrate_peak(rts, intensity, mz, smoothing_window, baseline_drop_top_x):
+    '''
+    Integrate the most intense peak of an EIC
+
+    The EIC is smoothed with a moving average of up to smoothing_window scans; its
+    baseline is the mean of the smoothed intensities after dropping the top
+    baseline_drop_top_x percent (as in peakdetector). The peak extends from
+    the apex of the smoothed EIC down to the baseline or the nearest local
+    minimum on either side.
+
+    Returns
+    -------
+    peak : tuple
+      values of PEAK_COLUMNS except ppmError, None if the EIC has no signal
+    '''
+
+    if intensity.size == 0 or not np.any(intensity > 0):
+        return None
+
+    # moving average over the scans within the window, so that the EIC's ends are not pulled towards zero
+    window = np.ones(max(min(smoothing_window, intensity.size), 1))
+    smoothed = np.convolve(intensity, window, mode='same') / np.convolve(np.ones(intensity.size), window, mode='same')
+
+    n_kept = max(int(intensity.size * (100 - baseline_drop_top_x) / 100), 1)
+    baseline = float(np.sort(smoothed)[:n_kept].mean())
+
+    apex = int(np.argmax(smoothed))
+
+    # scans before the apex on the rising flank above the baseline, then after it on the falling flank
+    flank = (smoothed[:apex] <= smoothed[1:apex + 1]) & (smoothed[:apex] > baseline)
+    breaks = np.nonzero(~flank)[0]
+    left = int(breaks[-1]) + 1 if breaks.size else 0
+
+    flank = (smoothed[apex + 1:] <= smoothed[apex:-1]) & (smoothed[apex + 1:] > baseline)
+    breaks = np.nonzero(~flank)[0]
+    right = apex + int(breaks[0]) if breaks.size else intensity.size - 1
+
+    peak_intensity = intensity[left:right + 1]
+    raw_apex = left + int(np.argmax(peak_intensity))
+    top = intensity[max(raw_apex - 1, 0):raw_apex + 2]
+
+    signal = peak_intensity > 0
+    peak_mz = float(np.average(mz[left:right + 1][signal], weights=peak_intensity[signal])) if np.any(signal) else np.nan
+
+    return (1,
+            float(rts[raw_apex]),
+            float(rts[left]),
+            float(rts[right]),
+            peak_mz,
+            float(intensity[raw_apex]),
+            float(peak_intensity.sum()),
+            float(np.clip(peak_intensity - baseline, 0, None).sum()),
+            float(top.mean()),
+            baseline,
+            float(intensity[raw_apex] / baseline) if baseline > 0 else np.inf,
+            right - left + 1)
+
+
+def extract_spectra_file(path, index, polarity, smoothing_window, baseline_drop_top_x, min_intensity=0,
+                         min_signal_baseline_ratio=0, keep_eics=False):
+    '''
+    Extract and integrate all targets' peaks in a spectra file
+
+    Peaks below min_intensity or min_signal_baseline_ratio are reported as not detected.
+
+    Returns
+    -------
+    result : dict
+      the peaks (values of PEAK_COLUMNS) of every target, in the order the
+      targets were given, and their dense EICs over their retention time
+      windows if keep_eics
+    '''
+
+    rts, eics = extract_eics(path, index, polarity)
+
+    peaks = [None] * index['mz'].size
+    dense_eics = [None] * index['mz'].size
+
+    for i, (scans, intensities, mzs) in enumerate(eics):
+        # dense EIC over the target's window: scans without a centroid in the m/z window are zeros
+        first = np.searchsorted(rts, index['rt_lower'][i], side='left')
+        last = np.searchsorted(rts, index['rt_upper'][i], side='right')
+        intensity = np.zeros(last - first)
+        mz = np.full(last - first, index['mz'][i])
+        intensity[scans - first] = intensities
+        mz[scans - first] = mzs
+
+        peak = integrate_peak(rts[first:last], intensity, mz, smoothing_window, baseline_drop_top_x)
+        if peak is not None and (peak[5] < min_intensity or peak[10] < min_signal_baseline_ratio):
+            peak = None
+        if peak is None:
+            peak = (0,) + (np.nan,) * (len(PEAK_COLUMNS) - 2) + (0,)
+        else:
+            peak = peak[:5] + ((peak[4] - index['mz'][i]) / index['mz'][i] * 1e6,) + peak[5:]
+
+        target = index['order'][i]
+        peaks[target] = peak
+        if keep_eics:
+            dense_eics[target] = (rts[first:last], intensity)
+
+    return {'path': path, 'peaks': peaks, 'eics': dense_eics if keep_eics else None}
+
+
+def _format(value):
+    if isinstance(value, (float, np.floating)):
+        return "NA" if not np.isfinite(value) else "%.6g" % value
+    return str(value)
+
+
+def write_tsv(rows, columns, out_path):
+
+    with open(out_path, "w", newline="") as f:
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow([_format(x) for x in row])
+
+    return
+
+
+def write_parquet(rows, columns, out_path):
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pa.table({column: [row[i] for row in rows] for i, column in enumerate(columns)})
+    pq.write_table(table, out_path)
+
+    return
+
+
+def write_eics(results, targets, out_path):
+
+    with gzip.open(out_path, "wt", newline="") as f:
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        writer.writerow(["sample", "targetId", "rt", "intensity"])
+
+        for path in sorted(results, key=sample_name):
+            for target, (rts, intensity) in zip(targets, results[path]['eics']):
+                for rt, value in zip(rts, intensity):
+                    writer.writerow([sample_name(path), target.target_id, "%.4f" % rt, "%.6g" % value])
+
+    return
+
+
+def write_mzrolldb_table(conn, rows, columns):
+    '''Replace the mzrollDB's targeted_peaks table within the caller's transaction'''
+
+    declared_types = {"sample": "TEXT", "targetId": "TEXT", "name": "TEXT", "adductName": "TEXT",
+                      "detected": "INTEGER", "width": "INTEGER"}
+
+    conn.execute("DROP TABLE IF EXISTS targeted_peaks")
+    conn.execute("CREATE TABLE targeted_peaks (%s)" % ", ".join("%s %s" % (x, declared_types.get(x, "REAL")) for x in columns))
+    conn.executemany("INSERT INTO targeted_peaks VALUES (%s)" % ", ".join("?" * len(columns)),
+                     [[None if isinstance(x, float) and not np.isfinite(x) else x for x in row] for row in rows])
+    conn.execute("CREATE INDEX idx_targeted_peaks_targetId ON targeted_peaks (targetId)")
+
+    return
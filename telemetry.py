@@ -0,0 +1,526 @@
+import os
+import re
+import resource
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# seconds between rewrites of the metrics file
+METRICS_FILE_INTERVAL = 5
+
+# seconds between checks of the spectra files a module's processes have open
+OPEN_FILES_INTERVAL = 1
+
+# progress line printed by mzkit.R around each R wrapper, and by wrappers calling mzkit_progress(done, total)
+PROGRESS_PATTERN = re.compile(r'^\s*MZKIT_PROGRESS\s+(\d+)\s*/\s*(\d+)')
+
+
+def parse_progress_line(line):
+    '''Interpret a module output line as progress; returns (done, total) or None'''
+
+    match = PROGRESS_PATTERN.search(line)
+    if match is None:
+        return None
+
+    done, total = int(match.group(1)), int(match.group(2))
+    if total <= 0 or done > total:
+        return None
+
+    return done, total
+
+
+def _process_tree_pids(pid):
+    '''pid and its descendants, read from /proc (Linux)'''
+
+    pids = []
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        pids.append(current)
+        task_folder = "/proc/%d/task" % current
+        try:
+            tasks = os.listdir(task_folder)
+        except OSError:
+            continue
+        for task in tasks:
+            try:
+                with open(os.path.join(task_folder, task, "children"), "r") as f:
+                    pending.extend(int(x) for x in f.read().split())
+            except OSError:
+                continue
+
+    return pids
+
+
+def process_tree_usage(pid, include_children=True):
+    '''(resident memory bytes, CPU seconds) of a process and its descendants, None if /proc is unavailable'''
+
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    clock_ticks = os.sysconf("SC_CLK_TCK")
+
+    rss_bytes = 0
+    cpu_seconds = 0.0
+    found = False
+    for tree_pid in _process_tree_pids(pid) if include_children else [pid]:
+        try:
+            with open("/proc/%d/statm" % tree_pid, "r") as f:
+                rss_bytes += int(f.read().split()[1]) * page_size
+            with open("/proc/%d/stat" % tree_pid, "r") as f:
+                # fields after the parenthesized command name; utime and stime are fields 14 and 15
+                stat_fields = f.read().rsplit(")", 1)[1].split()
+                cpu_seconds += (int(stat_fields[11]) + int(stat_fields[12])) / clock_ticks
+            found = True
+        except (OSError, IndexError, ValueError):
+            continue
+
+    return (rss_bytes, cpu_seconds) if found else None
+
+
+def open_files(pid, paths):
+    '''Which of paths (resolved, absolute) a process or its descendants have open, read from /proc (Linux)'''
+
+    found = set()
+    for tree_pid in _process_tree_pids(pid):
+        fd_folder = "/proc/%d/fd" % tree_pid
+        try:
+            fds = os.listdir(fd_folder)
+        except OSError:
+            continue
+        for fd in fds:
+            try:
+                target = os.readlink(os.path.join(fd_folder, fd))
+            except OSError:
+                continue
+            if target in paths:
+                found.add(target)
+
+    return found
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(labels):
+
+    if not labels:
+        return ""
+
+    return "{" + ",".join('%s="%s"' % (key, _escape_label(value)) for key, value in labels.items()) + "}"
+
+
+class ModuleProgress(object):
+    '''Live state of a running module'''
+
+    def __init__(self, pipe, module, language, allocation, n_samples, estimated_seconds):
+
+        self.pipe = pipe
+        self.module = module
+        self.language = language
+        self.n_workers = allocation.n_workers
+        self.memory_bytes = allocation.memory_bytes
+        self.start_time = time.time()
+        self.samples_done = 0
+        self.samples_total = n_samples
+        self.fraction = None
+        self.last_progress_time = self.start_time
+        self.last_output_time = self.start_time
+        self.output_lines = 0
+        self.pid = None
+        self.estimated_seconds = estimated_seconds
+
+        return
+
+    def estimated_remaining_seconds(self, now):
+
+        elapsed = now - self.start_time
+        if self.fraction is not None and self.fraction > 0.05:
+            return elapsed * (1 - self.fraction) / self.fraction
+        if self.estimated_seconds is not None:
+            return max(self.estimated_seconds - elapsed, 0)
+
+        return None
+
+
+class RunTelemetry(object):
+    '''
+    Live progress and resource gauges of a run, published in Prometheus text format
+
+    Samples done and total of a module come from one of:
+      - bin modules (peakdetector, mzDeltas) running as local processes: the
+        run's spectra files which the module's processes have opened and
+        closed again, i.e. read, checked every OPEN_FILES_INTERVAL seconds;
+        the tools print no per-sample progress
+      - MZKIT_PROGRESS done/total lines in a module's output, printed by
+        mzkit.R around each R wrapper and by wrappers calling mzkit_progress()
+      - report_progress() calls of python modules
+    Metrics are served over HTTP on 127.0.0.1 when a port is given, and
+    rewritten to a metrics file every METRICS_FILE_INTERVAL seconds, e.g. for
+    node_exporter's textfile collector.
+
+    Attributes
+    ----------
+    metrics_file : str
+        path of the metrics file, None to not write one
+    port : int
+        local HTTP port serving /metrics, None to not serve
+    labels : OrderedDict
+        labels added to all of the run's metrics, e.g. to tell apart the sub-runs of a multiplexed run
+    '''
+
+    def __init__(self, metrics_file=None, port=None, labels=None):
+
+        self.metrics_file = metrics_file
+        self.port = port
+        self.labels = OrderedDict(labels or {})
+        self.lock = threading.RLock()
+
+        self.start_time = time.time()
+        self.status = "running"
+        self.run_labels = OrderedDict()
+        self.n_samples = 0
+        self.sample_files = set()
+        self.pipes_total = 0
+        self.pipes_done = 0
+        self.current_pipe = None
+        self.estimates = OrderedDict()
+        self.completed_modules = set()
+        self.active = OrderedDict()
+
+        self.publisher = None
+
+        return
+
+    def start(self, run_plan, settings, resource_plan=None):
+        '''Start publishing metrics for a run'''
+
+        with self.lock:
+            self.run_labels = OrderedDict([("output_folder", settings.run['output_folder']),
+                                           ("config_fingerprint", run_plan.fingerprint)])
+            self.n_samples = len(settings.project_files)
+            # /proc lists open files by their resolved paths
+            self.sample_files = set(os.path.realpath(x) for x in settings.project_files)
+            self.pipes_total = sum(1 for x in run_plan.pipeline.values() if x['use'])
+            if resource_plan is not None:
+                self.estimates = OrderedDict(((x.pipe, x.module), x.seconds) for x in resource_plan.estimates)
+
+        if self.metrics_file is not None or self.port is not None:
+            self.publisher = MetricsPublisher([self], self.metrics_file, self.port)
+            self.publisher.start()
+
+        return
+
+    def publish_status(self, status):
+        '''Record the run's status and write it to the metrics file right away'''
+
+        with self.lock:
+            self.status = status
+
+        if self.publisher is not None:
+            try:
+                self.publisher.write_metrics_file()
+            except OSError as e:
+                print("# Could not write metrics file " + str(self.metrics_file) + ": " + str(e))
+
+        return
+
+    def stop(self, status):
+        '''Record the run's final status and publish it a last time'''
+
+        with self.lock:
+            self.status = status
+
+        if self.publisher is not None:
+            self.publisher.stop()
+
+        return
+
+    def start_pipe(self, pipe):
+        with self.lock:
+            self.current_pipe = pipe
+
+    def finish_pipe(self, pipe, ran):
+        with self.lock:
+            if ran:
+                self.pipes_done += 1
+            self.current_pipe = None
+
+    def start_module(self, pipe, module, language, allocation):
+        with self.lock:
+            n_samples = self.n_samples if language == "bin" else 0
+            self.active[module] = ModuleProgress(pipe, module, language, allocation, n_samples, self.estimates.get((pipe, module)))
+
+    def finish_module(self, module):
+        with self.lock:
+            progress = self.active.pop(module, None)
+            if progress is not None:
+                self.completed_modules.add((progress.pipe, progress.module))
+
+    def attach_process(self, module, pid):
+        '''Track the resource usage of a module's process (and its children)'''
+
+        with self.lock:
+            progress = self.active.get(module)
+            if progress is None:
+                return
+            progress.pid = pid
+            watch = progress.samples_total > 0 and len(self.sample_files) > 0 and os.path.isdir("/proc/%d/fd" % pid)
+
+        if watch:
+            threading.Thread(target=self._watch_open_files, args=(progress,), daemon=True).start()
+
+    def _watch_open_files(self, progress):
+        '''Count the spectra files a module's processes have read as samples done, while the module runs'''
+
+        opened = set()
+        while True:
+            open_now = open_files(progress.pid, self.sample_files)
+            opened |= open_now
+
+            with self.lock:
+                if self.active.get(progress.module) is not progress:
+                    return
+                n_read = min(len(opened - open_now), progress.samples_total)
+                if n_read > progress.samples_done:
+                    self._set_progress(progress, n_read, progress.samples_total, time.time())
+
+            time.sleep(OPEN_FILES_INTERVAL)
+
+    def observe_line(self, module, line):
+        '''Update a module's progress from a line of its output'''
+
+        with self.lock:
+            progress = self.active.get(module)
+            if progress is None:
+                return
+
+            now = time.time()
+            progress.output_lines += 1
+            progress.last_output_time = now
+
+            parsed = parse_progress_line(line)
+            if parsed is None:
+                return
+
+            self._set_progress(progress, parsed[0], parsed[1], now)
+
+    def report_progress(self, module, done, total):
+        '''Progress reported directly by a python module'''
+
+        with self.lock:
+            progress = self.active.get(module)
+            if progress is not None and total > 0:
+                self._set_progress(progress, done, total, time.time())
+
+    def _set_progress(self, progress, done, total, now):
+
+        progress.samples_done = done
+        progress.samples_total = total
+        progress.fraction = float(done) / total
+        progress.last_progress_time = now
+
+    def collect(self, metrics):
+        '''Add the run's current metrics to metrics, a dict of name: (type, help, [(labels, value)])'''
+
+        now = time.time()
+
+        def add(name, metric_type, help_str, value, labels=None):
+            _add_metric(metrics, name, metric_type, help_str, value, OrderedDict(list(self.labels.items()) + list((labels or {}).items())))
+
+        with self.lock:
+            active = list(self.active.values())
+            pending_seconds = sum(seconds for key, seconds in self.estimates.items()
+                                  if key not in self.completed_modules and key[1] not in self.active)
+
+            add("mzkit_run_info", "gauge", "Run identity", 1, OrderedDict(list(self.run_labels.items()) + [("status", self.status)]))
+            add("mzkit_run_start_time_seconds", "gauge", "Unix time the run started", self.start_time)
+            add("mzkit_run_completed", "gauge", "Whether the run has finished", 0 if self.status == "running" else 1)
+            add("mzkit_pipes_total", "gauge", "Pipes which will run", self.pipes_total)
+            add("mzkit_pipes_completed", "gauge", "Pipes which have finished", self.pipes_done)
+            add("mzkit_samples_total", "gauge", "Spectra files in the run", self.n_samples)
+
+            remaining_seconds = pending_seconds
+            for progress in active:
+                labels = OrderedDict([("pipe", progress.pipe), ("module", progress.module), ("language", progress.language)])
+                add("mzkit_module_running", "gauge", "Modules currently running", 1, labels)
+                add("mzkit_module_start_time_seconds", "gauge", "Unix time the module started", progress.start_time, labels)
+                add("mzkit_module_samples_done", "gauge", "Samples the module reported as done", progress.samples_done, labels)
+                add("mzkit_module_samples_total", "gauge", "Samples the module will process", progress.samples_total, labels)
+                add("mzkit_module_progress_ratio", "gauge", "Fraction of the module reported as done", progress.fraction, labels)
+                add("mzkit_module_last_progress_timestamp_seconds", "gauge", "Unix time of the module's last progress update",
+                    progress.last_progress_time, labels)
+                add("mzkit_module_last_output_timestamp_seconds", "gauge", "Unix time of the module's last output line",
+                    progress.last_output_time, labels)
+                add("mzkit_module_output_lines_total", "counter", "Output lines read from the module", progress.output_lines, labels)
+                add("mzkit_module_estimated_seconds", "gauge", "Planned runtime of the module", progress.estimated_seconds, labels)
+                add("mzkit_module_workers", "gauge", "Workers allocated to the module", progress.n_workers, labels)
+                add("mzkit_module_memory_limit_bytes", "gauge", "Memory allocated to the module", progress.memory_bytes, labels)
+
+                if progress.pid is not None:
+                    usage = process_tree_usage(progress.pid)
+                    if usage is not None:
+                        add("mzkit_process_resident_memory_bytes", "gauge", PROCESS_RSS_HELP,
+                            usage[0], OrderedDict([("process", "module"), ("module", progress.module)]))
+                        add("mzkit_process_cpu_seconds_total", "counter", PROCESS_CPU_HELP,
+                            usage[1], OrderedDict([("process", "module"), ("module", progress.module)]))
+
+                module_remaining = progress.estimated_remaining_seconds(now)
+                if module_remaining is not None:
+                    remaining_seconds += module_remaining
+
+            if self.status == "running":
+                add("mzkit_run_estimated_remaining_seconds", "gauge", "Estimated time until the run finishes", remaining_seconds)
+
+        return
+
+    def render(self):
+        '''Current metrics in Prometheus text exposition format'''
+
+        return render_metrics([self])
+
+
+PROCESS_RSS_HELP = "Resident memory of the driver process or a module's process tree"
+PROCESS_CPU_HELP = "CPU time of the driver process or a module's process tree"
+
+
+def _add_metric(metrics, name, metric_type, help_str, value, labels=None):
+
+    if value is None:
+        return
+    if name not in metrics:
+        metrics[name] = (metric_type, help_str, [])
+    metrics[name][2].append((labels, value))
+
+
+def render_metrics(sources):
+    '''Metrics of one or more RunTelemetry and of the driver process in Prometheus text exposition format'''
+
+    metrics = OrderedDict()
+    for source in sources:
+        source.collect(metrics)
+
+    # the driver alone; module processes are reported by each run
+    usage = process_tree_usage(os.getpid(), include_children=False)
+    if usage is not None:
+        driver_rss, driver_cpu = usage
+    else:
+        rusage = resource.getrusage(resource.RUSAGE_SELF)
+        driver_rss, driver_cpu = None, rusage.ru_utime + rusage.ru_stime
+    _add_metric(metrics, "mzkit_process_resident_memory_bytes", "gauge", PROCESS_RSS_HELP, driver_rss, OrderedDict([("process", "driver")]))
+    _add_metric(metrics, "mzkit_process_cpu_seconds_total", "counter", PROCESS_CPU_HELP, driver_cpu, OrderedDict([("process", "driver")]))
+
+    lines = []
+    for name, (metric_type, help_str, samples) in metrics.items():
+        lines.append("# HELP %s %s" % (name, help_str))
+        lines.append("# TYPE %s %s" % (name, metric_type))
+        for labels, value in samples:
+            lines.append("%s%s %s" % (name, _format_labels(labels), repr(float(value))))
+
+    return "\n".join(lines) + "\n"
+
+
+class MetricsPublisher(object):
+    '''
+    Serves the metrics of one or more runs over local HTTP and rewrites them to a file
+
+    Attributes
+    ----------
+    sources : [RunTelemetry]
+        runs whose metrics are published together
+    metrics_file : str
+        path of the metrics file, None to not write one
+    port : int
+        local HTTP port serving /metrics (0 picks a free port), None to not serve
+    '''
+
+    def __init__(self, sources, metrics_file=None, port=None):
+
+        self.sources = list(sources)
+        self.metrics_file = metrics_file
+        self.port = port
+
+        self.server = None
+        self.stop_event = threading.Event()
+        self.writer = None
+
+        return
+
+    def render(self):
+        return render_metrics(self.sources)
+
+    def start(self):
+
+        if self.port is not None:
+            publisher = self
+
+            class MetricsHandler(BaseHTTPRequestHandler):
+
+                def do_GET(self):
+                    if self.path.split("?")[0] not in ["/", "/metrics"]:
+                        self.send_error(404)
+                        return
+                    body = publisher.render().encode("utf-8")
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    return
+
+            try:
+                self.server = ThreadingHTTPServer(("127.0.0.1", self.port), MetricsHandler)
+            except OSError as e:
+                print("# WARNING: could not serve run metrics on port %d (%s), continuing without it" % (self.port, e))
+                self.server = None
+
+            if self.server is not None:
+                self.server.daemon_threads = True
+                threading.Thread(target=self.server.serve_forever, daemon=True).start()
+                print("# Serving run metrics at http://127.0.0.1:%d/metrics" % self.server.server_address[1])
+
+        if self.metrics_file is not None:
+            self.writer = threading.Thread(target=self._write_periodically, daemon=True)
+            self.writer.start()
+
+        return
+
+    def stop(self):
+        '''Write the metrics file a last time and stop serving'''
+
+        self.stop_event.set()
+        if self.writer is not None:
+            self.writer.join()
+        self.write_metrics_file()
+
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+        return
+
+    def write_metrics_file(self):
+        '''Atomically replace the metrics file with the current metrics'''
+
+        if self.metrics_file is None:
+            return
+
+        tmp_path = self.metrics_file + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.render())
+        os.replace(tmp_path, self.metrics_file)
+
+        return
+
+    def _write_periodically(self):
+
+        while not self.stop_event.is_set():
+            try:
+                self.write_metrics_file()
+            except OSError as e:
+                print("# Could not write metrics file " + self.metrics_file + ": " + str(e))
+            self.stop_event.wait(METRICS_FILE_INTERVAL)
+
+        return
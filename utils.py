@@ -1,13 +1,20 @@
 import os
-import subprocess
 import platform
 import argparse
 from collections import OrderedDict
 from pytz import timezone
 import os
 import re
+import traceback
 from time import time, gmtime, strftime
 from datetime import datetime
+from resources import RESOURCE_PARAMETERS, allocation_environment
+from executors import DEFAULT_BATCH_MEMORY_MB, DEFAULT_BATCH_MINUTES, DEFAULT_POLL_SECONDS, EXECUTOR_NAMES, LocalExecutor
+from pymodules import load_py_module
+
+
+# methodIds such as M002A, as found in file names and instrument method names
+DEFAULT_METHOD_PATTERN = r'M\d{3}[A-Z]'
 
 
 class PipelineFailedException(Exception):
@@ -34,6 +41,63 @@ def get_mz_files_list(project_folder):
     return matched
 
 
+def read_scan_count(spectra_file, header_bytes=65536):
+    '''
+    Read the number of scans declared in a spectra file's header
+
+    Only the start of the file is read: mzML declares <spectrumList count=...>
+    and mzXML <msRun scanCount=...>. Returns None when no count is declared.
+    '''
+
+    with open(spectra_file, "rb") as f:
+        header = f.read(header_bytes).decode("utf-8", errors="ignore")
+
+    match = re.search(r'<spectrumList[^>]*\scount="(\d+)"', header) or re.search(r'<msRun[^>]*\sscanCount="(\d+)"', header)
+    if match is None:
+        return None
+
+    return int(match.group(1))
+
+
+def read_acquisition_info(spectra_file, method_pattern=DEFAULT_METHOD_PATTERN, header_bytes=1048576):
+    '''
+    Read the polarity and method id of a spectra file from its header
+
+    Polarity comes from the scans at the start of the file: the mzML
+    positive/negative scan cvParams or the mzXML polarity attribute ("mixed"
+    for polarity-switching files). The method id is the first match of
+    method_pattern in the header before the first scan (source file names,
+    run id, instrument method), falling back to the file name.
+
+    Returns
+    -------
+    (polarity, method_id) : (str, str)
+      polarity is positive, negative, mixed or None; method_id is None if not found
+    '''
+
+    with open(spectra_file, "rb") as f:
+        header = f.read(header_bytes).decode("utf-8", errors="ignore")
+
+    positive = re.search(r'MS:1000130|polarity="\+"', header) is not None
+    negative = re.search(r'MS:1000129|polarity="-"', header) is not None
+    if positive and negative:
+        polarity = "mixed"
+    elif positive:
+        polarity = "positive"
+    elif negative:
+        polarity = "negative"
+    else:
+        polarity = None
+
+    first_scan = re.search(r'<spectrum\s|<scan\s', header)
+    file_description = header[:first_scan.start()] if first_scan is not None else header
+
+    match = re.search(method_pattern, file_description) or re.search(method_pattern, os.path.basename(spectra_file))
+    method_id = match.group(0) if match is not None else None
+
+    return polarity, method_id
+
+
 def get_elapsed_time(start_time, end_time):
     time_elapsed = end_time - start_time
 
@@ -44,6 +108,26 @@ def get_elapsed_time(start_time, end_time):
     return time_elapsed_str
 
 
+def parse_ppm_tolerance(tolerance):
+    '''Convert a tolerance such as "10ppm" (or a bare number of ppm) to a float'''
+
+    tolerance_str = str(tolerance).strip()
+    match = re.match(r'^([0-9.eE+-]+)\s*(ppm)?$', tolerance_str, flags=re.I)
+    if match is None:
+        raise ValueError('invalid mass tolerance: %s; expected a value in ppm, e.g. 10ppm' % tolerance_str)
+
+    return float(match.group(1))
+
+
+def parse_mz_list(mz_list):
+    '''Convert a comma-separated string of m/z values, e.g. "117.0192,203.0526", to a sorted list of floats'''
+
+    if isinstance(mz_list, (int, float)):
+        return [float(mz_list)]
+
+    return sorted([float(x) for x in str(mz_list).split(",") if x.strip()])
+
+
 def exit_with_error(err_str):
     raise NameError("ERROR: " + err_str)
 
@@ -85,6 +169,89 @@ def mzkit_commandline_parser():
                         choices=[True, False],
                         default=True)
 
+    parser.add_argument("--ignore-plan",
+                        dest='ignore_plan',
+                        help="run even if the resource plan predicts that a required pipe will not fit in memory",
+                        action='store_true',
+                        default=False)
+
+    parser.add_argument("--metrics-port",
+                        dest='metrics_port',
+                        help="serve live run metrics in Prometheus format on this local port (0 picks a free port)",
+                        type=int,
+                        default=None)
+
+    parser.add_argument("--metrics-file",
+                        dest='metrics_file',
+                        help="file which live run metrics are written to (default: mzkit_metrics.prom in the output folder)",
+                        default=None)
+
+    parser.add_argument("--multiplex",
+                        dest='multiplex',
+                        help="split the data folder by polarity and methodId read from the spectra file headers and run each group as a concurrent sub-run",
+                        action='store_true',
+                        default=False)
+
+    parser.add_argument("--method-pattern",
+                        dest='method_pattern',
+                        help="regular expression matching methodIds in spectra file headers and names (with --multiplex)",
+                        default=DEFAULT_METHOD_PATTERN)
+
+    parser.add_argument("--max-concurrent-groups",
+                        dest='max_concurrent_groups',
+                        help="number of multiplexed sub-runs which run at the same time (default: all)",
+                        type=int,
+                        default=None)
+
+    parser.add_argument("--library-path",
+                        dest='library_path',
+                        help="folder of MSP libraries, matched to each run's methodId for peakdetector_mzkitchen_search (default: libraries in the output folder)",
+                        default=None)
+
+    parser.add_argument("--executor",
+                        dest='executor',
+                        help="where bin and R modules run: local processes, jobs of a batch scheduler (--batch-submit), or jobs of a local fake scheduler for testing",
+                        choices=EXECUTOR_NAMES,
+                        default="local")
+
+    parser.add_argument("--batch-submit",
+                        dest='batch_submit',
+                        help="command submitting a job script, e.g. \"sbatch --parsable -c {n_cpus} --mem={memory_mb}M {script}\" (fields: script, job_folder, name, n_cpus, memory_mb, minutes); prints the job id",
+                        default=None)
+
+    parser.add_argument("--batch-status",
+                        dest='batch_status',
+                        help="command which prints output while job {job_id} is queued or running, e.g. \"squeue -h -j {job_id}\"",
+                        default=None)
+
+    parser.add_argument("--batch-cancel",
+                        dest='batch_cancel',
+                        help="command cancelling job {job_id}, e.g. \"scancel {job_id}\"",
+                        default=None)
+
+    parser.add_argument("--batch-jobs-folder",
+                        dest='batch_jobs_folder',
+                        help="folder on a filesystem shared with the compute nodes for job scripts, logs and results (default: <output folder>_jobs)",
+                        default=None)
+
+    parser.add_argument("--batch-default-memory-mb",
+                        dest='batch_default_memory_mb',
+                        help="memory_mb requested by jobs of modules without a memory limit",
+                        type=int,
+                        default=DEFAULT_BATCH_MEMORY_MB)
+
+    parser.add_argument("--batch-default-minutes",
+                        dest='batch_default_minutes',
+                        help="time limit (minutes) requested by jobs of modules without enough run history to estimate their runtime",
+                        type=int,
+                        default=DEFAULT_BATCH_MINUTES)
+
+    parser.add_argument("--batch-poll-seconds",
+                        dest='batch_poll_seconds',
+                        help="seconds between checks for finished batch jobs",
+                        type=float,
+                        default=DEFAULT_POLL_SECONDS)
+
     parser.add_argument('-w', "--wild-cards",
                         dest='wild_cards',
                         help = "Used to overwrite config arguments",
@@ -99,7 +266,7 @@ def mzkit_commandline_parser():
     return parser
 
 
-def run_pipe(config, settings, pipe):
+def run_pipe(run_plan, settings, pipe):
   
     '''
     Run one step of the pipeline
@@ -109,8 +276,8 @@ def run_pipe(config, settings, pipe):
         
     Parameters
     ----------
-    config : dict
-      configuration generated using mzkitConfig()
+    run_plan : RunPlan
+      validated pipeline plan generated using MzkitConfig.compile()
     settings: dict
       paths to the dataset, outputs and programming assets, and run settings
     pipe : str
@@ -122,28 +289,22 @@ def run_pipe(config, settings, pipe):
       pipeline steps and their associated parameters
     '''
   
-    pipe_config = config.get_pipe_dict(pipe)
+    # use / required / critical consistency is checked when the plan is compiled
+    pipe_config = run_plan.get_pipe_dict(pipe)
     
     use = pipe_config['pipe']['use'] # should the step be run
     required = pipe_config['pipe']['required'] # should a failure stop the pipeline. this could be altered if a certain non-critical step is required for an analysis (e.g.,)
     critical = pipe_config['pipe']['critical'] # does a pipe always need to be run
     modules_dict = pipe_config['modules']
     
-    if critical and not use:
-        raise ValueError('the %s pipe is set to not be used, but this pipe is critical' %pipe)
-    
-    if required and not use:
-        raise ValueError('the %s pipe is set to not be used, but this pipe is required' %pipe)
-    
-    if critical and not required:
-        raise ValueError('the %s pipe is set to as critical but not required; all critical steps are required' %pipe)
-    
     status_dict = {}
     timing_dict = OrderedDict()
     step_start = datetime.now()
+    mzrolldb_state = get_file_state(settings.mzrolldb_file)
     
     print("=================================================")
     print("#### Running Pipe: " + pipe)
+    settings.telemetry.start_pipe(pipe)
     
     if use:
         fail = False
@@ -154,10 +315,11 @@ def run_pipe(config, settings, pipe):
             print("    \n")
 
             # determine whether previous steps have failed        
+            usage_dict = None
             if not fail:
                 try:
                     # run module
-                    run_module(module, modules_dict[module], pipe, settings)
+                    usage_dict = run_module(module, modules_dict[module], pipe, settings)
                     fail = False
                     message = "success"
 
@@ -168,10 +330,11 @@ def run_pipe(config, settings, pipe):
                     message = "failure of non-critical module"
 
         
-            # save timing information
+            # save timing and resource usage information
             timing_dict[module] = {
                 'end_time': datetime.now(),
-                'message': message
+                'message': message,
+                'usage': usage_dict
                 }
     
         status_dict['timing_dict'] = timing_dict
@@ -180,6 +343,9 @@ def run_pipe(config, settings, pipe):
             'critical_fail': ((fail and critical) or (fail and required)),
             'fail': fail
             }
+
+        if get_file_state(settings.mzrolldb_file) != mzrolldb_state and "mzrolldb_tuning" not in modules_dict:
+            tune_mzrolldb_after_pipe(run_plan, settings, pipe)
     else:
         # pipe not run, but still return a status_dict
       
@@ -196,6 +362,8 @@ def run_pipe(config, settings, pipe):
             'fail': False
             }
 
+    settings.telemetry.finish_pipe(pipe, use)
+
     print("    ")
     print("    #### Completed Pipe: " + pipe + " in " + get_elapsed_time(step_start, datetime.now()))
     print("    =============================================\n")
@@ -203,23 +371,147 @@ def run_pipe(config, settings, pipe):
     return status_dict
     
     
+def get_file_state(path):
+    '''
+    Returns the (modification time, size) of a file and of its SQLite -wal file, or None if it does not exist
+
+    Writes to an SQLite database in WAL mode (e.g., by python modules) only
+    reach the main file when the WAL is checkpointed, so the -wal file's state
+    is part of the database's.
+    '''
+
+    if not os.path.isfile(path):
+        return None
+
+    file_stat = os.stat(path)
+    wal_state = None
+    if os.path.isfile(path + "-wal"):
+        wal_stat = os.stat(path + "-wal")
+        wal_state = (wal_stat.st_mtime_ns, wal_stat.st_size)
+
+    return (file_stat.st_mtime_ns, file_stat.st_size, wal_state)
+
+
+def tune_mzrolldb_after_pipe(run_plan, settings, pipe):
+    '''
+    Index and analyze the mzrollDB after a pipe has modified it
+
+    This runs when the config defines the mzrolldb_tuning module with
+    after_each_pipe set; compaction (VACUUM) is left to the mzrolldb_tuning
+    module itself, which should be the last pipe to touch the mzrollDB.
+    '''
+
+    if "mzrolldb_tuning" not in run_plan.modules:
+        return
+
+    tuning_parameters = run_plan.modules['mzrolldb_tuning']['parameters']
+    if not tuning_parameters.get('after_each_pipe', False):
+        return
+
+    import sqlite3
+    from mzrolldb import tune_mzrolldb
+
+    try:
+        tune_mzrolldb(settings.mzrolldb_file,
+                      stage=pipe,
+                      report_path=os.path.join(settings.run['output_folder'], "QC", "mzrolldb_query_timings.tsv"),
+                      journal_mode=tuning_parameters.get('journal_mode', "wal"),
+                      vacuum=False,
+                      conn=settings.py_context.mzrolldb(settings.mzrolldb_file))
+    except sqlite3.Error as e:
+        # tuning is an optimization; a failure should not fail the pipe
+        print("    #### mzrollDB tuning after " + pipe + " failed: " + str(e))
+
+    return
+
+
 def run_module(module, module_dict, pipe, settings):
   
     # call module
     
     language = module_dict['language']
-    
-    if language == "bin":
-        summary_dict = call_bin_module(module, module_dict, pipe, settings)
-    elif language == "R":
-        summary_dict = call_R_module(module, module_dict, settings)
-    else:
-        raise ValueError('invalid language: %s does not have a defined calling method' %language)
-        
-    return summary_dict
+
+    module_start = datetime.now()
+
+    with settings.resources.allocate(module, module_dict['parameters'], settings.planned_workers.get((pipe, module)),
+                                     settings.planned_jobs.get((pipe, module))) as allocation:
+        memory_str = "unlimited" if allocation.memory_bytes is None else "%.1f GB" % (allocation.memory_bytes / 2 ** 30)
+        print("    #### Resources: " + str(allocation.n_workers) + " workers, " + memory_str + " memory")
+
+        settings.telemetry.start_module(pipe, module, language, allocation)
+        try:
+            if language == "bin":
+                # release the python modules' mzrollDB connection; the module's process may rewrite the file
+                settings.py_context.close()
+                call_bin_module(module, module_dict, pipe, settings, allocation)
+            elif language == "R":
+                settings.py_context.close()
+                call_R_module(module, module_dict, settings, allocation)
+            elif language == "py":
+                try:
+                    with allocation.measure_in_process():
+                        call_py_module(module, module_dict, settings, allocation)
+                finally:
+                    settings.py_context.after_module()
+            else:
+                raise ValueError('invalid language: %s does not have a defined calling method' %language)
+        finally:
+            settings.telemetry.finish_module(module)
+
+    usage_dict = {
+        'seconds': (datetime.now() - module_start).total_seconds(),
+        'cpu_seconds': allocation.cpu_seconds,
+        'max_rss_bytes': allocation.max_rss_bytes,
+        'n_workers': allocation.n_workers
+        }
+
+    return usage_dict
   
 
-def call_R_module(module, module_dict, settings):
+def run_command(cmd_str, settings, allocation):
+    '''
+    Run a module's shell command limited to its resource allocation
+
+    The command runs with the run's executor (settings.executor): as a local
+    process, or as a batch scheduler job with --executor batch. stdout is
+    printed as it is produced in verbose mode, and all output is passed to the
+    run's telemetry to track progress.
+
+    Raises PipelineFailedException if the command exits with a non-zero status.
+    '''
+
+    # modules run locally unless the run uses a batch scheduler; a module can opt out with "executor": "local"
+    executor = settings.executor
+    if allocation.executor == "local":
+        executor = LocalExecutor()
+
+    def on_start(pid):
+        settings.telemetry.attach_process(allocation.module, pid)
+
+    def on_line(stream, line):
+        if stream == "out" and settings.run['verbose']:
+            print(line, flush=True)
+        settings.telemetry.observe_line(allocation.module, line)
+
+    try:
+        result = executor.run(cmd_str, allocation_environment(allocation), allocation.module, allocation, on_start, on_line)
+    except (OSError, RuntimeError) as e:
+        print("    #### Running " + allocation.module + " with the " + executor.name + " executor failed: " + str(e))
+        raise PipelineFailedException(str(e))
+    allocation.add_usage(result.max_rss_bytes, result.cpu_seconds)
+
+    if result.returncode != 0:
+
+        err = result.err.decode("utf-8")
+        print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
+        print("ERROR")
+        print(err)
+        print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
+
+        raise PipelineFailedException(err)
+
+
+def call_R_module(module, module_dict, settings, allocation):
 
     output_path_argument = "output_folder={}".format(settings.run['output_folder'])
     function_call_argument = "rwrapper={}".format(module)
@@ -227,6 +519,9 @@ def call_R_module(module, module_dict, settings):
 
     aux_r_params = []
     for par, val in module_dict['parameters'].items(): 
+        # resource overrides are passed through the environment
+        if par in RESOURCE_PARAMETERS:
+            continue
         aux_r_params.append(par + "=" + str(val))
     #print(aux_r_params)
 
@@ -236,48 +531,62 @@ def call_R_module(module, module_dict, settings):
            function_call_argument,
            r_scripts_path_argument] + aux_r_params
            
-    p = subprocess.Popen(" ".join(cmd),
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE,
-                         shell=True,
-                         close_fds=True)
+    run_command(" ".join(cmd), settings, allocation)  # throws PipelineFailedException
 
-    out, err = p.communicate()
 
-    # decode byte string
-    out = out.decode("utf-8")
+def call_py_module(module, module_dict, settings, allocation):
 
-    if settings.run['verbose']:
-        print(out)
-    if p.returncode != 0:
+    # python modules are registered in pymodules and imported when first called, so that their
+    # dependencies (e.g., numpy) are only required by runs which use them
 
-        err = err.decode("utf-8")
-        print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
-        print("ERROR")
-        print(err)
-        print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
+    try:
+        run_py_module = load_py_module(module)
+    except ImportError as e:
+        print("    #### Missing python dependency for module " + module + ": " + str(e))
+        raise PipelineFailedException(str(e))
 
-        raise(PipelineFailedException(err))
+    # python modules size their process pools from n_workers and report progress under their module name
+    module_dict = OrderedDict(module_dict)
+    module_dict['module'] = module
+    module_dict['parameters'] = OrderedDict(module_dict['parameters'])
+    module_dict['parameters']['n_workers'] = allocation.n_workers
 
+    # any error of a python module fails the module, like a nonzero exit status of a bin or R module
+    try:
+        run_py_module(module_dict, settings)
+    except PipelineFailedException:
+        raise
+    except Exception as e:
+        print(traceback.format_exc())
+        print("    #### Python module " + module + " failed: " + str(e))
+        raise PipelineFailedException(str(e))
 
-def call_bin_module(module, module_dict, pipe, settings):
+    return
+
+
+def call_bin_module(module, module_dict, pipe, settings, allocation):
     
     if module == "peakdetector" or module == "peakdetector_mzkitchen_search":
         if pipe == "peakdetector":
-            run_peakdetector(settings.run['data_folder'], module_dict, settings)  # throws PipelineFailedException
+            run_peakdetector(settings.run['data_folder'], module_dict, settings, allocation)  # throws PipelineFailedException
         elif pipe == "alignment":
-            run_peakdetector(settings.mzrolldb_file, module_dict, settings)  # throws PipelineFailedException
+            # use an RT correction computed earlier in the pipe (e.g., by mzkit_alignment) unless one is configured
+            if not module_dict['parameters']['alignmentFile'] and settings.alignment_file is not None:
+                module_dict = OrderedDict(module_dict)
+                module_dict['parameters'] = OrderedDict(module_dict['parameters'])
+                module_dict['parameters']['alignmentFile'] = settings.alignment_file
+            run_peakdetector(settings.mzrolldb_file, module_dict, settings, allocation)  # throws PipelineFailedException
         else:
             raise ValueError("Called peakdetector from undefined pipe: %s" % pipe)
     elif module == "mz_deltas":
-        run_mzdeltas(module_dict, settings)  # throws PipelineFailedException
+        run_mzdeltas(module_dict, settings, allocation)  # throws PipelineFailedException
     else:
         raise ValueError("%s doesn't have a defined method for calling the appropriate binary" % module)
       
     return
 
 
-def run_peakdetector(peakdetector_input, module_dict, settings):
+def run_peakdetector(peakdetector_input, module_dict, settings, allocation):
 
     peakdetector_binary = settings.program_settings['peakdetector_bin_path'] + '/peakdetector'
 
@@ -406,31 +715,10 @@ def run_peakdetector(peakdetector_input, module_dict, settings):
 
     print("#RUNNING ", cmd_str)
 
-    p = subprocess.Popen(cmd_str,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE,
-                         shell=True,
-                         close_fds=True)
-
-    out, err = p.communicate()
+    run_command(cmd_str, settings, allocation)  # throws PipelineFailedException
 
-    # decode byte string
-    out = out.decode("utf-8")
 
-    if settings.run['verbose']:
-        print(out)
-    if p.returncode != 0:
-
-        err = err.decode("utf-8")
-        print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
-        print("ERROR")
-        print(err)
-        print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
-
-        raise PipelineFailedException(err)
-
-
-def run_mzdeltas(module_dict, settings):
+def run_mzdeltas(module_dict, settings, allocation):
     
     if not os.path.exists(settings.program_settings['mzdeltas_bin_path']):
         raise ValueError("Can not find mzDeltas binary at %s" % settings.program_settings['mzdeltas_bin_path'])
@@ -461,28 +749,7 @@ def run_mzdeltas(module_dict, settings):
     cmd_str = cmd_str + " " + data_folder
 
     print(cmd_str)
-    p = subprocess.Popen(cmd_str,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE,
-                         shell=True,
-                         close_fds=True)
-
-    out, err = p.communicate()
-
-    # decode byte string
-    out = out.decode("utf-8")
-
-    if settings.run['verbose']:
-        print(out)
-    if p.returncode != 0:
-
-        err = err.decode("utf-8")
-        print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
-        print("ERROR")
-        print(err)
-        print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
-
-        raise PipelineFailedException(err)
+    run_command(cmd_str, settings, allocation)  # throws PipelineFailedException
 
     if not os.path.isfile(output_file):
         raise OSError(2, "Outfile not found")